@@ -0,0 +1,369 @@
+#! /usr/bin/env python
+
+# Benchmark for the stages of the probabilistic annotation algorithm with synthetic data.
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing import Pool
+from biop3.ProbModelSEED.ProbAnnotationWorker import ProbAnnotationWorker
+from biop3.ProbModelSEED.ProbAnnotationIndex import ProbAnnotationIndex, writeIndexFile
+from biop3.ProbModelSEED.ProbAnnotationEngine import CompiledTemplate, NUMPY_AVAILABLE
+from biop3.ProbModelSEED.ProbAnnotationHitStore import DEFAULT_MAX_LIKELIHOOD_CHANGE
+
+desc = '''
+Time the stages of the probabilistic annotation algorithm on synthetic data
+without running the search program or loading the static database files
+from Shock.  For each scale, a genome with that many proteins, a search
+results table in BLAST output format 6, a feature ID to role index, and a
+template with complexes and reactions are generated from a fixed random seed
+so every run uses the same inputs.  Each scale runs in a separate process so
+the peak memory is measured for that scale alone.
+
+Use --save-baseline to store the results in a baseline file and --baseline
+to compare a run against a stored baseline.  The command exits with status 1
+when a stage is slower than the baseline by more than the tolerance.
+
+The rolesetProbabilitiesFromHits stage times the likelihood calculations on
+hits that are already parsed and reads every likelihood tuple.  The
+rolesetProbabilitiesFromHitsPython stage times the pure Python calculations
+on the same hits so the two can be compared in one run.
+
+Use --top-k and --min-relative-score to also time the parse and marble-picking
+stages with low-scoring hits pruned and report the largest change in a roleset
+likelihood and in a total role probability compared to the unpruned results.
+Use --max-likelihood-change to set the largest change in a likelihood allowed
+from pruning.  The command exits with status 1 when the measured change is
+larger.
+'''
+
+# Version of the synthetic data (change when the generated inputs change so old baselines are not used).
+BENCHMARK_VERSION = '1'
+
+# Default numbers of proteins in the synthetic genomes.
+DEFAULT_SCALES = [ 500, 5000, 50000 ]
+
+# Stages in the order they are run.
+STAGES = [ 'parseBlastOutput', 'rolesetProbabilitiesMarble', 'rolesetProbabilitiesFromHits', 'rolesetProbabilitiesFromHitsPython',
+           'rolesetProbabilitiesToRoleProbabilities',
+           'totalRoleProbabilities', 'complexProbabilities', 'reactionProbabilities', 'templateProbabilities' ]
+
+# Stages run again with pruned hits when pruning is enabled.
+PRUNED_STAGES = [ 'parseBlastOutputPruned', 'rolesetProbabilitiesMarblePruned' ]
+
+# Stages faster than this number of seconds are not checked against the baseline.
+MIN_CHECK_TIME = 0.05
+
+# Separator between roles in a rolestring.
+SEPARATOR = '///'
+
+def _choose(rng, weights):
+    ''' Pick a value with a weighted random choice.
+        @param rng: Random object
+        @param weights: List of tuples with value and weight
+        @return Chosen value
+    '''
+
+    pick = rng.random() * sum([ weight for value, weight in weights ])
+    for value, weight in weights:
+        pick -= weight
+        if pick < 0.0:
+            return value
+    return weights[-1][0]
+
+''' Synthetic genome, search results, feature ID to role index, and template for one scale. '''
+
+class SyntheticData:
+
+    def __init__(self, folder, numProteins, seed):
+        ''' Generate the synthetic inputs for one scale.
+            @param folder: Path to folder for generated files
+            @param numProteins: Number of proteins in the genome
+            @param seed: Seed for random number generator
+        '''
+
+        rng = random.Random(seed * 1000003 + numProteins)
+
+        # Reference proteins with one or more roles (most proteins have a single function).
+        roles = [ 'Synthetic role %d' %(index) for index in range(4000) ]
+        self.fidsToRoles = dict()
+        for index in range(20000):
+            numRoles = _choose(rng, [ (1, 85), (2, 12), (3, 3) ])
+            self.fidsToRoles['fig|83333.1.peg.%d' %(index)] = rng.sample(roles, numRoles)
+        referenceFids = sorted(self.fidsToRoles)
+        self.indexFile = os.path.join(folder, 'OTU_FID_ROLE.index')
+        writeIndexFile(self.indexFile, self.fidsToRoles)
+
+        # Search results with hits in order of increasing E value for each query.  Some
+        # proteins have no hits.
+        self.blastResultFile = os.path.join(folder, 'genome.blastout')
+        self.numHits = 0
+        with open(self.blastResultFile, 'w') as handle:
+            for index in range(numProteins):
+                query = 'fig|666666.1.peg.%d' %(index)
+                numHits = 0 if rng.random() < 0.1 else rng.randint(1, 40)
+                evalues = sorted([ 10 ** -rng.uniform(5, 180) for hit in range(numHits) ])
+                for evalue in evalues:
+                    handle.write('%s\t%s\t%.1f\t300\t10\t0\t1\t300\t1\t300\t%g\t%.1f\n' \
+                                 %(query, rng.choice(referenceFids), rng.uniform(25, 100), evalue, rng.uniform(30, 600)))
+                self.numHits += numHits
+
+        # Template with complexes built from the reference roles (and some roles that are
+        # not represented) and reactions with several complexes.
+        templateRoles = roles + [ 'Unrepresented role %d' %(index) for index in range(400) ]
+        self.complexesToRoles = dict()
+        for index in range(3000):
+            numRoles = _choose(rng, [ (1, 55), (2, 25), (3, 12), (4, 4), (6, 3), (8, 1) ])
+            self.complexesToRoles['cpx%05d' %(index)] = rng.sample(templateRoles, numRoles)
+        complexes = sorted(self.complexesToRoles)
+        self.reactionsToComplexes = dict()
+        for index in range(8000):
+            numComplexes = _choose(rng, [ (0, 5), (1, 60), (2, 25), (3, 6), (6, 4) ])
+            self.reactionsToComplexes['rxn%05d' %(index)] = rng.sample(complexes, numComplexes)
+        return
+
+def _measure(results, stage, numItems, function, *args, **kwargs):
+    ''' Run a stage and record the wall clock time, CPU time, and memory.
+        @param results: Dictionary keyed by stage name of measurements
+        @param stage: Name of stage
+        @param numItems: Number of items processed by the stage
+        @param function: Function that runs the stage
+        @return Return value of function
+    '''
+
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    value = function(*args, **kwargs)
+    wallTime = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    cpuTime = after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime
+    if stage not in results or wallTime < results[stage]['wall_time']:
+        results[stage] = { 'wall_time': wallTime, 'cpu_time': cpuTime, 'items': numItems,
+                           'items_per_second': numItems / wallTime if wallTime > 0 else 0.0,
+                           'max_rss_kb': after.ru_maxrss, 'rss_growth_kb': after.ru_maxrss - before.ru_maxrss }
+    return value
+
+def _maxChange(first, second):
+    ''' Find the largest difference between two sets of probabilities.
+        @param first: Dictionary keyed by item of probability
+        @param second: Dictionary keyed by item of probability
+        @return Largest absolute difference (an item missing from one set has probability 0)
+    '''
+
+    change = 0.0
+    for key in set(first) | set(second):
+        change = max(change, abs(first.get(key, 0.0) - second.get(key, 0.0)))
+    return change
+
+def _readLikelihoods(worker, hits, useArrays):
+    ''' Calculate the roleset likelihoods from parsed hits and read every tuple.
+        @param worker: ProbAnnotationWorker object
+        @param hits: ProbAnnotationHitStore object with hits for each query
+        @param useArrays: When True, use the array-backed calculations
+        @return Number of likelihood tuples
+    '''
+
+    rolestringTuples = worker.rolesetProbabilitiesFromHits(hits, useArrays)
+    numTuples = 0
+    for query in rolestringTuples:
+        numTuples += len(rolestringTuples[query])
+    return numTuples
+
+def runScale(numProteins, seed, repeat, topK=0, minRelativeScore=0.0, maxLikelihoodChange=DEFAULT_MAX_LIKELIHOOD_CHANGE):
+    ''' Generate the inputs for a scale and time every stage.
+        @param numProteins: Number of proteins in the genome
+        @param seed: Seed for random number generator
+        @param repeat: Number of times to run each stage (the fastest run is kept)
+        @param topK: Maximum number of hits to keep for a query when pruning (0 for no limit)
+        @param minRelativeScore: Minimum fraction of the maximum score for a query when pruning
+            (0 for no limit)
+        @param maxLikelihoodChange: Largest change in a likelihood allowed from pruning
+        @return Dictionary with the measurements for the scale
+    '''
+
+    folder = tempfile.mkdtemp(prefix='probannobench')
+    try:
+        data = SyntheticData(folder, numProteins, seed)
+        config = { 'data_dir': os.path.join(folder, 'data'), 'work_dir': os.path.join(folder, 'work'),
+                   'mlog_log_file': os.path.join(folder, 'bench.log'), 'mlog_log_level': '3',
+                   'separator': SEPARATOR, 'search_program': 'usearch', 'search_program_path': 'usearch',
+                   'shock-url': '', 'load_data_option': 'preload', 'data_sources': 'cdm',
+                   'pseudo_count': '40', 'dilution_percent': '80' }
+        fidRoleIndex = ProbAnnotationIndex(data.indexFile, SEPARATOR)
+        worker = ProbAnnotationWorker('bench', fidRoleIndex=fidRoleIndex, config=config)
+        template = CompiledTemplate(data.complexesToRoles, data.reactionsToComplexes)
+
+        # Each pruned stage runs right after the same stage without pruning so both are
+        # timed with the same objects in memory.
+        pruning = topK > 0 or minRelativeScore > 0.0
+        if pruning:
+            prunedConfig = dict(config)
+            prunedConfig['hit_top_k'] = str(topK)
+            prunedConfig['hit_min_relative_score'] = repr(minRelativeScore)
+            prunedConfig['hit_max_likelihood_change'] = repr(maxLikelihoodChange)
+            prunedWorker = ProbAnnotationWorker('bench', fidRoleIndex=fidRoleIndex, config=prunedConfig)
+
+        results = dict()
+        for run in range(repeat):
+            _measure(results, 'parseBlastOutput', data.numHits, worker.dataParser.parseBlastOutput, data.blastResultFile)
+            if pruning:
+                hitStore = _measure(results, 'parseBlastOutputPruned', data.numHits, prunedWorker.dataParser.parseBlastOutput,
+                                    data.blastResultFile, None, topK, minRelativeScore, maxLikelihoodChange)
+            rolestringTuples = _measure(results, 'rolesetProbabilitiesMarble', data.numHits,
+                                        worker.rolesetProbabilitiesMarble, data.blastResultFile)
+            if pruning:
+                prunedTuples = _measure(results, 'rolesetProbabilitiesMarblePruned', data.numHits,
+                                        prunedWorker.rolesetProbabilitiesMarble, data.blastResultFile)
+            hits = worker.dataParser.parseBlastOutput(data.blastResultFile, fidRoleIndex)
+            _measure(results, 'rolesetProbabilitiesFromHits', data.numHits, _readLikelihoods, worker, hits, True)
+            _measure(results, 'rolesetProbabilitiesFromHitsPython', data.numHits, _readLikelihoods, worker, hits, False)
+            del hits
+            roleProbs = _measure(results, 'rolesetProbabilitiesToRoleProbabilities', len(rolestringTuples),
+                                 worker.rolesetProbabilitiesToRoleProbabilities, rolestringTuples)
+            totalRoleProbs = _measure(results, 'totalRoleProbabilities', len(roleProbs),
+                                      worker.totalRoleProbabilities, roleProbs)
+            complexProbs = _measure(results, 'complexProbabilities', len(data.complexesToRoles),
+                                    worker.complexProbabilities, totalRoleProbs, complexesToRequiredRoles=data.complexesToRoles)
+            _measure(results, 'reactionProbabilities', len(data.reactionsToComplexes),
+                     worker.reactionProbabilities, complexProbs, rxnsToComplexes=data.reactionsToComplexes)
+            _measure(results, 'templateProbabilities', len(data.reactionsToComplexes),
+                     worker.templateProbabilities, totalRoleProbs, template)
+        worker.cleanup()
+        scale = { 'proteins': numProteins, 'hits': data.numHits, 'stages': results }
+
+        # Compare the likelihoods and total role probabilities from pruned hits to the
+        # unpruned results.
+        if pruning:
+            prunedTotalRoleProbs = prunedWorker.totalRoleProbabilities(prunedWorker.rolesetProbabilitiesToRoleProbabilities(prunedTuples))
+            prunedWorker.cleanup()
+            likelihoods = dict([ ((query, tup[0]), tup[1]) for query in rolestringTuples for tup in rolestringTuples[query] ])
+            prunedLikelihoods = dict([ ((query, tup[0]), tup[1]) for query in prunedTuples for tup in prunedTuples[query] ])
+            scale['pruning'] = { 'top_k': topK, 'min_relative_score': minRelativeScore, 'max_likelihood_change_bound': maxLikelihoodChange,
+                                 'hits_kept': hitStore.numHits(),
+                                 'max_likelihood_change': _maxChange(likelihoods, prunedLikelihoods),
+                                 'max_role_probability_change': _maxChange(dict([ (tup[0], tup[1]) for tup in totalRoleProbs ]),
+                                                                           dict([ (tup[0], tup[1]) for tup in prunedTotalRoleProbs ])) }
+        fidRoleIndex.close()
+        return scale
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+def _runScale(args):
+    ''' Run a scale in a pool process.
+        @param args: Tuple with arguments for runScale()
+        @return Dictionary with the measurements for the scale
+    '''
+
+    return runScale(*args)
+
+def compareToBaseline(scales, baseline, tolerance):
+    ''' Compare the measurements to a baseline.
+        @param scales: List of dictionaries with measurements for each scale
+        @param baseline: Dictionary with baseline measurements
+        @param tolerance: Fraction a stage can be slower than the baseline
+        @return List of strings describing each regression
+    '''
+
+    regressions = list()
+    for scale in scales:
+        baseStages = baseline['scales'].get(str(scale['proteins']), dict())
+        for stage in STAGES + PRUNED_STAGES:
+            if stage not in baseStages or stage not in scale['stages']:
+                continue
+            baseTime = baseStages[stage]['wall_time']
+            wallTime = scale['stages'][stage]['wall_time']
+            scale['stages'][stage]['baseline_change'] = (wallTime - baseTime) / baseTime if baseTime > 0 else 0.0
+            if max(wallTime, baseTime) >= MIN_CHECK_TIME and wallTime > baseTime * (1.0 + tolerance):
+                regressions.append('%s with %d proteins took %.3f seconds (baseline %.3f seconds)' \
+                                   %(stage, scale['proteins'], wallTime, baseTime))
+    return regressions
+
+def printReport(scales):
+    ''' Print a table of the measurements.
+        @param scales: List of dictionaries with measurements for each scale
+        @return Nothing
+    '''
+
+    print '%-10s %-10s %-40s %10s %14s %12s %10s' %('proteins', 'hits', 'stage', 'seconds', 'items/second', 'peak RSS MB', 'baseline')
+    for scale in scales:
+        for stage in STAGES + PRUNED_STAGES:
+            if stage not in scale['stages']:
+                continue
+            result = scale['stages'][stage]
+            change = ''
+            if 'baseline_change' in result:
+                change = '%+.1f%%' %(result['baseline_change'] * 100.0)
+            print '%-10d %-10d %-40s %10.3f %14.0f %12.1f %10s' %(scale['proteins'], scale['hits'], stage, result['wall_time'],
+                result['items_per_second'], result['max_rss_kb'] / 1024.0, change)
+    for scale in scales:
+        if 'pruning' in scale:
+            pruning = scale['pruning']
+            print 'Pruning with %d proteins kept %d of %d hits: max likelihood change %.3g (allowed %.3g), max role probability change %.3g' \
+                %(scale['proteins'], pruning['hits_kept'], scale['hits'], pruning['max_likelihood_change'],
+                  pruning['max_likelihood_change_bound'], pruning['max_role_probability_change'])
+    return
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='BenchmarkProbAnnotation.py', description=desc, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', help='comma separated list of numbers of proteins in a genome', action='store', dest='scales',
+                        default=','.join([ str(scale) for scale in DEFAULT_SCALES ]))
+    parser.add_argument('--repeat', help='number of times to run each stage (the fastest run is kept)', action='store', type=int, dest='repeat', default=3)
+    parser.add_argument('--seed', help='seed for generating synthetic data', action='store', type=int, dest='seed', default=1)
+    parser.add_argument('--baseline', help='path to baseline file to compare against', action='store', dest='baseline', default=None)
+    parser.add_argument('--save-baseline', help='path to file to save results as a baseline', action='store', dest='saveBaseline', default=None)
+    parser.add_argument('--tolerance', help='fraction a stage can be slower than the baseline', action='store', type=float, dest='tolerance', default=0.25)
+    parser.add_argument('--json', help='path to file to save results in JSON format', action='store', dest='json', default=None)
+    parser.add_argument('--top-k', help='maximum number of hits to keep for a query when pruning', action='store', type=int, dest='topK', default=0)
+    parser.add_argument('--min-relative-score', help='minimum fraction of the maximum score for a query when pruning', action='store',
+                        type=float, dest='minRelativeScore', default=0.0)
+    parser.add_argument('--max-likelihood-change', help='largest change in a likelihood allowed from pruning', action='store',
+                        type=float, dest='maxLikelihoodChange', default=DEFAULT_MAX_LIKELIHOOD_CHANGE)
+    args = parser.parse_args()
+
+    # Run each scale in a new process so the peak memory is only for that scale.
+    scales = list()
+    for numProteins in [ int(scale) for scale in args.scales.split(',') ]:
+        sys.stderr.write('Running benchmark with %d proteins\n' %(numProteins))
+        pool = Pool(processes=1)
+        try:
+            scales.append(pool.apply(_runScale, [ (numProteins, args.seed, args.repeat, args.topK, args.minRelativeScore, args.maxLikelihoodChange) ]))
+        finally:
+            pool.close()
+            pool.join()
+    report = { 'version': BENCHMARK_VERSION, 'seed': args.seed, 'python': platform.python_version(), 'numpy': NUMPY_AVAILABLE,
+               'host': platform.node(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'scales': dict([ (str(scale['proteins']), scale['stages']) for scale in scales ]),
+               'pruning': dict([ (str(scale['proteins']), scale['pruning']) for scale in scales if 'pruning' in scale ]) }
+
+    # Compare the results to the baseline.
+    regressions = list()
+    if args.baseline is not None:
+        baseline = json.load(open(args.baseline, 'r'))
+        if baseline.get('version') != BENCHMARK_VERSION or baseline.get('seed') != args.seed or baseline.get('numpy') != NUMPY_AVAILABLE:
+            sys.stderr.write('Baseline in %s was made with different synthetic data or without the same numpy support\n' %(args.baseline))
+            exit(2)
+        regressions = compareToBaseline(scales, baseline, args.tolerance)
+
+    # Check that pruning stayed within the allowed change in a likelihood.
+    for scale in scales:
+        if 'pruning' in scale and scale['pruning']['max_likelihood_change'] > args.maxLikelihoodChange:
+            regressions.append('pruning with %d proteins changed a likelihood by %.3g (allowed %.3g)' \
+                               %(scale['proteins'], scale['pruning']['max_likelihood_change'], args.maxLikelihoodChange))
+
+    printReport(scales)
+    if args.json is not None:
+        json.dump(report, open(args.json, 'w'), indent=4, sort_keys=True)
+    if args.saveBaseline is not None:
+        json.dump(report, open(args.saveBaseline, 'w'), indent=4, sort_keys=True)
+        sys.stderr.write('Saved baseline to %s\n' %(args.saveBaseline))
+    if len(regressions) > 0:
+        for regression in regressions:
+            sys.stderr.write('Regression: %s\n' %(regression))
+        exit(1)
+    exit(0)
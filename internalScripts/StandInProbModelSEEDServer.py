@@ -0,0 +1,122 @@
+#! /usr/bin/env python
+
+# Stand-in ProbModelSEED server for testing JSON-RPC calls from ProbModelSEEDClient.
+import argparse
+import gzip
+import json
+import sys
+import time
+import traceback
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+
+desc = '''
+Answer JSON-RPC 1.1 requests like the ProbModelSEED service with canned
+results from a data file.  The data file is a JSON object keyed by method name
+(without the ProbModelSEED prefix) of objects keyed by the JSON encoding of the
+input parameter (with sorted keys) of the result.  A call with an input that
+is not in the data file returns an error.  A request body that is a list of
+calls is answered with a list of responses in one round trip.  Use --no-batch
+to reject a list of calls like a server that does not support batches,
+--delay to add latency to every request, and --gzip to compress responses for
+clients that accept gzip encoding.
+'''
+
+def paramKey(param):
+    ''' Build the key for an input parameter in the data file.
+        @param param: Input parameter of a call
+        @return JSON encoding of parameter with sorted keys
+    '''
+
+    return json.dumps(param, sort_keys=True)
+
+class ProbModelSEEDHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def _answer(self, request):
+        ''' Answer one call.
+            @param request: Dictionary with method, params, version, and id
+            @return Dictionary with response for call
+        '''
+
+        response = { 'version': '1.1', 'id': request.get('id') }
+        module, sep, method = request.get('method', '').partition('.')
+        params = request.get('params', list())
+        results = self.server.data.get(method, None)
+        if module != 'ProbModelSEED' or results is None:
+            response['error'] = { 'name': 'JSONRPCError', 'code': -32601, 'message': 'Method %s is not supported' %(request.get('method')) }
+        elif len(params) != 1 or paramKey(params[0]) not in results:
+            response['error'] = { 'name': 'JSONRPCError', 'code': -32500, 'message': 'No result for %s with input %s' %(method, json.dumps(params)),
+                                  'error': '' }
+        else:
+            response['result'] = [ results[paramKey(params[0])] ]
+        return response
+
+    def do_POST(self):
+        self.server.numRequests += 1
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', '0'))))
+            if self.server.delay > 0:
+                time.sleep(self.server.delay)
+            if isinstance(request, list):
+                self.server.numCalls += len(request)
+                if self.server.noBatch:
+                    response = { 'version': '1.1', 'error': { 'name': 'JSONRPCError', 'code': -32600, 'message': 'Invalid request' } }
+                else:
+                    response = [ self._answer(call) for call in request ]
+            else:
+                self.server.numCalls += 1
+                response = self._answer(request)
+        except Exception as e:
+            response = { 'version': '1.1', 'error': { 'name': 'JSONRPCError', 'code': -32700, 'message': str(e), 'error': traceback.format_exc() } }
+        code = 500 if isinstance(response, dict) and 'error' in response else 200
+        body = json.dumps(response)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        if self.server.gzip and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buffer = StringIO()
+            compressed = gzip.GzipFile(fileobj=buffer, mode='wb')
+            compressed.write(body)
+            compressed.close()
+            body = buffer.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+            sys.stderr.write('%d requests with %d calls\n' %(self.server.numRequests, self.server.numCalls))
+        return
+
+class ProbModelSEEDServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='StandInProbModelSEEDServer.py', description=desc, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('datafile', help='path to JSON file with results of calls', action='store')
+    parser.add_argument('--port', help='port number for server', action='store', type=int, dest='port', default=7131)
+    parser.add_argument('--no-batch', help='reject requests with a list of calls', action='store_true', dest='noBatch', default=False)
+    parser.add_argument('--delay', help='seconds to wait before answering a request', action='store', type=float, dest='delay', default=0.0)
+    parser.add_argument('--gzip', help='compress responses with gzip encoding', action='store_true', dest='gzip', default=False)
+    parser.add_argument('--verbose', help='log every request', action='store_true', dest='verbose', default=False)
+    args = parser.parse_args()
+
+    server = ProbModelSEEDServer(('localhost', args.port), ProbModelSEEDHandler)
+    server.data = json.load(open(args.datafile, 'r'))
+    server.noBatch = args.noBatch
+    server.delay = args.delay
+    server.gzip = args.gzip
+    server.verbose = args.verbose
+    server.numRequests = 0
+    server.numCalls = 0
+    sys.stderr.write('Serving results for %d methods on port %d\n' %(len(server.data), args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    exit(0)
@@ -0,0 +1,145 @@
+#! /usr/bin/env python
+
+# Stand-in Shock server for testing the download of static database files.
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+desc = '''
+Serve the files in a directory with the subset of the Shock API used by
+ProbAnnotationParser.loadDatabaseFiles(): a node query by lookup name and a
+node download that supports an HTTP range.  A compiled index file (name
+ending in .index) gets the checksum of the file it was built from as its
+source_md5 attribute like "ms-probanno-data store" does.  Set shock-url in the deployment
+config file to http://localhost:<port> to load the static database files from
+this server.  Use --drop-after to close the connection after sending part of
+a file to test resuming a download.
+'''
+
+class ShockNodes:
+
+    def __init__(self, directory, prefix):
+        ''' Build a node for every file in the directory.
+            @param directory: Path to directory with files
+            @param prefix: Prefix for lookup name attribute of files
+        '''
+
+        self.nodes = dict()
+        self.paths = dict()
+        checksums = dict()
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if not os.path.isfile(path):
+                continue
+            checksum = hashlib.md5()
+            with open(path, 'rb') as handle:
+                for chunk in iter(lambda: handle.read(1048576), ''):
+                    checksum.update(chunk)
+            checksums[name] = checksum.hexdigest()
+            nodeId = hashlib.sha1(name+checksum.hexdigest()).hexdigest()
+            self.nodes[nodeId] = { 'id': nodeId, 'attributes': { 'lookupname': prefix+'/'+name },
+                                   'file': { 'name': name, 'size': os.path.getsize(path), 'checksum': { 'md5': checksum.hexdigest() } } }
+            self.paths[nodeId] = path
+        for node in self.nodes.values():
+            name = node['file']['name']
+            if name.endswith('.index') and name[:-len('.index')] in checksums:
+                node['attributes']['source_md5'] = checksums[name[:-len('.index')]]
+        return
+
+class ShockHandler(BaseHTTPRequestHandler):
+
+    def _sendJson(self, code, data, error=None):
+        body = json.dumps({ 'status': code, 'data': data, 'error': error })
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query, keep_blank_values=True)
+
+        # Query for nodes by lookup name.
+        if url.path.rstrip('/') == '/node':
+            matches = [ node for node in self.server.shockNodes.nodes.values()
+                        if 'lookupname' not in query or node['attributes']['lookupname'] == query['lookupname'][0] ]
+            self._sendJson(200, matches)
+            return
+
+        match = re.match(r'^/node/([^/]+)$', url.path)
+        if match is None or match.group(1) not in self.server.shockNodes.nodes:
+            self._sendJson(404, None, [ 'Node not found' ])
+            return
+        node = self.server.shockNodes.nodes[match.group(1)]
+        if 'download' not in query:
+            self._sendJson(200, node)
+            return
+
+        # Download the file or the requested range of the file.
+        size = node['file']['size']
+        start = 0
+        rangeHeader = self.headers.get('Range')
+        if rangeHeader is not None:
+            match = re.match(r'^bytes=(\d+)-$', rangeHeader.strip())
+            if match is None or int(match.group(1)) >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' %(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            start = int(match.group(1))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' %(start, size - 1, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size - start))
+        self.end_headers()
+        remaining = size - start
+        if self.server.dropAfter is not None:
+            remaining = min(remaining, self.server.dropAfter)
+        with open(self.server.shockNodes.paths[node['id']], 'rb') as handle:
+            handle.seek(start)
+            while remaining > 0:
+                chunk = handle.read(min(remaining, 65536))
+                if len(chunk) == 0:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+        return
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+        return
+
+class ShockServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='StandInShockServer.py', description=desc, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory', help='path to directory with static database files', action='store')
+    parser.add_argument('--port', help='port number for server', action='store', type=int, dest='port', default=7078)
+    parser.add_argument('--prefix', help='prefix for lookup name attribute', action='store', dest='prefix', default='ProbAnnoDataV2')
+    parser.add_argument('--drop-after', help='close connection after sending this many bytes of a file', action='store', type=int, dest='dropAfter', default=None)
+    parser.add_argument('--verbose', help='log every request', action='store_true', dest='verbose', default=False)
+    args = parser.parse_args()
+
+    server = ShockServer(('localhost', args.port), ShockHandler)
+    server.shockNodes = ShockNodes(args.directory, args.prefix)
+    server.dropAfter = args.dropAfter
+    server.verbose = args.verbose
+    sys.stderr.write('Serving %d files from %s on port %d\n' %(len(server.shockNodes.nodes), args.directory, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    exit(0)
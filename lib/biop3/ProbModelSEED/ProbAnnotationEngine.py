@@ -0,0 +1,423 @@
+
+# Array-backed calculations for the probabilistic annotation algorithm
+from array import array
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# True when numpy is available and the array-backed calculations can be used.
+NUMPY_AVAILABLE = numpy is not None
+
+def _asArray(values, dtype):
+    ''' Convert a sequence to a numpy array.
+        An array.array is converted without copying the values one at a time.
+        @param values: Sequence of values
+        @param dtype: Type of array
+        @return Array of values
+    '''
+
+    if isinstance(values, array):
+        values = numpy.frombuffer(values, dtype=numpy.dtype(values.typecode))
+    return numpy.asarray(values, dtype=dtype)
+
+def rolesetScores(queryOffsets, targetIndices, scores, targetRolestringIds):
+    ''' Calculate the scores needed for the marble-picking likelihoods with grouped reductions.
+        The hits for each query must be together and in the order returned by the search
+        program.  The sums of squared scores are accumulated in hit order so each sum is
+        exactly the same value as adding the squared scores one at a time.
+        @param queryOffsets: Sequence with offset of first hit of each query and total number of hits
+        @param targetIndices: Sequence with index of target for each hit
+        @param scores: Sequence with score for each hit
+        @param targetRolestringIds: Sequence with rolestring ID for each target index
+        @return Array with maximum score (or zero) for each query, array with offset of first
+            (query, rolestring) pair of each query and total number of pairs, array with
+            rolestring ID of each pair, and array with sum of squared scores for each pair
+            where the pairs of a query are sorted by rolestring ID
+    '''
+
+    queryOffsets = _asArray(queryOffsets, numpy.int64)
+    targetIndices = _asArray(targetIndices, numpy.int64)
+    scores = _asArray(scores, numpy.float64)
+    targetRolestringIds = _asArray(targetRolestringIds, numpy.int64)
+    numQueries = len(queryOffsets) - 1
+
+    # Maximum score (or zero) for each query. Like a comparison, fmax ignores a NaN score.
+    maxScores = numpy.fmax(_segmentReduce(numpy.fmax, scores, queryOffsets, 0.0), 0.0)
+
+    # Group the hits by (query, rolestring) pair.  A stable sort keeps the hits for a pair
+    # in order.
+    queryIndices = numpy.repeat(numpy.arange(numQueries, dtype=numpy.int64), numpy.diff(queryOffsets))
+    rolestringIds = targetRolestringIds[targetIndices]
+    numRolestrings = int(rolestringIds.max()) + 1 if len(rolestringIds) > 0 else 1
+    keys = queryIndices * numRolestrings + rolestringIds
+    order = numpy.argsort(keys, kind='mergesort')
+    keys = keys[order]
+    firstHits = numpy.empty(len(keys), dtype=bool)
+    firstHits[:1] = True
+    numpy.not_equal(keys[1:], keys[:-1], out=firstHits[1:])
+    pairIndices = numpy.cumsum(firstHits) - 1
+    pairKeys = keys[firstHits]
+
+    # Sum of squared scores for each pair. The exponent is an array so every score is squared
+    # with pow() like the ** operator (numpy replaces a scalar exponent of 2 with a multiply,
+    # which can differ in the last bit).  bincount adds the weights in input order.
+    exponents = numpy.empty_like(scores)
+    exponents.fill(2.0)
+    pairScores = numpy.bincount(pairIndices, weights=numpy.power(scores[order], exponents), minlength=len(pairKeys))
+
+    pairOffsets = numpy.searchsorted(pairKeys // numRolestrings, numpy.arange(numQueries + 1))
+    return maxScores, pairOffsets, pairKeys % numRolestrings, pairScores
+
+def rolesetLikelihoods(maxScores, pairOffsets, pairScores, pseudoCount):
+    ''' Calculate the marble-picking likelihoods of the (query, rolestring) pairs.
+        Each denominator is the pseudo count times the maximum score for the query plus the
+        sums of squared scores of its pairs added in pair order.
+        @param maxScores: Array with maximum score for each query (as returned by rolesetScores())
+        @param pairOffsets: Array with offset of first pair of each query and total number of pairs
+        @param pairScores: Array with sum of squared scores for each pair
+        @param pseudoCount: Pseudo count multiplied by the maximum score in each denominator
+        @return Array with denominator for each query and array with likelihood of each pair
+    '''
+
+    maxScores = _asArray(maxScores, numpy.float64)
+    pairOffsets = _asArray(pairOffsets, numpy.int64)
+    pairScores = _asArray(pairScores, numpy.float64)
+
+    # bincount adds the weights in input order starting from zero so each denominator starts
+    # with the pseudo count times the maximum score.
+    numQueries = len(maxScores)
+    pairQueries = numpy.repeat(numpy.arange(numQueries, dtype=numpy.int64), numpy.diff(pairOffsets))
+    bins = numpy.concatenate((numpy.arange(numQueries, dtype=numpy.int64), pairQueries))
+    weights = numpy.concatenate((pseudoCount * maxScores, pairScores))
+    denominators = numpy.bincount(bins, weights=weights, minlength=numQueries)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        likelihoods = pairScores / denominators[pairQueries]
+    return denominators, likelihoods
+
+def selectHits(queryOffsets, scores, topK, minRelativeScore, maxLikelihoodChange):
+    ''' Select the hits to keep when pruning low-scoring hits for all of the queries at once.
+        The hits are selected with the same rules and the same floating point operations as
+        ProbAnnotationHitStore.selectHits() so the same hits are kept.
+        @param queryOffsets: Sequence with offset of first hit of each query and total number of hits
+        @param scores: Sequence with score for each hit
+        @param topK: Maximum number of hits to keep for a query or 0 to keep all hits
+        @param minRelativeScore: Minimum fraction of the maximum score for a query to keep
+            a hit or 0 to keep all hits
+        @param maxLikelihoodChange: Largest change in a likelihood allowed from pruning
+        @return Boolean array with True for each hit to keep and array with offset of first
+            kept hit of each query and total number of kept hits
+    '''
+
+    queryOffsets = _asArray(queryOffsets, numpy.int64)
+    scores = _asArray(scores, numpy.float64)
+    numQueries = len(queryOffsets) - 1
+    lengths = numpy.diff(queryOffsets)
+    queryIndices = numpy.repeat(numpy.arange(numQueries, dtype=numpy.int64), lengths)
+
+    # Rank the hits for each query from best to worst score (a stable sort keeps hits with
+    # the same score in search results order).  The search programs usually write the hits
+    # from best to worst so the hits only need to be sorted when they are in a different order.
+    inOrder = (scores[1:] <= scores[:-1]) | (queryIndices[1:] != queryIndices[:-1])
+    if inOrder.all():
+        order = None
+        ranked = scores
+    else:
+        order = numpy.lexsort((-scores, queryIndices))
+        ranked = scores[order]
+    ranks = numpy.arange(len(scores), dtype=numpy.int64) - queryOffsets[:-1][queryIndices]
+
+    # A hit can be pruned when it is not one of the topK best hits or when its score is
+    # below the minimum relative score.  The best hit is always kept.
+    maxScores = _segmentReduce(numpy.fmax, ranked, queryOffsets, 0.0)
+    if minRelativeScore > 0.0:
+        cutoffs = numpy.where(maxScores > 0.0, minRelativeScore * maxScores, -numpy.inf)
+    else:
+        cutoffs = numpy.empty(numQueries)
+        cutoffs.fill(-numpy.inf)
+    prunable = ranked < cutoffs[queryIndices]
+    if topK > 0:
+        prunable |= ranks >= topK
+    prunable &= ranks >= 1
+
+    # A hit is pruned along with the hits below it when their number times the largest of
+    # their squared scores is within the allowed part of the sum of squared scores for the
+    # query.  Since the scores are in order, the largest squared score is from the hit or
+    # from the last hit (when the scores are negative).
+    squares = ranked * ranked
+    limits = maxLikelihoodChange * numpy.bincount(queryIndices, weights=squares, minlength=numQueries)
+    largest = numpy.maximum(squares, squares[queryOffsets[1:] - 1][queryIndices])
+    prunable &= ((lengths[queryIndices] - ranks) * largest) * (1.0 + maxLikelihoodChange) <= limits[queryIndices]
+
+    keep = ~prunable
+    if order is not None:
+        keep[order] = keep.copy()
+    keptOffsets = numpy.zeros(numQueries + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(queryIndices[keep], minlength=numQueries), out=keptOffsets[1:])
+    return keep, keptOffsets
+
+def compressArray(values, keep):
+    ''' Select the values to keep from an array.array.
+        @param values: array.array of values
+        @param keep: Boolean array with True for each value to keep
+        @return array.array with the same type code and the values that are kept
+    '''
+
+    result = array(values.typecode)
+    result.fromstring(_asArray(values, numpy.dtype(values.typecode))[keep].tostring())
+    return result
+
+def _segmentReduce(ufunc, values, offsets, empty):
+    ''' Reduce each row of a CSR matrix.
+        @param ufunc: Numpy ufunc used to reduce values in a row
+        @param values: Array with value for each entry
+        @param offsets: Array with offset of first entry in each row and total number of entries
+        @param empty: Value for a row with no entries
+        @return Array with reduced value for each row
+    '''
+
+    lengths = numpy.diff(offsets)
+    result = numpy.empty(len(lengths), dtype=values.dtype)
+    result.fill(empty)
+    nonempty = lengths > 0
+    if numpy.any(nonempty):
+        result[nonempty] = ufunc.reduceat(values, offsets[:-1][nonempty])
+    return result
+
+def uniqueValues(values):
+    ''' Find the distinct values in a sequence of small non-negative integers.
+        The values are counted instead of sorted like numpy.unique().
+        @param values: Sequence of integer values
+        @return Array with sorted distinct values and array with index of distinct value
+            for each value in the sequence
+    '''
+
+    values = _asArray(values, numpy.int64)
+    present = numpy.bincount(values) > 0
+    return numpy.flatnonzero(present), (numpy.cumsum(present) - 1)[values]
+
+def nanPositions(values):
+    ''' Find the positions of NaN values.
+        @param values: Array of values
+        @return List with position of each NaN value
+    '''
+
+    isnan = numpy.isnan(values)
+    if not isnan.any():
+        return list()
+    return numpy.flatnonzero(isnan).tolist()
+
+def take(items, indices):
+    ''' Select items from a list.
+        @param items: List of items
+        @param indices: Array with index of each item to select
+        @return List of selected items
+    '''
+
+    objects = numpy.empty(len(items), dtype=object)
+    objects[:] = items
+    return objects[indices].tolist()
+
+# Type of a complex calculated by complexScores().
+CPLX_FULL = 0
+CPLX_PARTIAL = 1
+CPLX_NOTTHERE = 2
+CPLX_NOREPS = 3
+CPLX_NOREPS_AND_NOTTHERE = 4
+
+''' Roleset likelihoods for each query from rolesetLikelihoods() with the tuples built when a query is used. '''
+
+class RolesetLikelihoodStore:
+
+    def __init__(self, queries, pairOffsets, keyRolestrings, pairKeys, likelihoods):
+        ''' Initialize the object.
+            The store is used like a dictionary keyed by query of list of tuples with roleset
+            and likelihood.  The list of tuples for a query is built each time the query is
+            used so the tuples for all of the queries are never held at the same time.
+            @param queries: List of query IDs
+            @param pairOffsets: Array with offset of first (query, rolestring) pair of each
+                query and total number of pairs
+            @param keyRolestrings: List of distinct rolestrings used by the pairs
+            @param pairKeys: Array with index in keyRolestrings of rolestring of each pair
+            @param likelihoods: Array with likelihood of each pair
+        '''
+
+        self.queries = queries
+        self.pairOffsets = pairOffsets
+        self.keyRolestrings = keyRolestrings
+        self.pairKeys = pairKeys
+        self.likelihoods = likelihoods
+        self._lists = None
+        return
+
+    def __len__(self):
+        return len(self.queries)
+
+    def __iter__(self):
+        return iter(self.queries)
+
+    def __contains__(self, query):
+        return query in self._getLists()[0]
+
+    def __getitem__(self, query):
+        queryToIndex, offsets, rolestrings, likelihoods = self._lists or self._getLists()
+        queryIndex = queryToIndex[query]
+        start = offsets[queryIndex]
+        end = offsets[queryIndex + 1]
+        return zip(rolestrings[start:end], likelihoods[start:end])
+
+    def get(self, query, default=None):
+        if query not in self:
+            return default
+        return self[query]
+
+    def _getLists(self):
+        ''' Convert the arrays to lists the first time a query is used.
+            Slicing a list is much faster than slicing an array for the few pairs of a query.
+            @return Tuple with dictionary keyed by query of index, list of pair offsets, list of
+                rolestring of each pair, and list of likelihood of each pair
+        '''
+
+        if self._lists is None:
+            self._lists = (dict(zip(self.queries, range(len(self.queries)))), self.pairOffsets.tolist(),
+                           take(self.keyRolestrings, self.pairKeys), self.likelihoods.tolist())
+        return self._lists
+
+    def iteritems(self):
+        ''' Get the likelihoods for each query.
+            @return Generator of tuples with query ID and list of tuples with roleset and likelihood
+        '''
+
+        for query in self.queries:
+            yield query, self[query]
+        return
+
+    def items(self):
+        ''' Get the likelihoods for all of the queries.
+            @return List of tuples with query ID and list of tuples with roleset and likelihood
+        '''
+
+        return list(self.iteritems())
+
+''' Complex and reaction mappings from a template compiled into CSR incidence matrices. '''
+
+class CompiledTemplate:
+
+    def __init__(self, complexesToRoles, reactionsToComplexes):
+        ''' Initialize the object.
+            Roles and complexes are interned and each complex is a row of role IDs and each
+            reaction is a row of complex IDs.  A row keeps the order (and any duplicates)
+            from the mappings.  Complexes that are not in the complex to role mapping are
+            dropped from a reaction since they do not contribute to the reaction likelihood.
+            @param complexesToRoles: Dictionary keyed by complex ID of list of roles
+            @param reactionsToComplexes: Dictionary keyed by reaction ID of list of complex IDs
+        '''
+
+        self.roles = list()
+        roleIds = dict()
+        self.complexes = sorted(complexesToRoles)
+        complexIds = dict()
+        self.complexRoleOffsets = array('l', [ 0 ])
+        self.complexRoleIds = array('l')
+        for cplx in self.complexes:
+            complexIds[cplx] = len(complexIds)
+            for role in complexesToRoles[cplx]:
+                if role not in roleIds:
+                    roleIds[role] = len(self.roles)
+                    self.roles.append(role)
+                self.complexRoleIds.append(roleIds[role])
+            self.complexRoleOffsets.append(len(self.complexRoleIds))
+
+        self.reactions = sorted(reactionsToComplexes)
+        self.reactionComplexOffsets = array('l', [ 0 ])
+        self.reactionComplexIds = array('l')
+        for rxn in self.reactions:
+            for cplx in reactionsToComplexes[rxn]:
+                if cplx in complexIds:
+                    self.reactionComplexIds.append(complexIds[cplx])
+            self.reactionComplexOffsets.append(len(self.reactionComplexIds))
+        return
+
+    def complexRoles(self, complexIndex):
+        ''' Get the role IDs in a complex.
+            @param complexIndex: Index of complex
+            @return List of role IDs
+        '''
+
+        return self.complexRoleIds[self.complexRoleOffsets[complexIndex]:self.complexRoleOffsets[complexIndex + 1]].tolist()
+
+    def reactionComplexes(self, reactionIndex):
+        ''' Get the complex IDs for a reaction.
+            @param reactionIndex: Index of reaction
+            @return List of complex IDs
+        '''
+
+        return self.reactionComplexIds[self.reactionComplexOffsets[reactionIndex]:self.reactionComplexOffsets[reactionIndex + 1]].tolist()
+
+    def complexesToRoles(self):
+        ''' Rebuild the complex to role mapping.
+            @return Dictionary keyed by complex ID of list of roles
+        '''
+
+        complexesToRoles = dict()
+        for index in range(len(self.complexes)):
+            complexesToRoles[self.complexes[index]] = [ self.roles[roleId] for roleId in self.complexRoles(index) ]
+        return complexesToRoles
+
+    def reactionsToComplexes(self):
+        ''' Rebuild the reaction to complex mapping (without complexes dropped from reactions).
+            @return Dictionary keyed by reaction ID of list of complex IDs
+        '''
+
+        reactionsToComplexes = dict()
+        for index in range(len(self.reactions)):
+            reactionsToComplexes[self.reactions[index]] = [ self.complexes[cplxId] for cplxId in self.reactionComplexes(index) ]
+        return reactionsToComplexes
+
+def complexScores(template, roleProbabilities, roleAvailable, roleRepresented):
+    ''' Calculate the likelihood and type of every complex in a template.
+        See equation 5 in the paper ("Calculating reaction likelihoods" section).
+        @param template: CompiledTemplate object
+        @param roleProbabilities: Sequence with likelihood of each template role in the organism
+        @param roleAvailable: Sequence with True for each template role found in the organism
+        @param roleRepresented: Sequence with True for each template role in the subsystems
+        @return Array with likelihood of each complex, array with type of each complex, and
+            array with number of available roles in each complex
+    '''
+
+    offsets = _asArray(template.complexRoleOffsets, numpy.int64)
+    roleIds = _asArray(template.complexRoleIds, numpy.int64)
+    represented = numpy.asarray(roleRepresented, dtype=bool)[roleIds]
+    available = numpy.asarray(roleAvailable, dtype=bool)[roleIds] & represented
+    probabilities = numpy.asarray(roleProbabilities, dtype=numpy.float64)[roleIds]
+
+    # Count the roles of each kind in every complex.
+    numRoles = numpy.diff(offsets)
+    numAvailable = _segmentReduce(numpy.add, available.astype(numpy.int64), offsets, 0)
+    numNoexist = _segmentReduce(numpy.add, (~represented).astype(numpy.int64), offsets, 0)
+    numUnavailable = numRoles - numAvailable - numNoexist
+
+    # The complex likelihood is the minimum likelihood of the available roles.
+    minProbabilities = _segmentReduce(numpy.minimum, numpy.where(available, probabilities, numpy.inf), offsets, numpy.inf)
+
+    # Set the type in reverse order of precedence so the first matching condition wins.
+    types = numpy.empty(len(numRoles), dtype=numpy.int64)
+    types.fill(CPLX_PARTIAL)
+    types[numAvailable == numRoles] = CPLX_FULL
+    types[numUnavailable + numNoexist == numRoles] = CPLX_NOREPS_AND_NOTTHERE
+    types[numUnavailable == numRoles] = CPLX_NOTTHERE
+    types[numNoexist == numRoles] = CPLX_NOREPS
+    likelihoods = numpy.where(numAvailable > 0, minProbabilities, 0.0)
+    return likelihoods, types, numAvailable
+
+def reactionScores(template, complexLikelihoods):
+    ''' Calculate the likelihood of every reaction in a template.
+        See equation 6 in the paper ("Calculating reaction likelihoods" section).
+        @param template: CompiledTemplate object
+        @param complexLikelihoods: Sequence with likelihood of each complex
+        @return Array with maximum likelihood of the complexes for each reaction (or zero)
+    '''
+
+    offsets = _asArray(template.reactionComplexOffsets, numpy.int64)
+    complexIds = _asArray(template.reactionComplexIds, numpy.int64)
+    return _segmentReduce(numpy.maximum, numpy.asarray(complexLikelihoods, dtype=numpy.float64)[complexIds], offsets, 0.0)
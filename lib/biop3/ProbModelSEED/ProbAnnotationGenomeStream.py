@@ -0,0 +1,292 @@
+
+# Streaming reader for the features of a genome object
+import re
+import json
+import tempfile
+
+# Fields kept from every feature in a genome object.
+FEATURE_FIELDS = [ 'id', 'protein_translation' ]
+
+# Number of bytes read from the genome object at a time.
+CHUNK_SIZE = 1024 * 1024
+
+# Patterns for finding the end of a value that is skipped.
+_STRUCTURE = re.compile(r'["\[\]{}]')
+_STRING_END = re.compile(r'["\\]')
+_SCALAR = re.compile(r'[-+.0-9a-zA-Z]+')
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+# Exception thrown when a genome object is not valid JSON
+class GenomeStreamError(Exception):
+    pass
+
+''' Reader that parses a genome object as it is read and only keeps the projected fields. '''
+
+class GenomeStreamReader:
+
+    def __init__(self, handle, chunkSize=CHUNK_SIZE, closeFunction=None):
+        ''' Initialize the object and read the genome ID.
+            The genome object is read in chunks and the value of every top-level field other
+            than the ID and the list of features is skipped without being decoded.  Each
+            feature is decoded on its own and only the fields in FEATURE_FIELDS are kept.
+            When the list of features comes before the genome ID in the object, the projected
+            features are saved to a temporary file while the reader looks for the ID.
+            @param handle: File handle with genome object in JSON format
+            @param chunkSize: Number of bytes to read at a time
+            @param closeFunction: Function called once when the reader is closed, for example
+                to release the connection the genome object is read from, or None (the reader
+                is closed when the features have been read or reading the object fails)
+            @raise GenomeStreamError when the genome object is not valid or has no ID
+        '''
+
+        self.handle = handle
+        self.chunkSize = chunkSize
+        self.closeFunction = closeFunction
+        self.genomeId = None
+        self.numFeatures = 0
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+        self._spool = None
+        self._started = False
+
+        # Read top-level fields until the genome ID is found.
+        try:
+            self._skipWhitespace()
+            if self._peek() != '{':
+                raise GenomeStreamError('Genome object is not a JSON object')
+            self._pos += 1
+            self._first = True
+            while self.genomeId is None:
+                key = self._nextKey()
+                if key is None:
+                    raise GenomeStreamError('Genome object does not have an id field')
+                if key == 'id':
+                    self.genomeId = self._decodeValue()
+                elif key == 'features':
+                    if self._spool is not None:
+                        raise GenomeStreamError('Genome object has more than one features field')
+                    self._spool = tempfile.TemporaryFile()
+                    for feature in self._iterArray():
+                        self._spool.write(json.dumps(feature)+'\n')
+                else:
+                    self._skipValue()
+        except:
+            self.close()
+            raise
+        return
+
+    def features(self):
+        ''' Get the projected features from the genome object.
+            The genome object is read as the features are used so the features can only be
+            read once.
+            @return Generator of dictionaries with the fields in FEATURE_FIELDS that are in
+                each feature
+            @raise GenomeStreamError when the genome object is not valid
+        '''
+
+        if self._started:
+            raise GenomeStreamError('Features from genome %s were already read' %(self.genomeId))
+        self._started = True
+
+        try:
+            # Return the features that were saved while looking for the genome ID.
+            if self._spool is not None:
+                self._spool.seek(0)
+                for line in self._spool:
+                    yield json.loads(line)
+                self._spool.close()
+                self._spool = None
+
+            # Read the rest of the top-level fields.
+            while True:
+                key = self._nextKey()
+                if key is None:
+                    break
+                if key == 'features':
+                    for feature in self._iterArray():
+                        yield feature
+                else:
+                    self._skipValue()
+        finally:
+            # The whole object was read, reading failed, or the features are no longer used.
+            self.close()
+        return
+
+    def close(self):
+        ''' Close the reader and call the close function the first time it is closed.
+            @return Nothing
+        '''
+
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+        if self.closeFunction is not None:
+            closeFunction = self.closeFunction
+            self.closeFunction = None
+            closeFunction()
+        return
+
+    def _iterArray(self):
+        ''' Decode the features in an array one at a time.
+            @return Generator of projected features
+        '''
+
+        self._skipWhitespace()
+        if self._peek() != '[':
+            raise GenomeStreamError('Features field in genome object is not a list')
+        self._pos += 1
+        first = True
+        while True:
+            self._skipWhitespace()
+            c = self._peek()
+            if c == ']':
+                self._pos += 1
+                return
+            if not first:
+                if c != ',':
+                    raise GenomeStreamError('Expected "," or "]" after feature %d in features list' %(self.numFeatures))
+                self._pos += 1
+            first = False
+            feature = self._decodeValue()
+            if not isinstance(feature, dict):
+                raise GenomeStreamError('Feature %d in genome object is not a JSON object' %(self.numFeatures))
+            self.numFeatures += 1
+            yield dict([ (field, feature[field]) for field in FEATURE_FIELDS if field in feature ])
+        return
+
+    def _nextKey(self):
+        ''' Get the key of the next top-level field.
+            @return Key string or None at the end of the object
+        '''
+
+        self._skipWhitespace()
+        c = self._peek()
+        if c == '}':
+            self._pos += 1
+            return None
+        if not self._first:
+            if c != ',':
+                raise GenomeStreamError('Expected "," or "}" between fields in genome object')
+            self._pos += 1
+            self._skipWhitespace()
+        self._first = False
+        key = self._decodeValue()
+        self._skipWhitespace()
+        if self._peek() != ':':
+            raise GenomeStreamError('Expected ":" after key "%s" in genome object' %(key))
+        self._pos += 1
+        return key
+
+    def _decodeValue(self):
+        ''' Decode the next value, reading more of the object until the value is complete.
+            @return Decoded value
+        '''
+
+        self._skipWhitespace()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+                # A number at the end of the buffer might continue in the next chunk.
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+            except ValueError as e:
+                if self._eof:
+                    raise GenomeStreamError('Genome object is not valid JSON: %s' %(e))
+            self._fill()
+
+    def _skipValue(self):
+        ''' Skip the next value without decoding it.
+            @return Nothing
+        '''
+
+        self._skipWhitespace()
+        c = self._peek()
+        if c == '"':
+            self._skipString()
+            return
+        if c not in '[{':
+            while True:
+                match = _SCALAR.match(self._buffer, self._pos)
+                if match is None:
+                    raise GenomeStreamError('Unexpected character "%s" in genome object' %(c))
+                if match.end() < len(self._buffer) or self._eof:
+                    self._pos = match.end()
+                    return
+                self._fill()
+        depth = 0
+        while True:
+            match = _STRUCTURE.search(self._buffer, self._pos)
+            if match is None:
+                self._pos = len(self._buffer)
+                self._fill()
+                continue
+            self._pos = match.start()
+            if match.group() == '"':
+                self._skipString()
+                continue
+            self._pos += 1
+            if match.group() in '[{':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def _skipString(self):
+        ''' Skip a string, which can be longer than the buffer.
+            @return Nothing
+        '''
+
+        self._pos += 1
+        while True:
+            match = _STRING_END.search(self._buffer, self._pos)
+            if match is None:
+                self._pos = len(self._buffer)
+                self._fill()
+                continue
+            if match.group() == '"':
+                self._pos = match.end()
+                return
+            # Skip the escaped character after a backslash.
+            self._pos = match.start()
+            if self._pos + 1 >= len(self._buffer):
+                self._fill()
+            self._pos += 2
+
+    def _skipWhitespace(self):
+        ''' Skip whitespace before the next token.
+            @return Nothing
+        '''
+
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return
+            self._fill()
+
+    def _peek(self):
+        ''' Get the next character.
+            @return Character
+        '''
+
+        while self._pos >= len(self._buffer):
+            self._fill()
+        return self._buffer[self._pos]
+
+    def _fill(self):
+        ''' Read the next chunk of the object, dropping the part of the buffer that was used.
+            @return Nothing
+            @raise GenomeStreamError at the end of the object
+        '''
+
+        if self._eof:
+            raise GenomeStreamError('Genome object ended before it was complete')
+        chunk = self.handle.read(self.chunkSize)
+        if len(chunk) == 0:
+            self._eof = True
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return
@@ -0,0 +1,100 @@
+
+# Persistent cache of protein search hits
+import time
+import zlib
+import sqlite3
+import hashlib
+
+# Version of the hit cache database schema.
+HIT_CACHE_VERSION = '1'
+
+def sequenceHash(sequence):
+    ''' Calculate the key for a protein sequence in the hit cache.
+        @param sequence: Amino acid sequence
+        @return Hash string
+    '''
+
+    return hashlib.sha1(sequence.strip().upper()).hexdigest()
+
+''' Cache of the search hits for protein sequences stored in a SQLite database. '''
+
+class ProbAnnotationHitCache:
+
+    def __init__(self, filename, databaseKey, maxBytes):
+        ''' Initialize the object.
+            All of the cached hits are removed when the database key does not match the
+            key saved in the cache so hits from an old reference database are never used.
+            @param filename: Path to hit cache database file
+            @param databaseKey: String that identifies the reference database and search parameters
+            @param maxBytes: Maximum size of the compressed hits in the cache
+        '''
+
+        self.filename = filename
+        self.databaseKey = HIT_CACHE_VERSION+':'+databaseKey
+        self.maxBytes = maxBytes
+        self.connection = sqlite3.connect(filename, timeout=600)
+        self.connection.text_factory = str
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS hits (sequence_hash TEXT PRIMARY KEY, hits BLOB, size INTEGER, last_used INTEGER)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS hits_last_used ON hits (last_used)')
+            row = self.connection.execute('SELECT value FROM meta WHERE name = ?', ('database_key',)).fetchone()
+            if row is None or row[0] != self.databaseKey:
+                self.connection.execute('DELETE FROM hits')
+                self.connection.execute('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)', ('database_key', self.databaseKey))
+        return
+
+    def get(self, sequenceHashes):
+        ''' Get the cached hits for a list of protein sequences.
+            @param sequenceHashes: List of sequence hash strings
+            @return Dictionary keyed by sequence hash of search results lines without the query ID
+                field (only sequences found in the cache are included)
+        '''
+
+        found = dict()
+        sequenceHashes = list(set(sequenceHashes))
+        with self.connection:
+            # SQLite limits the number of parameters in a statement.
+            for start in range(0, len(sequenceHashes), 500):
+                chunk = sequenceHashes[start:start+500]
+                markers = ','.join([ '?' ] * len(chunk))
+                for sequenceHash, hits in self.connection.execute('SELECT sequence_hash, hits FROM hits WHERE sequence_hash IN (%s)' %(markers), chunk):
+                    found[sequenceHash] = zlib.decompress(str(hits))
+                self.connection.execute('UPDATE hits SET last_used = ? WHERE sequence_hash IN (%s)' %(markers), [ int(time.time()) ] + chunk)
+        return found
+
+    def put(self, hitsBySequence):
+        ''' Add the hits for protein sequences to the cache and remove the least recently
+            used sequences when the cache is larger than the maximum size.
+            @param hitsBySequence: Dictionary keyed by sequence hash of search results lines
+                without the query ID field (an empty string when there were no hits)
+            @return Nothing
+        '''
+
+        now = int(time.time())
+        rows = list()
+        for sequenceHash in hitsBySequence:
+            hits = zlib.compress(hitsBySequence[sequenceHash])
+            rows.append( (sequenceHash, buffer(hits), len(hits), now) )
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO hits (sequence_hash, hits, size, last_used) VALUES (?, ?, ?, ?)', rows)
+            totalBytes = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM hits').fetchone()[0]
+            if totalBytes > self.maxBytes:
+                # Remove enough sequences to get below 90% of the maximum so the next put does
+                # not immediately need to remove more.
+                removeHashes = list()
+                for sequenceHash, size in self.connection.execute('SELECT sequence_hash, size FROM hits ORDER BY last_used').fetchall():
+                    if totalBytes <= self.maxBytes * 0.9:
+                        break
+                    removeHashes.append( (sequenceHash,) )
+                    totalBytes -= size
+                self.connection.executemany('DELETE FROM hits WHERE sequence_hash = ?', removeHashes)
+        return
+
+    def close(self):
+        ''' Close the hit cache database.
+            @return Nothing
+        '''
+
+        self.connection.close()
+        return
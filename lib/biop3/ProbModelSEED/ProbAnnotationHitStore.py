@@ -0,0 +1,326 @@
+
+# Compact store of the hits from protein search results
+import operator
+from array import array
+from biop3.ProbModelSEED import ProbAnnotationEngine
+
+# Default for the largest change in a likelihood allowed when pruning low-scoring hits.
+DEFAULT_MAX_LIKELIHOOD_CHANGE = 0.01
+
+def selectHits(scores, topK, minRelativeScore, maxLikelihoodChange=DEFAULT_MAX_LIKELIHOOD_CHANGE):
+    ''' Select the hits for a query to keep when pruning low-scoring hits.
+        A hit can be pruned when it is not one of the topK best hits or when its score is
+        below minRelativeScore times the maximum score.  The hits that can be pruned are
+        pruned starting from the lowest score while the number of pruned hits times the
+        largest of their squared scores is at most maxLikelihoodChange times the sum of the
+        squared scores of the kept hits.  The best hit is always kept so the maximum score
+        for the query does not change.
+
+        A likelihood is the sum of squared scores for a rolestring divided by a denominator
+        that is at least the sum of all of the kept squared scores, so no likelihood changes
+        by more than maxLikelihoodChange.
+        @param scores: List of scores of hits for a query in search results order
+        @param topK: Maximum number of hits to keep or 0 to keep any number of hits
+        @param minRelativeScore: Minimum fraction of the maximum score or 0 to keep hits with
+            any score
+        @param maxLikelihoodChange: Largest change in a likelihood allowed from pruning
+        @return List of positions of hits to keep in search results order or None when all
+            of the hits are kept
+    '''
+
+    # Nothing can be pruned when there are no more than topK hits and no hit is below the
+    # minimum relative score.
+    maxScore = max(scores)
+    cutoff = minRelativeScore * maxScore if minRelativeScore > 0.0 and maxScore > 0.0 else float('-inf')
+    if (topK <= 0 or len(scores) <= topK) and min(scores) >= cutoff:
+        return None
+
+    # Prune from the lowest score up (of hits with the same score, later hits are pruned first).
+    # The search programs usually write the hits for a query from best to worst so the
+    # hits only need to be sorted when they are in a different order.
+    ranked = sorted(scores, reverse=True)
+    if ranked == scores:
+        order = None
+    else:
+        order = sorted(range(len(scores)), key=scores.__getitem__, reverse=True)
+
+    # Since the scores are in order, the largest squared score of the pruned hits is from the
+    # last pruned hit or from the last hit (when the scores are negative).  The calculations
+    # are the same as ProbAnnotationEngine.selectHits() so the same hits are kept.
+    limit = maxLikelihoodChange * sum(map(operator.mul, ranked, ranked))
+    lastSquare = ranked[-1] * ranked[-1]
+    numKept = len(ranked)
+    while numKept > 1:
+        score = ranked[numKept - 1]
+        if not (0 < topK < numKept or score < cutoff):
+            break
+        if ((len(ranked) - numKept + 1) * max(score * score, lastSquare)) * (1.0 + maxLikelihoodChange) > limit:
+            break
+        numKept -= 1
+    if numKept == len(ranked):
+        return None
+    if order is None:
+        return range(numKept)
+    return sorted(order[:numKept])
+
+''' Hits from search results grouped by query with interned targets and array-backed scores. '''
+
+class ProbAnnotationHitStore:
+
+    def __init__(self, fidRoleIndex=None, topK=0, minRelativeScore=0.0, maxLikelihoodChange=DEFAULT_MAX_LIKELIHOOD_CHANGE):
+        ''' Initialize the object.
+            Each distinct target is stored once in a target table.  When a compiled index is
+            given, the table has the index of each target in the compiled index instead of
+            the target ID.  A hit is a target table index and a score in parallel arrays
+            and the hits for a query are a contiguous range given by the query offsets.
+            @param fidRoleIndex: ProbAnnotationIndex object for interning targets or None to
+                keep the target IDs
+            @param topK: Maximum number of hits to keep for a query or 0 to keep all hits
+            @param minRelativeScore: Minimum fraction of the maximum score for a query to keep
+                a hit or 0 to keep all hits
+            @param maxLikelihoodChange: Largest change in a likelihood allowed from pruning
+                (see selectHits())
+        '''
+
+        self.fidRoleIndex = fidRoleIndex
+        self.topK = topK
+        self.minRelativeScore = minRelativeScore
+        self.maxLikelihoodChange = maxLikelihoodChange
+        self._pruning = topK > 0 or minRelativeScore > 0.0
+        self.queries = list()
+        self.queryOffsets = array('l')
+        self.targetIndices = array('i')
+        self.scores = array('d')
+
+        # Target table with index of target in compiled index (or -1 when the target is not
+        # in the compiled index) or with target ID when there is no compiled index.
+        if fidRoleIndex is not None:
+            self.targetTable = array('l')
+        else:
+            self.targetTable = list()
+        self.unknownTargets = dict()
+
+        # Number of hits that were thrown out and number of hits that were pruned.
+        self.numDiscarded = 0
+        self.numPruned = 0
+
+        # Lookup tables used while adding hits and for finding a query.
+        self._targetToIndex = dict()
+        self._queryToIndex = dict()
+        self._hitQueries = None
+        self._finished = False
+        return
+
+    def addHits(self, query, targets, scores):
+        ''' Add the hits for a query.
+            The hits for a query are usually together in search results.  When they are not,
+            the hits are grouped by query in the order the queries were first seen (keeping
+            the order of the hits for each query) when the store is finished.  When pruning
+            without numpy, the hits are pruned before they are stored (see selectHits()).
+            When the hits for a query are added in more than one call, the hits from each
+            call are pruned separately so fewer hits can be pruned but the bound on the
+            change in a likelihood still holds.
+            @param query: Query ID
+            @param targets: List of target IDs in search results order
+            @param scores: List of scores of hits in search results order
+            @return Nothing
+        '''
+
+        if self._pruning and not ProbAnnotationEngine.NUMPY_AVAILABLE:
+            keep = selectHits(scores, self.topK, self.minRelativeScore, self.maxLikelihoodChange)
+            if keep is not None:
+                self.numPruned += len(scores) - len(keep)
+                if keep[-1] == len(keep) - 1:
+                    targets = targets[:len(keep)]
+                    scores = scores[:len(keep)]
+                else:
+                    targets = [ targets[position] for position in keep ]
+                    scores = [ scores[position] for position in keep ]
+
+        queryIndex = self._queryToIndex.get(query)
+        if queryIndex is not None:
+            # Start saving the query of every hit so the hits can be grouped later.
+            if self._hitQueries is None:
+                self._hitQueries = array('i')
+                for index in range(len(self.queries)):
+                    self._hitQueries.extend([ index ] * (self._queryEnd(index) - self.queryOffsets[index]))
+        else:
+            queryIndex = len(self.queries)
+            self._queryToIndex[query] = queryIndex
+            self.queries.append(query)
+            self.queryOffsets.append(len(self.scores))
+        if self._hitQueries is not None:
+            self._hitQueries.extend([ queryIndex ] * len(scores))
+
+        # Look up all of the targets at once and only add the new targets one at a time.
+        targetIndices = map(self._targetToIndex.get, targets)
+        if None in targetIndices:
+            for position in range(len(targets)):
+                if targetIndices[position] is None:
+                    targetIndices[position] = self._addTarget(targets[position])
+        self.targetIndices.extend(targetIndices)
+        self.scores.extend(scores)
+        return
+
+    def _addTarget(self, target):
+        ''' Add a target to the target table.
+            @param target: Target ID
+            @return Index of target in target table
+        '''
+
+        targetIndex = self._targetToIndex.get(target)
+        if targetIndex is None:
+            targetIndex = len(self.targetTable)
+            self._targetToIndex[target] = targetIndex
+            if self.fidRoleIndex is not None:
+                fidIndex = self.fidRoleIndex.fidIndex(target)
+                if fidIndex is None:
+                    self.unknownTargets[targetIndex] = target
+                    fidIndex = -1
+                self.targetTable.append(fidIndex)
+            else:
+                self.targetTable.append(target)
+        return targetIndex
+
+    def _queryEnd(self, queryIndex):
+        ''' Get the offset after the last hit of a query while hits are being added.
+            @param queryIndex: Index of query
+            @return Offset of end of hits for query
+        '''
+
+        if queryIndex + 1 < len(self.queryOffsets):
+            return self.queryOffsets[queryIndex + 1]
+        return len(self.scores)
+
+    def finish(self):
+        ''' Finish adding hits.
+            The hits are grouped by query when needed, the hits for all of the queries are
+            pruned at once when pruning with numpy, and the lookup tables used while adding
+            hits are released.
+            @return Nothing
+        '''
+
+        if self._hitQueries is not None:
+            order = sorted(range(len(self._hitQueries)), key=self._hitQueries.__getitem__)
+            self.targetIndices = array('i', [ self.targetIndices[hit] for hit in order ])
+            self.scores = array('d', [ self.scores[hit] for hit in order ])
+            counts = [ 0 ] * len(self.queries)
+            for queryIndex in self._hitQueries:
+                counts[queryIndex] += 1
+            self.queryOffsets = array('l')
+            offset = 0
+            for count in counts:
+                self.queryOffsets.append(offset)
+                offset += count
+        self.queryOffsets.append(len(self.scores))
+        if self._pruning and ProbAnnotationEngine.NUMPY_AVAILABLE:
+            keep, keptOffsets = ProbAnnotationEngine.selectHits(self.queryOffsets, self.scores, self.topK,
+                                                                self.minRelativeScore, self.maxLikelihoodChange)
+            if keptOffsets[-1] < len(self.scores):
+                self.numPruned += len(self.scores) - int(keptOffsets[-1])
+                self.targetIndices = ProbAnnotationEngine.compressArray(self.targetIndices, keep)
+                self.scores = ProbAnnotationEngine.compressArray(self.scores, keep)
+                self.queryOffsets = array('l', keptOffsets.tolist())
+        self._targetToIndex = None
+        self._queryToIndex = None
+        self._hitQueries = None
+        self._finished = True
+        return
+
+    def __len__(self):
+        return len(self.queries)
+
+    def __iter__(self):
+        return iter(self.queries)
+
+    def __contains__(self, query):
+        return self._queryIndex(query) is not None
+
+    def __getitem__(self, query):
+        queryIndex = self._queryIndex(query)
+        if queryIndex is None:
+            raise KeyError(query)
+        return self.queryHits(queryIndex)
+
+    def _queryIndex(self, query):
+        ''' Look up the index of a query.
+            @param query: Query ID
+            @return Index of query or None when query has no hits
+        '''
+
+        if self._queryToIndex is None:
+            self._queryToIndex = dict([ (self.queries[index], index) for index in range(len(self.queries)) ])
+        return self._queryToIndex.get(query)
+
+    def numHits(self):
+        ''' Get the number of hits in the store.
+            @return Number of hits
+        '''
+
+        return len(self.scores)
+
+    def targetId(self, targetIndex):
+        ''' Get the ID of a target.
+            @param targetIndex: Index of target in target table
+            @return Target ID
+        '''
+
+        if self.fidRoleIndex is None:
+            return self.targetTable[targetIndex]
+        if targetIndex in self.unknownTargets:
+            return self.unknownTargets[targetIndex]
+        return self.fidRoleIndex.fid(self.targetTable[targetIndex])
+
+    def targetRolestringIds(self, fidRoleIndex):
+        ''' Look up the rolestring ID of every target in the target table.
+            @param fidRoleIndex: ProbAnnotationIndex object for looking up rolestrings
+            @return Array with rolestring ID of each target (or -1 when the target is not in
+                the compiled index)
+        '''
+
+        if fidRoleIndex is self.fidRoleIndex:
+            # The targets are already interned as indexes in the compiled index.
+            fidRolestringIds = fidRoleIndex.fidRolestringIds()
+            return array('l', [ fidRolestringIds[fidIndex] if fidIndex >= 0 else -1 for fidIndex in self.targetTable ])
+        rolestringIds = array('l')
+        for targetIndex in range(len(self.targetTable)):
+            if fidRoleIndex is self.fidRoleIndex:
+                fidIndex = self.targetTable[targetIndex]
+            else:
+                fidIndex = fidRoleIndex.fidIndex(self.targetId(targetIndex))
+            if fidIndex is None or fidIndex < 0:
+                rolestringIds.append(-1)
+            else:
+                rolestringIds.append(fidRoleIndex.fidRolestringId(fidIndex))
+        return rolestringIds
+
+    def queryHits(self, queryIndex):
+        ''' Get the hits for a query.
+            @param queryIndex: Index of query
+            @return List of tuples with target ID and score in search results order
+        '''
+
+        hits = list()
+        for hit in range(self.queryOffsets[queryIndex], self.queryOffsets[queryIndex + 1]):
+            hits.append( (self.targetId(self.targetIndices[hit]), self.scores[hit]) )
+        return hits
+
+    def iteritems(self):
+        ''' Get the hits for each query in the order the queries were first seen.
+            @return Generator of tuples with query ID and list of tuples of target ID and score
+        '''
+
+        for queryIndex in range(len(self.queries)):
+            yield self.queries[queryIndex], self.queryHits(queryIndex)
+        return
+
+    def arrays(self):
+        ''' Get the hits as parallel arrays.
+            @return Array of query index for each hit, array of target table index for each
+                hit, and array of score for each hit
+        '''
+
+        queryIndices = array('i')
+        for queryIndex in range(len(self.queries)):
+            queryIndices.extend([ queryIndex ] * (self.queryOffsets[queryIndex + 1] - self.queryOffsets[queryIndex]))
+        return queryIndices, self.targetIndices, self.scores
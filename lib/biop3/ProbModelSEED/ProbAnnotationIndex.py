@@ -0,0 +1,277 @@
+
+# Compiled index of the feature ID to role file
+import os
+import sys
+import mmap
+import zlib
+import struct
+from array import array
+
+# Identifies a compiled index file and the version of the file format.
+INDEX_MAGIC = 'PAIDX001'
+
+# The header has the magic string, four counts, and the byte offsets of the eight sections.
+HEADER_FORMAT = '<8s4I8I'
+
+# Exception thrown when a compiled index file is not valid
+class BadIndexError(Exception):
+    pass
+
+# A compiled index file holds the data from a feature ID to role file in a form that can
+# be memory-mapped and used without parsing.  All integers are unsigned 32-bit little-endian
+# values.  After the header, the file has these sections:
+#   1. Role offsets: numRoles+1 offsets into the role names section
+#   2. Role names: names of all roles in sorted order (a role ID is the index of the role)
+#   3. Rolestring offsets: numRolestrings+1 offsets into the rolestring roles section
+#   4. Rolestring roles: sorted list of role IDs for each rolestring
+#   5. Feature offsets: numFids+1 offsets into the feature IDs section
+#   6. Feature IDs: all feature IDs
+#   7. Feature rolestrings: rolestring ID for each feature
+#   8. Slots: open addressing hash table of feature index plus one (zero is an empty slot)
+
+def _toBytes(values):
+    ''' Convert a list of integers to little-endian unsigned 32-bit values.
+        @param values: List of integers
+        @return String with packed values
+        @raise BadIndexError when a value does not fit in 32 bits
+    '''
+
+    packed = array('I')
+    if packed.itemsize != 4:
+        packed = array('L')
+    try:
+        packed.fromlist(values)
+    except OverflowError:
+        raise BadIndexError('Value is too large for compiled index file')
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tostring()
+
+def _hashFid(fid):
+    ''' Calculate the hash value for a feature ID.
+        @param fid: Feature ID
+        @return Hash value
+    '''
+
+    return zlib.crc32(fid) & 0xffffffff
+
+def writeIndexFile(filename, fidsToRoles):
+    ''' Write a compiled index file.
+        The file is written to a temporary file and renamed so a reader never sees a
+        partial file.
+        @param filename: Path to compiled index file
+        @param fidsToRoles: Dictionary mapping a feature ID to list of names of roles
+        @return Nothing
+    '''
+
+    # Intern the roles. Role IDs are assigned in sorted order so a sorted list of role
+    # names and a sorted list of role IDs are in the same order.
+    roleNames = set()
+    for fid in fidsToRoles:
+        roleNames.update(fidsToRoles[fid])
+    roleNames = sorted(roleNames)
+    roleIds = dict()
+    for index in range(len(roleNames)):
+        roleIds[roleNames[index]] = index
+
+    # Intern the rolestrings and the features. Duplicate roles are kept in a rolestring to
+    # match the rolestrings built from the text file.
+    fids = sorted(fidsToRoles)
+    rolestrings = list()
+    rolestringIds = dict()
+    fidRolestrings = list()
+    for fid in fids:
+        key = tuple([ roleIds[role] for role in sorted(fidsToRoles[fid]) ])
+        if key not in rolestringIds:
+            rolestringIds[key] = len(rolestrings)
+            rolestrings.append(key)
+        fidRolestrings.append(rolestringIds[key])
+
+    # Build the open addressing hash table with at least twice as many slots as features.
+    numSlots = 1
+    while numSlots < 2 * len(fids):
+        numSlots *= 2
+    mask = numSlots - 1
+    slots = [ 0 ] * numSlots
+    for index in range(len(fids)):
+        slot = _hashFid(fids[index]) & mask
+        while slots[slot] != 0:
+            slot = (slot + 1) & mask
+        slots[slot] = index + 1
+
+    # Build the sections.
+    roleOffsets = [ 0 ]
+    for name in roleNames:
+        roleOffsets.append(roleOffsets[-1] + len(name))
+    rolestringOffsets = [ 0 ]
+    rolestringRoles = list()
+    for key in rolestrings:
+        rolestringRoles.extend(key)
+        rolestringOffsets.append(len(rolestringRoles))
+    fidOffsets = [ 0 ]
+    for fid in fids:
+        fidOffsets.append(fidOffsets[-1] + len(fid))
+    sections = [ _toBytes(roleOffsets), ''.join(roleNames), _toBytes(rolestringOffsets), _toBytes(rolestringRoles),
+                 _toBytes(fidOffsets), ''.join(fids), _toBytes(fidRolestrings), _toBytes(slots) ]
+
+    # Write the header and sections to the file.
+    offsets = list()
+    position = struct.calcsize(HEADER_FORMAT)
+    for section in sections:
+        offsets.append(position)
+        position += len(section)
+    if position > 0xffffffff:
+        raise BadIndexError('Compiled index file would be larger than 4 GB')
+    tempFilename = filename+'.tmp'
+    with open(tempFilename, 'wb') as handle:
+        handle.write(struct.pack(HEADER_FORMAT, INDEX_MAGIC, len(roleNames), len(rolestrings), len(fids), numSlots, *offsets))
+        for section in sections:
+            handle.write(section)
+    os.rename(tempFilename, filename)
+    return
+
+''' Memory-mapped compiled index of the feature ID to role file. '''
+
+class ProbAnnotationIndex:
+
+    def __init__(self, filename, separator):
+        ''' Initialize the object.
+            @param filename: Path to compiled index file
+            @param separator: String used to separate roles in a rolestring
+            @raise BadIndexError when the file is not a compiled index file
+        '''
+
+        self.filename = filename
+        self.separator = separator
+        if os.path.getsize(filename) < struct.calcsize(HEADER_FORMAT):
+            raise BadIndexError('File "%s" is too small to be a compiled index file' %(filename))
+        with open(filename, 'rb') as handle:
+            self.buffer = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        header = struct.unpack_from(HEADER_FORMAT, self.buffer, 0)
+        if header[0] != INDEX_MAGIC:
+            raise BadIndexError('File "%s" is not a compiled index file' %(filename))
+        self.numRoles, self.numRolestrings, self.numFids, self.numSlots = header[1:5]
+        self._roleOffsets, self._roleNames, self._rolestringOffsets, self._rolestringRoles, \
+            self._fidOffsets, self._fids, self._fidRolestrings, self._slots = header[5:]
+        self._mask = self.numSlots - 1
+        self._allRoles = None
+        self._fidRolestringIds = None
+        return
+
+    def _value(self, sectionOffset, index):
+        ''' Get an integer value from a section.
+            @param sectionOffset: Byte offset of section in file
+            @param index: Index of value in section
+            @return Integer value
+        '''
+
+        return struct.unpack_from('<I', self.buffer, sectionOffset + 4 * index)[0]
+
+    def _values(self, sectionOffset, start, end):
+        ''' Get a range of integer values from a section.
+            @param sectionOffset: Byte offset of section in file
+            @param start: Index of first value
+            @param end: Index after last value
+            @return Tuple of integer values
+        '''
+
+        return struct.unpack_from('<%dI' %(end - start), self.buffer, sectionOffset + 4 * start)
+
+    def fid(self, fidIndex):
+        ''' Get a feature ID.
+            @param fidIndex: Index of feature
+            @return Feature ID
+        '''
+
+        start, end = self._values(self._fidOffsets, fidIndex, fidIndex + 2)
+        return self.buffer[self._fids + start:self._fids + end]
+
+    def fidIndex(self, fid):
+        ''' Look up the index of a feature.
+            @param fid: Feature ID
+            @return Index of feature or None when feature is not in index
+        '''
+
+        if self.numFids == 0:
+            return None
+        slot = _hashFid(fid) & self._mask
+        while True:
+            value = self._value(self._slots, slot)
+            if value == 0:
+                return None
+            if self.fid(value - 1) == fid:
+                return value - 1
+            slot = (slot + 1) & self._mask
+
+    def fidRolestringId(self, fidIndex):
+        ''' Get the rolestring ID of a feature.
+            @param fidIndex: Index of feature
+            @return Rolestring ID
+        '''
+
+        return self._value(self._fidRolestrings, fidIndex)
+
+    def fidRolestringIds(self):
+        ''' Get the rolestring ID of every feature.
+            @return Tuple with rolestring ID of each feature index
+        '''
+
+        if self._fidRolestringIds is None:
+            self._fidRolestringIds = self._values(self._fidRolestrings, 0, self.numFids)
+        return self._fidRolestringIds
+
+    def rolestringId(self, fid):
+        ''' Look up the rolestring ID of a feature.
+            @param fid: Feature ID
+            @return Rolestring ID or None when feature is not in index
+        '''
+
+        fidIndex = self.fidIndex(fid)
+        if fidIndex is None:
+            return None
+        return self._value(self._fidRolestrings, fidIndex)
+
+    def rolestringRoles(self, rolestringId):
+        ''' Get the role IDs in a rolestring.
+            @param rolestringId: Rolestring ID
+            @return Tuple of role IDs in sorted order
+        '''
+
+        start, end = self._values(self._rolestringOffsets, rolestringId, rolestringId + 2)
+        return self._values(self._rolestringRoles, start, end)
+
+    def rolestring(self, rolestringId):
+        ''' Get a rolestring.
+            @param rolestringId: Rolestring ID
+            @return Sorted role names joined with the separator
+        '''
+
+        return self.separator.join([ self.role(roleId) for roleId in self.rolestringRoles(rolestringId) ])
+
+    def role(self, roleId):
+        ''' Get the name of a role.
+            @param roleId: Role ID
+            @return Name of role
+        '''
+
+        start, end = self._values(self._roleOffsets, roleId, roleId + 2)
+        return self.buffer[self._roleNames + start:self._roleNames + end]
+
+    def allRoles(self):
+        ''' Get the set of all roles in the index.
+            @return Set of names of roles
+        '''
+
+        if self._allRoles is None:
+            offsets = self._values(self._roleOffsets, 0, self.numRoles + 1)
+            names = self.buffer[self._roleNames:self._roleNames + offsets[-1]]
+            self._allRoles = frozenset([ names[offsets[index]:offsets[index + 1]] for index in range(self.numRoles) ])
+        return self._allRoles
+
+    def close(self):
+        ''' Unmap the compiled index file.
+            @return Nothing
+        '''
+
+        self.buffer.close()
+        return
@@ -1,14 +1,26 @@
 
 # Read and write data files
 import os
+import re
 import sys
 import math
 import subprocess
 import json
 import traceback
 import time
+import hashlib
+import cPickle
+import glob
+import fcntl
+import threading
+import requests
+from multiprocessing.pool import ThreadPool
 from shock import Client as ShockClient
 from biokbase import log
+from biop3.ProbModelSEED.ProbAnnotationIndex import ProbAnnotationIndex, writeIndexFile
+from biop3.ProbModelSEED.ProbAnnotationRxnprobs import CompactRxnprobs, writeRxnprobsFile
+from biop3.ProbModelSEED.ProbAnnotationHitStore import ProbAnnotationHitStore, selectHits, DEFAULT_MAX_LIKELIHOOD_CHANGE
+from biop3.ProbModelSEED.ProbAnnotationThrottle import backoffDelay
 
 # E values of less than 1E-200 are treated as 1E-200 to avoid log of 0 issues.
 MIN_EVALUE = 1E-200
@@ -16,6 +28,9 @@ MIN_EVALUE = 1E-200
 # Prefix for lookup name attribute of files stored in Shock.
 LOOKUP_NAME_PREFIX = 'ProbAnnoDataV2'
 
+# Version of the compiled template cache files (change when CompiledTemplate changes).
+TEMPLATE_CACHE_VERSION = '1'
+
 # Exception thrown when there is an invalid sources configuration variable
 class BadSourceError(Exception):
     pass
@@ -32,6 +47,14 @@ class MissingFileError(Exception):
 class NotReadyError(Exception):
     pass
 
+# Exception thrown when a downloaded file does not match the checksum from Shock
+class BadChecksumError(Exception):
+    pass
+
+# Exception thrown when a file could not be downloaded from Shock
+class DownloadError(Exception):
+    pass
+
 ''' Read and write data files. '''
 
 class ProbAnnotationParser:
@@ -49,6 +72,8 @@ class ProbAnnotationParser:
         self.searchProgramPath = config['search_program_path']
         self.shockURL = config['shock-url']
         self.loadDataOption = config['load_data_option']
+        self.downloadThreads = int(config.get('shock_download_threads', '4'))
+        self.downloadRetries = int(config.get('shock_download_retries', '3'))
 
         # Create a dictionary with the valid sources and initialize to not set.
         self.sources = { 'cdm': dict(), 'kegg': dict() }
@@ -87,6 +112,8 @@ class ProbAnnotationParser:
         self.StatusFiles = dict()
         self.StatusFiles['status_file'] = os.path.join(self.dataFolderPath, 'staticdata.status')
         self.StatusFiles['cache_file'] = os.path.join(self.dataFolderPath, 'staticdata.cache')
+        self.StatusFiles['ready_file'] = os.path.join(self.dataFolderPath, 'staticdata.ready')
+        self.StatusFiles['lock_file'] = os.path.join(self.dataFolderPath, 'staticdata.lock')
 
         # Paths to files with source data.
         self.DataFiles = dict()
@@ -104,6 +131,18 @@ class ProbAnnotationParser:
             self.SearchFiles['protein_otu_sequence_file'] = os.path.join(self.dataFolderPath, 'PROTEIN_FASTA.psq')
             self.SearchFiles['protein_otu_header_file'] = os.path.join(self.dataFolderPath, 'PROTEIN_FASTA.phr')
 
+        # Paths to files compiled from the source data.
+        self.IndexFiles = dict()
+        self.IndexFiles['otu_fid_role_index_file'] = os.path.join(self.dataFolderPath, 'OTU_FID_ROLE.index')
+
+        # Folder and maximum number of files for the cache of compiled templates.
+        self.templateCacheFolder = config.get('template_cache_dir', os.path.join(self.dataFolderPath, 'templatecache'))
+        self.templateCacheSize = int(config.get('template_cache_size', '16'))
+
+        # Folder and maximum number of genomes for the saved per-gene results.
+        self.geneResultsFolder = config.get('gene_results_dir', os.path.join(self.dataFolderPath, 'generesults'))
+        self.geneResultsSize = int(config.get('gene_results_size', '256'))
+
         # Create the data folder if it does not exist.
         if not os.path.exists(config['data_dir']):
             os.makedirs(config['data_dir'], 0775)
@@ -229,6 +268,193 @@ class ProbAnnotationParser:
                     handle.write('%s\t%s\n' %(fid, self.separator.join(roles)))
         return
 
+    # A compiled feature ID to role index file has the data from a feature ID to role file
+    # with interned roles and rolestrings in a binary form that is memory-mapped when read.
+    # See ProbAnnotationIndex for the details of the format.
+
+    def readFidRoleIndexFile(self, filename):
+        ''' Read data from a compiled feature ID to role index file.
+
+            @param filename: Path to compiled feature ID to role index file
+            @return ProbAnnotationIndex object for the memory-mapped file
+        '''
+
+        return ProbAnnotationIndex(filename, self.separator)
+
+    def writeFidRoleIndexFile(self, filename, fidsToRoles):
+        ''' Write data to a compiled feature ID to role index file.
+
+            @param filename: Path to compiled feature ID to role index file
+            @param fidsToRoles: Dictionary mapping a feature ID to list of names of roles
+            @return Nothing
+        '''
+
+        writeIndexFile(filename, fidsToRoles)
+        return
+
+    def buildFidRoleIndex(self, filename=None):
+        ''' Build the compiled index from the feature ID to role file.
+            @param filename: Path to compiled index file or None to use the path in the data folder
+            @return Path to compiled index file
+        '''
+
+        if filename is None:
+            filename = self.IndexFiles['otu_fid_role_index_file']
+        fidsToRoles, rolesToFids = self.readFidRoleFile(self.DataFiles['otu_fid_role_file'])
+        self.writeFidRoleIndexFile(filename, fidsToRoles)
+        return filename
+
+    def isFidRoleIndexCurrent(self):
+        ''' Check if the compiled index is newer than the feature ID to role file.
+            @return True when the compiled index can be used
+        '''
+
+        indexFile = self.IndexFiles['otu_fid_role_index_file']
+        if not os.path.exists(indexFile):
+            return False
+        return os.path.getmtime(indexFile) >= os.path.getmtime(self.DataFiles['otu_fid_role_file'])
+
+    # A compiled template cache file has a pickled CompiledTemplate object with the complex
+    # and reaction mappings from a template object.  The name of the file is a hash of the
+    # workspace reference and the creation time and ID of the template object so a cached
+    # file is not used after the template object is replaced.  The least recently used
+    # files are removed when there are more than template_cache_size files.
+
+    def templateCacheKey(self, reference, creationTime, objectId):
+        ''' Build the key for a template in the compiled template cache.
+
+            @param reference: Reference to template object
+            @param creationTime: Creation time from metadata of template object
+            @param objectId: Unique ID from metadata of template object
+            @return Key string
+        '''
+
+        return hashlib.sha1('\t'.join([ TEMPLATE_CACHE_VERSION, reference, creationTime, objectId ])).hexdigest()
+
+    def readCompiledTemplate(self, key):
+        ''' Read a compiled template from the cache.
+
+            @param key: Key string from templateCacheKey()
+            @return CompiledTemplate object or None when the template is not in the cache
+        '''
+
+        filename = os.path.join(self.templateCacheFolder, key+'.template')
+        try:
+            with open(filename, 'rb') as handle:
+                template = cPickle.load(handle)
+        except Exception:
+            # A missing or damaged file is treated the same as a template not in the cache.
+            return None
+
+        # Update the modification time to mark the file as recently used.
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return template
+
+    def writeCompiledTemplate(self, key, template):
+        ''' Write a compiled template to the cache and remove the least recently used templates.
+
+            @param key: Key string from templateCacheKey()
+            @param template: CompiledTemplate object
+            @return Nothing
+        '''
+
+        if self.templateCacheSize <= 0:
+            return
+        self._writeCacheFile(self.templateCacheFolder, key+'.template', template, self.templateCacheSize)
+        return
+
+    def _writeCacheFile(self, folder, name, data, maxFiles):
+        ''' Write a pickled object to a cache folder and remove the least recently used files.
+
+            @param folder: Path to cache folder
+            @param name: Name of cache file
+            @param data: Object to save in file
+            @param maxFiles: Maximum number of files with the same extension in the folder
+            @return Nothing
+        '''
+
+        if not os.path.exists(folder):
+            try:
+                os.makedirs(folder, 0775)
+            except OSError:
+                if not os.path.isdir(folder):
+                    raise
+
+        # Write to a temporary file and rename so a reader never sees a partial file.
+        filename = os.path.join(folder, name)
+        tempFilename = '%s.%d.tmp' %(filename, os.getpid())
+        with open(tempFilename, 'wb') as handle:
+            cPickle.dump(data, handle, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tempFilename, filename)
+
+        # Remove the least recently used files when the cache is full.
+        extension = os.path.splitext(name)[1]
+        cacheFiles = list()
+        for name in os.listdir(folder):
+            if name.endswith(extension):
+                path = os.path.join(folder, name)
+                try:
+                    cacheFiles.append( (os.path.getmtime(path), path) )
+                except OSError:
+                    pass
+        cacheFiles.sort()
+        for mtime, path in cacheFiles[:-maxFiles]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return
+
+    # A gene results file has the intermediate results of the algorithm for each protein in a
+    # genome so a genome can be annotated again without searching for the proteins that did
+    # not change.  The file has a pickled dictionary with the key of the data the results
+    # were calculated from and a dictionary keyed by feature ID of a tuple with the sequence
+    # hash, the roleset tuples, and the role tuples for the protein.  The least recently used
+    # files are removed when there are more than gene_results_size files.
+
+    def readGeneResults(self, genomeId):
+        ''' Read the saved per-gene results for a genome.
+
+            @param genomeId: Genome ID string
+            @return Dictionary with gene results or None when there are no saved results
+        '''
+
+        filename = os.path.join(self.geneResultsFolder, hashlib.sha1(genomeId).hexdigest()+'.results')
+        try:
+            with open(filename, 'rb') as handle:
+                results = cPickle.load(handle)
+        except Exception:
+            # A missing or damaged file is treated the same as a genome without saved results.
+            return None
+        if not isinstance(results, dict) or results.get('genome_id') != genomeId:
+            return None
+
+        # Update the modification time to mark the file as recently used.
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return results
+
+    def writeGeneResults(self, genomeId, key, genes):
+        ''' Save the per-gene results for a genome.
+
+            @param genomeId: Genome ID string
+            @param key: Key string that identifies the data the results were calculated from
+            @param genes: Dictionary keyed by feature ID of tuple with sequence hash, list of
+                roleset tuples, and list of role tuples
+            @return Nothing
+        '''
+
+        if self.geneResultsSize <= 0:
+            return
+        results = { 'genome_id': genomeId, 'key': key, 'genes': genes }
+        self._writeCacheFile(self.geneResultsFolder, hashlib.sha1(genomeId).hexdigest()+'.results', results, self.geneResultsSize)
+        return
+
     # A protein FASTA file contains the amino acid sequences for a set of feature IDs.
     
     def writeProteinFastaFile(self, filename, fidsToSeqs):
@@ -276,7 +502,8 @@ class ProbAnnotationParser:
             raise MakeblastdbError('Failed to run "%s": %s' %(cmd, e.strerror))
         return
     
-    def parseBlastOutput(self, blastResultsPath):
+    def parseBlastOutput(self, blastResultsPath, fidRoleIndex=None, topK=0, minRelativeScore=0.0,
+                         maxLikelihoodChange=DEFAULT_MAX_LIKELIHOOD_CHANGE):
         ''' Read BLAST results file and store in a convenient structure.
             The results file is in BLAST output format 6 where each line describes an alignment
             found by the search program.  A line has 12 tab delimited fields: (1) query label,
@@ -287,24 +514,87 @@ class ProbAnnotationParser:
  
             @note Score is the negative log E-value
             @param blastResultsPath Path to BLAST results file
-            @return Dictionary mapping query ID to tuple of target ID and score
+            @param fidRoleIndex ProbAnnotationIndex object for interning target IDs or None
+            @param topK Maximum number of hits to keep for a query or 0 to keep all hits
+            @param minRelativeScore Minimum fraction of the maximum score for a query to keep
+                a hit or 0 to keep all hits
+            @param maxLikelihoodChange Largest change in a likelihood allowed from pruning
+            @return ProbAnnotationHitStore object mapping query ID to list of tuples of target
+                ID and score
         '''
     
-        idToTargetList = dict()
-        for line in open(blastResultsPath, 'r'):
+        hitStore = ProbAnnotationHitStore(fidRoleIndex, topK, minRelativeScore, maxLikelihoodChange)
+        queryid = None
+        targets = list()
+        scores = list()
+        with open(blastResultsPath, 'r') as handle:
+            for line in handle:
+                fields = line.strip('\r\n').split('\t')
+                if float(fields[11]) < 0.0: # Throw out alignments with a negative bit score
+                    hitStore.numDiscarded += 1
+                    continue
+                if fields[0] != queryid:
+                    if len(targets) > 0:
+                        hitStore.addHits(queryid, targets, scores)
+                        targets = list()
+                        scores = list()
+                    queryid = fields[0]
+                targets.append(fields[1])
+                scores.append(-1.0 * math.log10(float(fields[10]) + MIN_EVALUE))
+        if len(targets) > 0:
+            hitStore.addHits(queryid, targets, scores)
+        hitStore.finish()
+        return hitStore
+
+    def iterBlastOutput(self, handle, topK=0, minRelativeScore=0.0, maxLikelihoodChange=DEFAULT_MAX_LIKELIHOOD_CHANGE):
+        ''' Read BLAST results from a file handle and return the hits for each query as it is completed.
+            The results are in the same format as for parseBlastOutput().  The search programs
+            write all of the hits for a query together so the hits for a query are complete when
+            a line for a different query is read.  Lines are read as they become available so
+            the handle can be a pipe from a running search program.
+
+            @note Score is the negative log E-value
+            @param handle File handle with BLAST results
+            @param topK Maximum number of hits to keep for a query or 0 to keep all hits
+            @param minRelativeScore Minimum fraction of the maximum score for a query to keep
+                a hit or 0 to keep all hits
+            @param maxLikelihoodChange Largest change in a likelihood allowed from pruning
+            @return Generator of tuples with query ID and list of tuples of target ID and score
+        '''
+
+        queryid = None
+        targetList = list()
+        for line in iter(handle.readline, ''):
             fields = line.strip('\r\n').split('\t')
-            queryid = fields[0]
-            targetid = fields[1]
+            if fields[0] != queryid:
+                if len(targetList) > 0:
+                    yield queryid, self._pruneTargetList(targetList, topK, minRelativeScore, maxLikelihoodChange)
+                queryid = fields[0]
+                targetList = list()
             if float(fields[11]) < 0.0: # Throw out alignments with a negative bit score
-                print 'throwing out %s' %(line)
                 continue
             logeval = -1.0 * math.log10(float(fields[10]) + MIN_EVALUE)
-            tup = ( targetid, logeval )
-            if queryid in idToTargetList:
-                idToTargetList[queryid].append( tup )
-            else:
-                idToTargetList[queryid] = [ tup ]
-        return idToTargetList
+            targetList.append( (fields[1], logeval) )
+        if len(targetList) > 0:
+            yield queryid, self._pruneTargetList(targetList, topK, minRelativeScore, maxLikelihoodChange)
+        return
+
+    def _pruneTargetList(self, targetList, topK, minRelativeScore, maxLikelihoodChange):
+        ''' Prune the low-scoring hits for a query.
+            @param targetList List of tuples of target ID and score
+            @param topK Maximum number of hits to keep or 0 to keep all hits
+            @param minRelativeScore Minimum fraction of the maximum score to keep a hit or 0
+                to keep all hits
+            @param maxLikelihoodChange Largest change in a likelihood allowed from pruning
+            @return List of tuples of target ID and score for hits that are kept
+        '''
+
+        if topK <= 0 and minRelativeScore <= 0.0:
+            return targetList
+        keep = selectHits([ tup[1] for tup in targetList ], topK, minRelativeScore, maxLikelihoodChange)
+        if keep is None:
+            return targetList
+        return [ targetList[position] for position in keep ]
     
     # A complexes to roles file contains a mapping of complex IDs to functional roles.
     # Each line has these fields:
@@ -517,6 +807,44 @@ class ProbAnnotationParser:
                 queryToTuplist[spl[0]] = [ (spl[1], float(spl[2])) ]
         return queryToTuplist
     
+    # A compact rxnprobs file has the reaction probabilities from a rxnprobs object in a
+    # columnar binary form with a dictionary-encoded ID column, a 32-bit float probability
+    # column, and compressed detail columns that are decoded when used.  See
+    # ProbAnnotationRxnprobs for the details of the format.
+
+    def readCompactRxnprobsFile(self, filename):
+        ''' Read data from a compact rxnprobs file.
+
+            @param filename: Path to compact rxnprobs file
+            @return CompactRxnprobs object for the memory-mapped file
+        '''
+
+        return CompactRxnprobs(filename)
+
+    def readCompactRxnprobsProbabilities(self, filename):
+        ''' Read only the probabilities from a compact rxnprobs file.
+
+            @param filename: Path to compact rxnprobs file
+            @return Dictionary mapping reaction ID to probability
+        '''
+
+        rxnprobs = CompactRxnprobs(filename)
+        try:
+            return rxnprobs.probabilities()
+        finally:
+            rxnprobs.close()
+
+    def writeCompactRxnprobsFile(self, filename, reactionProbs):
+        ''' Write data to a compact rxnprobs file.
+
+            @param filename: Path to compact rxnprobs file
+            @param reactionProbs: List of lists with reaction ID, probability, type, complex string, and GPR
+            @return Nothing
+        '''
+
+        writeRxnprobsFile(filename, reactionProbs)
+        return
+
     # The status file is used to track the status of setting up the static database files when
     # the server starts.  The first line of the file contains the status which is one of
     # these values:
@@ -568,10 +896,15 @@ class ProbAnnotationParser:
             The static database files are stored in the directory specified by the
             data_dir configuration variable.  A file is only downloaded if
             the file is not available on this system or the file has been updated
-            in Shock.
+            in Shock.  Files are downloaded concurrently (see downloadShockFile()) and
+            the cache file is updated as soon as each download is complete.  The compiled
+            feature ID to role index is optional and is only downloaded when it was built
+            from the same feature ID to role file that is stored in Shock.
             @param mylog Log object for messages
             @return Nothing
             @raise MissingFileError when database file is not found in Shock
+            @raise DownloadError when a database file could not be downloaded
+            @raise BadChecksumError when a downloaded file does not match its checksum
         '''
         
         # Get the current info about the static database files from the cache file.
@@ -585,17 +918,27 @@ class ProbAnnotationParser:
         shockClient = ShockClient(self.shockURL)
 
         # See if the static database files on this system are up-to-date with files stored in Shock.
-        shockFiles = dict(self.DataFiles.items() + self.SearchFiles.items())
-        for key in shockFiles:
+        shockFiles = dict(self.DataFiles.items() + self.SearchFiles.items() + self.IndexFiles.items())
+        nodes = dict()
+        downloads = list()
+        for key in sorted(shockFiles, key=lambda key: key in self.IndexFiles):
             # Get info about the file stored in Shock.
             localPath = shockFiles[key]
             name = os.path.basename(localPath)
             nodelist = shockClient.query_node( { 'lookupname': LOOKUP_NAME_PREFIX+'/'+name } )
-            if len(nodelist) == 0:
+            if key in self.IndexFiles:
+                # The compiled index is built on this system when it is not available or
+                # was built from a different feature ID to role file.
+                if len(nodelist) == 0 or nodelist[0]['attributes'].get('source_md5', None) != \
+                        nodes['otu_fid_role_file']['file']['checksum']['md5']:
+                    mylog.log_message(log.INFO, 'Compiled index %s is not available from %s' %(name, self.shockURL))
+                    continue
+            elif len(nodelist) == 0:
                 message = 'Database file %s is not available from %s\n' %(name, self.shockURL)
                 mylog.log_message(log.ERR, message) # MBM
                 raise MissingFileError(message)
             node = nodelist[0]
+            nodes[key] = node
             
             # Download the file if the checksum does not match or the file is not available on this system.
             download = False
@@ -607,26 +950,161 @@ class ProbAnnotationParser:
             if os.path.exists(localPath) == False:
                 download = True
             if download:
-                shockClient.download_to_path(node['id'], localPath)
+                downloads.append( (key, node, localPath) )
+
+        # Download the files concurrently and save the info about each file in the cache file
+        # as soon as it is available so a failed download does not lose the other files.
+        cacheLock = threading.Lock()
+        def downloadFile(download):
+            key, node, localPath = download
+            self.downloadShockFile(node, localPath)
+            with cacheLock:
                 fileCache[key] = node
-                mylog.log_message(log.INFO, 'Downloaded %s to %s' %(key, localPath))
-                
+                self._writeFileCache(fileCache)
+            mylog.log_message(log.INFO, 'Downloaded %s to %s' %(key, localPath))
+            return
+
+        if len(downloads) > 0:
+            pool = ThreadPool(max(1, min(self.downloadThreads, len(downloads))))
+            try:
+                pool.map(downloadFile, downloads)
+            finally:
+                pool.close()
+                pool.join()
+
+        # Make sure a downloaded compiled index is newer than the feature ID to role file
+        # it was built from so it is current.
+        for key, node, localPath in downloads:
+            if key in self.IndexFiles:
+                os.utime(localPath, None)
+
         # Save the updated cache file.
-        json.dump(fileCache, open(cacheFilename, 'w'), indent=4)
+        self._writeFileCache(fileCache)
+        return
+
+    def downloadShockFile(self, node, localPath):
+        ''' Download a file from Shock.
+            The file is downloaded to a partial file named with the Shock node ID.  When a
+            partial file from an earlier download exists, only the rest of the file is
+            requested with an HTTP range.  The md5 checksum is calculated while the file is
+            downloaded and the partial file is renamed to the local path only when the
+            checksum matches.
+            @param node: Shock node for the file
+            @param localPath: Path to file on this system
+            @return Nothing
+            @raise DownloadError when the file could not be downloaded after retrying
+            @raise BadChecksumError when the downloaded file does not match its checksum
+        '''
+
+        # Remove partial files from earlier versions of the file.
+        partialPath = '%s.%s.part' %(localPath, node['id'])
+        for path in glob.glob(localPath+'.*.part'):
+            if path != partialPath:
+                os.remove(path)
+
+        # Start the checksum with the data that was already downloaded.
+        checksum = hashlib.md5()
+        offset = 0
+        if os.path.exists(partialPath):
+            with open(partialPath, 'rb') as handle:
+                for chunk in iter(lambda: handle.read(1048576), ''):
+                    checksum.update(chunk)
+                    offset += len(chunk)
+
+        # Download the rest of the file (nothing to get when a partial file is complete).  When
+        # the connection is dropped, the download is resumed from the end of the partial file
+        # after a random delay.  When neither Shock nor the response has the size of the file,
+        # the download is only finished when the server sent the rest of the file without an error.
+        open(partialPath, 'ab').close()
+        size = node['file'].get('size', None)
+        url = '%s/node/%s?download' %(self.shockURL, node['id'])
+        attempt = 0
+        while size is None or offset < int(size):
+            try:
+                headers = dict()
+                if offset > 0:
+                    headers['Range'] = 'bytes=%d-' %(offset)
+                response = requests.get(url, headers=headers, stream=True)
+                if response.status_code == requests.codes.requested_range_not_satisfiable:
+                    # The partial file is not usable so download the whole file.
+                    response.close()
+                    response = requests.get(url, stream=True)
+                response.raise_for_status()
+                mode = 'ab'
+                if response.status_code != requests.codes.partial_content:
+                    # The server sent the whole file.
+                    checksum = hashlib.md5()
+                    offset = 0
+                    mode = 'wb'
+                if size is None and 'Content-Encoding' not in response.headers:
+                    # Use the size of the file from the response so a dropped connection is
+                    # found even when the server does not report an error.
+                    contentRange = response.headers.get('Content-Range', '')
+                    if mode == 'ab' and re.match(r'^bytes \d+-\d+/\d+$', contentRange):
+                        size = contentRange.rpartition('/')[2]
+                    elif mode == 'wb' and 'Content-Length' in response.headers:
+                        size = response.headers['Content-Length']
+                with open(partialPath, mode) as handle:
+                    for chunk in response.iter_content(1048576):
+                        checksum.update(chunk)
+                        handle.write(chunk)
+                        offset += len(chunk)
+                response.close()
+                if size is None:
+                    break
+            except requests.exceptions.RequestException as e:
+                if attempt >= self.downloadRetries:
+                    raise DownloadError('Failed to download %s from %s: %s' %(localPath, url, e))
+            else:
+                if offset >= int(size):
+                    break
+                if attempt >= self.downloadRetries:
+                    raise DownloadError('Download of %s from %s stopped after %d of %d bytes' %(localPath, url, offset, int(size)))
+            time.sleep(backoffDelay(attempt))
+            attempt += 1
+
+        # Only use the file when it matches the checksum from Shock.
+        if checksum.hexdigest() != node['file']['checksum']['md5']:
+            os.remove(partialPath)
+            raise BadChecksumError('Checksum %s of downloaded file %s does not match checksum %s from Shock' \
+                                   %(checksum.hexdigest(), localPath, node['file']['checksum']['md5']))
+        os.rename(partialPath, localPath)
+        return
+
+    def _writeFileCache(self, fileCache):
+        ''' Write the info about the static database files to the cache file.
+            @param fileCache: Dictionary keyed by file name key of Shock node for file
+            @return Nothing
+        '''
+
+        cacheFilename = self.StatusFiles['cache_file']
+        tempFilename = '%s.%d.tmp' %(cacheFilename, os.getpid())
+        with open(tempFilename, 'w') as handle:
+            json.dump(fileCache, handle, indent=4)
+        os.rename(tempFilename, cacheFilename)
         return
      
     def storeDatabaseFiles(self, token):
         ''' Store the static database files to Shock.
+            The compiled feature ID to role index is built first when it is out of date
+            and is stored with the checksum of the feature ID to role file it was built
+            from so it can be shipped with the other static database files.
             @param token: Authorization token for authenticating to shock
             @return Nothing
         '''
         
         # Create a shock client.
         shockClient = ShockClient(self.shockURL, token=token)
+
+        # Build the compiled index when it is out of date.
+        if os.path.exists(self.DataFiles['otu_fid_role_file']) and not self.isFidRoleIndexCurrent():
+            sys.stderr.write('Building "%s"...' %(self.IndexFiles['otu_fid_role_index_file']))
+            self.buildFidRoleIndex()
+            sys.stderr.write('done\n')
         
         # Upload all of the static database files to shock.
         fileCache = dict()
-        shockFiles = dict(self.DataFiles.items() + self.SearchFiles.items())
+        shockFiles = dict(self.DataFiles.items() + self.SearchFiles.items() + self.IndexFiles.items())
         for key in shockFiles:
             localPath = shockFiles[key]
             name = os.path.basename(localPath)
@@ -645,6 +1123,8 @@ class ProbAnnotationParser:
                 # Build the attributes for this file and store as json in a separate file.
                 moddate = time.ctime(os.path.getmtime(localPath))           
                 attr = { 'lookupname': LOOKUP_NAME_PREFIX+'/'+name, 'moddate': moddate }
+                if key in self.IndexFiles:
+                    attr['source_md5'] = self._fileMd5(self.DataFiles['otu_fid_role_file'])
                 attrFilename = os.path.join(self.dataFolderPath, name+'.attr')
                 attrFid = open(attrFilename, 'w')
                 json.dump(attr, attrFid, indent=4)
@@ -670,6 +1150,179 @@ class ProbAnnotationParser:
 
         return
 
+    def _fileMd5(self, path):
+        ''' Calculate the md5 checksum of a file.
+            @param path: Path to file
+            @return Checksum string
+        '''
+
+        checksum = hashlib.md5()
+        with open(path, 'rb') as handle:
+            for chunk in iter(lambda: handle.read(1048576), ''):
+                checksum.update(chunk)
+        return checksum.hexdigest()
+
+    def searchDatabaseChecksum(self):
+        ''' Get a checksum that identifies the current version of the search database.
+            The checksum of each search database file saved in the cache file is used when
+            available.  Otherwise the size and modification time of the file are used.
+            @return Checksum string
+        '''
+
+        return self._filesChecksum(dict(self.SearchFiles.items() + [ ('protein_fasta_file', self.DataFiles['protein_fasta_file']) ]))
+
+    def fidRoleChecksum(self):
+        ''' Get a checksum that identifies the current version of the feature ID to role file.
+            @return Checksum string
+        '''
+
+        return self._filesChecksum({ 'otu_fid_role_file': self.DataFiles['otu_fid_role_file'] })
+
+    def _filesChecksum(self, files):
+        ''' Get a checksum that identifies the current version of a set of static database files.
+            @param files: Dictionary keyed by file key of path to file
+            @return Checksum string
+        '''
+
+        cacheFilename = self.StatusFiles['cache_file']
+        if os.path.exists(cacheFilename):
+            fileCache = json.load(open(cacheFilename, 'r'))
+        else:
+            fileCache = dict()
+        parts = list()
+        for key in sorted(files):
+            try:
+                parts.append('%s=%s' %(key, fileCache[key]['file']['checksum']['md5']))
+            except (KeyError, TypeError):
+                if os.path.exists(files[key]):
+                    parts.append('%s=%d:%d' %(key, os.path.getsize(files[key]), int(os.path.getmtime(files[key]))))
+        return hashlib.sha1(';'.join(parts)).hexdigest()
+
+    # The ready file is published after the static database files are validated.  It has the
+    # load data option and the size and modification time of every static database file so
+    # a worker can check that the files have not changed with a few calls to stat().  The
+    # lock file is locked with a shared lock while checking the ready file and an exclusive
+    # lock while updating the static database files.
+
+    def _databaseFileStats(self):
+        ''' Get the size and modification time of the static database files.
+            @return Dictionary keyed by path of list with size and modification time
+                (None for a file that does not exist)
+        '''
+
+        stats = dict()
+        for path in self.DataFiles.values() + self.SearchFiles.values() + self.IndexFiles.values():
+            try:
+                info = os.stat(path)
+                stats[path] = [ info.st_size, info.st_mtime ]
+            except OSError:
+                stats[path] = None
+        return stats
+
+    def writeReadyFile(self):
+        ''' Publish the ready file for the current static database files.
+            @return Nothing
+        '''
+
+        ready = { 'load_data_option': self.loadDataOption, 'files': self._databaseFileStats(),
+                  'updated': time.strftime('%a %b %d %Y %H:%M:%S %Z', time.localtime()) }
+        readyFilename = self.StatusFiles['ready_file']
+        tempFilename = '%s.%d.tmp' %(readyFilename, os.getpid())
+        with open(tempFilename, 'w') as handle:
+            json.dump(ready, handle, indent=4)
+        os.rename(tempFilename, readyFilename)
+        return
+
+    def isReadyFileCurrent(self):
+        ''' Check if the ready file matches the current static database files.
+            @return True when the static database files are ready to use
+        '''
+
+        try:
+            ready = json.load(open(self.StatusFiles['ready_file'], 'r'))
+        except (IOError, ValueError):
+            return False
+        stats = self._databaseFileStats()
+        for path in stats:
+            if path in self.IndexFiles.values() and stats[path] is None:
+                continue # The compiled index is optional
+            if stats[path] is None or ready['files'].get(path, None) != stats[path]:
+                return False
+        return True
+
+    def _lockDatabaseFiles(self, operation):
+        ''' Lock the static database files.
+            @param operation: fcntl.LOCK_SH for a shared lock or fcntl.LOCK_EX for an exclusive lock
+            @return File handle of lock file (close the handle to release the lock)
+        '''
+
+        handle = open(self.StatusFiles['lock_file'], 'a')
+        fcntl.flock(handle.fileno(), operation)
+        return handle
+
+    def warmupDatabaseFiles(self, mylog):
+        ''' Validate the static database files and publish the ready file.
+            The files are loaded from Shock when the load data option is "shock", the
+            compiled feature ID to role index is built when it is out of date, and the
+            ready file is published so workers can skip the validation.
+            @param mylog: Log object for messages
+            @return Nothing
+            @raise NotReadyError when a static database file is missing
+        '''
+
+        lockHandle = self._lockDatabaseFiles(fcntl.LOCK_EX)
+        try:
+            self.writeStatusFile('running')
+            try:
+                if self.loadDataOption == 'shock':
+                    self.loadDatabaseFiles(mylog)
+                self.checkIfDatabaseFilesExist()
+                if not self.isFidRoleIndexCurrent():
+                    mylog.log_message(log.INFO, 'Building compiled index %s' %(self.IndexFiles['otu_fid_role_index_file']))
+                    self.buildFidRoleIndex()
+            except:
+                self.writeStatusFile('failed')
+                if os.path.exists(self.StatusFiles['ready_file']):
+                    os.remove(self.StatusFiles['ready_file'])
+                raise
+            self.writeReadyFile()
+            self.writeStatusFile('ready')
+            mylog.log_message(log.INFO, 'Static database files in %s are ready' %(self.dataFolderPath))
+        finally:
+            lockHandle.close()
+        return
+
+    def openDatabaseFiles(self, mylog, testDataPath):
+        ''' Make sure the static database files are ready to use.
+            When the ready file is current (published by warmupDatabaseFiles()), only the
+            size and modification time of the files are checked.  Otherwise the static
+            database files are set up with getDatabaseFiles() while holding an exclusive
+            lock so concurrent workers do not update the files at the same time.
+            @param mylog: Log object for messages
+            @param testDataPath: Path to directory with test database files
+            @return Current value of load data option
+        '''
+
+        lockHandle = self._lockDatabaseFiles(fcntl.LOCK_SH)
+        try:
+            if self.isReadyFileCurrent():
+                return self.loadDataOption
+        finally:
+            lockHandle.close()
+
+        # Another worker may have set up the files while waiting for the exclusive lock.
+        lockHandle = self._lockDatabaseFiles(fcntl.LOCK_EX)
+        try:
+            if self.isReadyFileCurrent():
+                return self.loadDataOption
+            mylog.log_message(log.NOTICE, 'Static database files in %s are not ready, run "ms-probanno-data warmup"' %(self.dataFolderPath))
+            loadDataOption = self.getDatabaseFiles(mylog, testDataPath)
+            if loadDataOption != 'test':
+                self.writeReadyFile()
+        finally:
+            lockHandle.close()
+        return loadDataOption
+
     def getDatabaseFiles(self, mylog, testDataPath):
         ''' Get the static database files.
             The static database files come from one of three places: (1) Shock,
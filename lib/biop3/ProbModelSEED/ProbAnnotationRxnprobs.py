@@ -0,0 +1,246 @@
+
+# Compact columnar encoding of reaction probabilities
+import os
+import sys
+import mmap
+import zlib
+import struct
+from array import array
+
+# Identifies a compact rxnprobs file and the version of the file format.
+RXNPROBS_MAGIC = 'PARXP001'
+
+# The header has the magic string, two counts, and the byte offsets of the six sections
+# and the end of the file.
+HEADER_FORMAT = '<8s2I7I'
+
+# Names of the detail columns in the order they are stored in the file.
+DETAIL_COLUMNS = [ 'type', 'complexes', 'gpr' ]
+
+# Exception thrown when a compact rxnprobs file is not valid
+class BadRxnprobsError(Exception):
+    pass
+
+# A compact rxnprobs file holds the list of reaction probabilities returned by
+# ProbAnnotationWorker.reactionProbabilities() with one column for each field of a
+# reaction.  All integers are unsigned 32-bit little-endian values.  After the header,
+# the file has these sections:
+#   1. ID column: index into the ID dictionary for each reaction
+#   2. Probability column: 32-bit float probability for each reaction
+#   3. ID dictionary: compressed list of unique reaction IDs
+#   4. Type column: compressed list of the type of each reaction
+#   5. Complex column: compressed list of the complex string of each reaction
+#   6. GPR column: compressed list of the GPR of each reaction
+# A compressed list is numValues+1 offsets followed by the values, compressed with zlib.
+# The ID and probability columns are not compressed so the probabilities can be loaded
+# without decoding the detail columns.
+
+def _packValues(values, typecode):
+    ''' Convert a list of numbers to packed little-endian values.
+        @param values: List of numbers
+        @param typecode: Type code for array ('I' or 'f')
+        @return String with packed values
+        @raise BadRxnprobsError when a value does not fit in 32 bits
+    '''
+
+    packed = array(typecode)
+    if packed.itemsize != 4 and typecode == 'I':
+        packed = array('L')
+    try:
+        packed.fromlist(values)
+    except OverflowError:
+        raise BadRxnprobsError('Value is too large for compact rxnprobs file')
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tostring()
+
+def _unpackValues(data, typecode):
+    ''' Convert packed little-endian values to a list of numbers.
+        @param data: String with packed values
+        @param typecode: Type code for array ('I' or 'f')
+        @return List of numbers
+    '''
+
+    values = array(typecode)
+    if values.itemsize != 4 and typecode == 'I':
+        values = array('L')
+    values.fromstring(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tolist()
+
+def _packStrings(strings):
+    ''' Build a compressed list of strings.
+        @param strings: List of strings
+        @return String with compressed list
+    '''
+
+    offsets = [ 0 ]
+    for value in strings:
+        offsets.append(offsets[-1] + len(value))
+    return zlib.compress(_packValues(offsets, 'I') + ''.join(strings))
+
+def _unpackStrings(data, numValues):
+    ''' Decode a compressed list of strings.
+        @param data: String with compressed list
+        @param numValues: Number of strings in list
+        @return List of strings
+        @raise BadRxnprobsError when the list cannot be decoded
+    '''
+
+    try:
+        data = zlib.decompress(data)
+    except zlib.error as e:
+        raise BadRxnprobsError('Compressed column in compact rxnprobs file is damaged: %s' %(e))
+    numBytes = 4 * (numValues + 1)
+    offsets = _unpackValues(data[:numBytes], 'I')
+    if len(offsets) != numValues + 1 or numBytes + offsets[-1] != len(data):
+        raise BadRxnprobsError('Compressed column in compact rxnprobs file has the wrong size')
+    return [ data[numBytes + offsets[index]:numBytes + offsets[index + 1]] for index in range(numValues) ]
+
+def _encode(value):
+    ''' Convert a value from a reaction probability to a byte string.
+        @param value: String or unicode value
+        @return Byte string
+    '''
+
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def writeRxnprobsFile(filename, reactionProbs):
+    ''' Write a compact rxnprobs file.
+        The file is written to a temporary file and renamed so a reader never sees a
+        partial file.  Probabilities are stored as 32-bit floats.
+        @param filename: Path to compact rxnprobs file
+        @param reactionProbs: List of lists with reaction ID, probability, type, complex
+            string, and GPR
+        @return Nothing
+    '''
+
+    # Intern the reaction IDs.
+    reactionIds = list()
+    idIndices = dict()
+    idColumn = list()
+    for reaction in reactionProbs:
+        rxnId = _encode(reaction[0])
+        if rxnId not in idIndices:
+            idIndices[rxnId] = len(reactionIds)
+            reactionIds.append(rxnId)
+        idColumn.append(idIndices[rxnId])
+
+    # Build the sections.
+    sections = [ _packValues(idColumn, 'I'), _packValues([ float(reaction[1]) for reaction in reactionProbs ], 'f'),
+                 _packStrings(reactionIds) ]
+    for column in range(len(DETAIL_COLUMNS)):
+        sections.append(_packStrings([ _encode(reaction[column + 2]) for reaction in reactionProbs ]))
+
+    # Write the header and sections to the file.
+    offsets = list()
+    position = struct.calcsize(HEADER_FORMAT)
+    for section in sections:
+        offsets.append(position)
+        position += len(section)
+    if position > 0xffffffff:
+        raise BadRxnprobsError('Compact rxnprobs file would be larger than 4 GB')
+    tempFilename = '%s.%d.tmp' %(filename, os.getpid())
+    with open(tempFilename, 'wb') as handle:
+        handle.write(struct.pack(HEADER_FORMAT, RXNPROBS_MAGIC, len(reactionProbs), len(reactionIds), *(offsets + [ position ])))
+        for section in sections:
+            handle.write(section)
+    os.rename(tempFilename, filename)
+    return
+
+''' Memory-mapped compact rxnprobs file with detail columns decoded on first use. '''
+
+class CompactRxnprobs:
+
+    def __init__(self, filename):
+        ''' Initialize the object.
+            Only the header is read.  The other sections are read when they are used.
+            @param filename: Path to compact rxnprobs file
+            @raise BadRxnprobsError when the file is not a compact rxnprobs file
+        '''
+
+        self.filename = filename
+        size = os.path.getsize(filename)
+        if size < struct.calcsize(HEADER_FORMAT):
+            raise BadRxnprobsError('File "%s" is too small to be a compact rxnprobs file' %(filename))
+        with open(filename, 'rb') as handle:
+            self.buffer = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        header = struct.unpack_from(HEADER_FORMAT, self.buffer, 0)
+        if header[0] != RXNPROBS_MAGIC:
+            self.buffer.close()
+            raise BadRxnprobsError('File "%s" is not a compact rxnprobs file' %(filename))
+        self.numReactions, self.numIds = header[1:3]
+        self._offsets = header[3:]
+        if self._offsets[-1] != size:
+            self.buffer.close()
+            raise BadRxnprobsError('File "%s" is truncated or has extra data' %(filename))
+        self._reactionIds = None
+        self._probabilities = None
+        self._columns = dict()
+        return
+
+    def __len__(self):
+        return self.numReactions
+
+    def _section(self, index):
+        ''' Get the data in a section.
+            @param index: Index of section
+            @return String with section data
+        '''
+
+        return self.buffer[self._offsets[index]:self._offsets[index + 1]]
+
+    def reactionIds(self):
+        ''' Get the ID of each reaction.
+            @return List of reaction IDs
+        '''
+
+        if self._reactionIds is None:
+            dictionary = _unpackStrings(self._section(2), self.numIds)
+            self._reactionIds = [ dictionary[index] for index in _unpackValues(self._section(0), 'I') ]
+        return self._reactionIds
+
+    def probabilityColumn(self):
+        ''' Get the probability of each reaction.
+            @return List of probabilities
+        '''
+
+        if self._probabilities is None:
+            self._probabilities = _unpackValues(self._section(1), 'f')
+        return self._probabilities
+
+    def probabilities(self):
+        ''' Get the probabilities without decoding the detail columns.
+            @return Dictionary mapping reaction ID to probability
+        '''
+
+        return dict(zip(self.reactionIds(), self.probabilityColumn()))
+
+    def column(self, name):
+        ''' Get the values in a detail column.
+            @param name: Name of column (one of DETAIL_COLUMNS)
+            @return List of values for each reaction
+        '''
+
+        if name not in self._columns:
+            self._columns[name] = _unpackStrings(self._section(3 + DETAIL_COLUMNS.index(name)), self.numReactions)
+        return self._columns[name]
+
+    def reactionProbabilities(self):
+        ''' Rebuild the list of reaction probabilities.
+            @return List of lists with reaction ID, probability, type, complex string, and GPR
+        '''
+
+        columns = [ self.reactionIds(), self.probabilityColumn() ] + [ self.column(name) for name in DETAIL_COLUMNS ]
+        return [ list(reaction) for reaction in zip(*columns) ]
+
+    def close(self):
+        ''' Unmap the compact rxnprobs file.
+            @return Nothing
+        '''
+
+        self.buffer.close()
+        return
@@ -0,0 +1,309 @@
+
+# Long-running server for the probabilistic annotation algorithm
+import os
+import json
+import time
+import random
+import threading
+import traceback
+import requests
+from collections import OrderedDict
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from biop3.ProbModelSEED.ProbAnnotationWorker import ProbAnnotationWorker
+from biokbase import log
+
+# Name of module for methods in JSON-RPC requests.
+MODULE_NAME = 'ProbAnnotation'
+
+# Exception thrown when the compiled template for a request is not available
+class TemplateNotFoundError(Exception):
+    pass
+
+# Exception thrown when a JSON-RPC request is not valid
+class BadRequestError(Exception):
+    pass
+
+''' Annotation service that keeps the reference data warm between requests. '''
+
+class ProbAnnotationService:
+
+    def __init__(self):
+        ''' Initialize the object.
+            The static database files are validated, the compiled feature ID to role index
+            is memory-mapped, and the search database is read once so it is in the page
+            cache before the first request.
+        '''
+
+        self.worker = ProbAnnotationWorker('server')
+        self.config = self.worker.config
+        self.dataParser = self.worker.dataParser
+        self.fidRoleIndex = self.worker.loadReferenceData()
+        if self.config.get('annotation_server_preload_db', '1') == '1':
+            for path in self.dataParser.SearchFiles.values():
+                self._preloadFile(path)
+
+        # Compiled templates in least recently used order.
+        self.templates = OrderedDict()
+        self.templateCacheSize = max(1, int(self.config.get('template_cache_size', '16')))
+        self.templateLock = threading.Lock()
+
+        # Limit the number of genomes annotated at the same time.
+        self.jobSemaphore = threading.Semaphore(int(self.config.get('annotation_server_jobs', '1')))
+        self.startTime = time.time()
+        self.numRequests = 0
+        self.numFailed = 0
+
+        # Totals of the measurements for each stage of the algorithm over all requests.
+        self.stageStats = dict()
+        self.statsLock = threading.Lock()
+        return
+
+    def _preloadFile(self, path):
+        ''' Read a file so its contents are in the page cache.
+            @param path: Path to file
+            @return Nothing
+        '''
+
+        if os.path.exists(path):
+            with open(path, 'rb') as handle:
+                while len(handle.read(8388608)) > 0:
+                    pass
+            self.worker._log(log.INFO, 'Preloaded %s' %(path))
+        return
+
+    def getTemplate(self, key):
+        ''' Get a compiled template from memory or from the compiled template cache.
+            @param key: Key string from ProbAnnotationParser.templateCacheKey()
+            @return CompiledTemplate object
+            @raise TemplateNotFoundError when the template is not in the compiled template cache
+        '''
+
+        with self.templateLock:
+            if key in self.templates:
+                template = self.templates.pop(key)
+                self.templates[key] = template
+                return template
+        template = self.dataParser.readCompiledTemplate(key)
+        if template is None:
+            raise TemplateNotFoundError('Compiled template %s is not in the compiled template cache' %(key))
+        with self.templateLock:
+            self.templates[key] = template
+            while len(self.templates) > self.templateCacheSize:
+                self.templates.popitem(last=False)
+        return template
+
+    def annotate(self, ctx, input):
+        ''' Run the probabilistic annotation algorithm for a genome.
+            @param ctx: User context for the request
+            @param input: Dictionary with genome_id, features (list of features with protein
+                sequences), template_key (key of compiled template), and optional community_index
+            @return Dictionary with reaction_probabilities (list of reaction probabilities)
+        '''
+
+        for name in [ 'genome_id', 'features', 'template_key' ]:
+            if name not in input:
+                raise BadRequestError('Required parameter %s is missing' %(name))
+        template = self.getTemplate(input['template_key'])
+        with self.jobSemaphore:
+            worker = ProbAnnotationWorker(input['genome_id'], context=ctx, communityIndex=input.get('community_index', '0'),
+                                          fidRoleIndex=self.fidRoleIndex)
+            try:
+                fastaFile = worker.genomeToFasta(input['features'])
+                blastResultFile = worker.runBlast(fastaFile)
+                rolestringTuples = worker.rolesetProbabilitiesMarble(blastResultFile)
+                roleProbs = worker.rolesetProbabilitiesToRoleProbabilities(rolestringTuples)
+                totalRoleProbs = worker.totalRoleProbabilities(roleProbs)
+                reactionProbs = worker.templateProbabilities(totalRoleProbs, template)
+            finally:
+                worker.cleanup()
+                self._addMetrics(worker.metrics)
+        return { 'reaction_probabilities': reactionProbs }
+
+    def _addMetrics(self, metrics):
+        ''' Add the measurements from a job to the totals for each stage.
+            @param metrics: Dictionary of measurements from ProbAnnotationWorker
+            @return Nothing
+        '''
+
+        measurements = list(metrics['stages'])
+        for process in metrics['search_processes']:
+            measurements.append({ 'stage': 'search_process', 'wall_time': 0.0, 'cpu_time': process['user_time'] + process['system_time'],
+                                  'max_rss_kb': process['max_rss_kb'], 'items': 1 })
+        with self.statsLock:
+            for measurement in measurements:
+                if measurement['stage'] not in self.stageStats:
+                    self.stageStats[measurement['stage']] = { 'count': 0, 'wall_time': 0.0, 'cpu_time': 0.0, 'items': 0, 'max_rss_kb': 0 }
+                stats = self.stageStats[measurement['stage']]
+                stats['count'] += 1
+                stats['wall_time'] += measurement['wall_time']
+                stats['cpu_time'] += measurement['cpu_time']
+                stats['items'] += measurement['items']
+                stats['max_rss_kb'] = max(stats['max_rss_kb'], measurement['max_rss_kb'])
+        return
+
+    def stats(self, ctx):
+        ''' Get the totals of the measurements for each stage of the algorithm.
+            @param ctx: User context for the request
+            @return Dictionary keyed by stage name of dictionary with number of times the stage
+                ran, total wall clock time, total CPU time, total number of items, and peak
+                resident set size
+        '''
+
+        with self.statsLock:
+            return dict([ (stage, dict(self.stageStats[stage])) for stage in self.stageStats ])
+
+    def status(self, ctx):
+        ''' Get the status of the server.
+            @param ctx: User context for the request
+            @return Dictionary with status information
+        '''
+
+        with self.statsLock:
+            numRequests = self.numRequests
+            numFailed = self.numFailed
+        return { 'uptime': time.time() - self.startTime, 'requests': numRequests, 'failed': numFailed,
+                 'templates': len(self.templates), 'data_dir': self.config['data_dir'] }
+
+    def call(self, method, params, ctx):
+        ''' Run a method from a JSON-RPC request.
+            @param method: Name of method with module prefix
+            @param params: List of parameters for method
+            @param ctx: User context for the request
+            @return List of results
+            @raise BadRequestError when the method is not supported
+        '''
+
+        module, sep, name = method.partition('.')
+        if module != MODULE_NAME or name not in [ 'annotate', 'status', 'stats' ]:
+            raise BadRequestError('Method %s is not supported' %(method))
+        with self.statsLock:
+            self.numRequests += 1
+        try:
+            return [ getattr(self, name)(ctx, *params) ]
+        except:
+            with self.statsLock:
+                self.numFailed += 1
+            raise
+
+''' HTTP request handler for JSON-RPC 1.1 requests shaped like ProbModelSEEDClient._call(). '''
+
+class ProbAnnotationRequestHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        ''' Handle a JSON-RPC request.
+            @return Nothing
+        '''
+
+        request = dict()
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', '0'))))
+            if 'method' not in request:
+                raise BadRequestError('Request does not have a method')
+            ctx = { 'client_ip': self.client_address[0], 'user_id': '-', 'module': MODULE_NAME,
+                    'method': request['method'], 'call_id': request.get('id', '-') }
+            result = self.server.service.call(request['method'], request.get('params', list()), ctx)
+            self._send(200, { 'version': '1.1', 'id': request.get('id'), 'result': result })
+        except Exception as e:
+            error = { 'name': type(e).__name__, 'code': -32000, 'message': str(e), 'error': traceback.format_exc() }
+            self._send(500, { 'version': '1.1', 'id': request.get('id'), 'error': error })
+        return
+
+    def _send(self, code, response):
+        ''' Send a JSON response.
+            @param code: HTTP status code
+            @param response: Response object
+            @return Nothing
+        '''
+
+        body = json.dumps(response)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return
+
+    def log_message(self, format, *args):
+        ''' Log a request to the system log.
+            @return Nothing
+        '''
+
+        self.server.service.worker._log(log.DEBUG, '%s %s' %(self.client_address[0], format %args))
+        return
+
+''' Threaded HTTP server for the annotation service. '''
+
+class ProbAnnotationServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        ''' Initialize the object.
+            @param address: Tuple with host name and port number
+            @param service: ProbAnnotationService object
+        '''
+
+        HTTPServer.__init__(self, address, ProbAnnotationRequestHandler)
+        self.service = service
+        return
+
+# Exception thrown when the annotation server returns an error
+class ServerError(Exception):
+
+    def __init__(self, name, code, message, data=None, error=None):
+        self.name = name
+        self.code = code
+        self.message = '' if message is None else message
+        self.data = data or error or ''
+
+    def __str__(self):
+        return self.name + ': ' + str(self.code) + '. ' + self.message + '\n' + self.data
+
+''' Client for the annotation server. '''
+
+class ProbAnnotationClient:
+
+    def __init__(self, url, timeout=60*60):
+        ''' Initialize the object.
+            @param url: URL of annotation server
+            @param timeout: Number of seconds to wait for a response
+        '''
+
+        self.url = url
+        self.timeout = timeout
+        return
+
+    def _call(self, method, params):
+        ''' Send a JSON-RPC request to the server.
+            @param method: Name of method
+            @param params: List of parameters
+            @return Result of method
+            @raise ServerError when the server returns an error
+        '''
+
+        body = json.dumps({ 'method': MODULE_NAME+'.'+method, 'params': params, 'version': '1.1', 'id': str(random.random())[2:] })
+        ret = requests.post(self.url, data=body, timeout=self.timeout)
+        if ret.status_code == requests.codes.server_error:
+            try:
+                err = json.loads(ret.text)
+            except ValueError:
+                raise ServerError('Unknown', 0, ret.text)
+            if 'error' in err:
+                raise ServerError(**err['error'])
+            raise ServerError('Unknown', 0, ret.text)
+        if ret.status_code != requests.codes.OK:
+            ret.raise_for_status()
+        resp = json.loads(ret.text)
+        if 'result' not in resp:
+            raise ServerError('Unknown', 0, 'An unknown server error occurred')
+        return resp['result'][0]
+
+    def annotate(self, input):
+        return self._call('annotate', [ input ])
+
+    def status(self):
+        return self._call('status', [ ])
+
+    def stats(self):
+        return self._call('stats', [ ])
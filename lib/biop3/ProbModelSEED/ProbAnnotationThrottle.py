@@ -0,0 +1,213 @@
+
+# Limits and retries for requests from many jobs to the same service
+import os
+import re
+import time
+import errno
+import fcntl
+import random
+import tempfile
+import threading
+import urlparse
+
+# Maximum number of requests at the same time to one host from all of the jobs on a machine.
+HOST_REQUEST_LIMIT = 8
+
+# Number of times a request is tried and the delays between tries in seconds.
+RETRY_COUNT = 8
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+
+# Delays in seconds between checks for a free slot when all slots for a host are in use.
+SLOT_BASE_DELAY = 0.05
+SLOT_MAX_DELAY = 2.0
+
+# Permissions of the lock folders and lock files in the system temporary folder so the jobs of
+# every user on a machine can use them.
+SHARED_FOLDER_MODE = 01777
+SHARED_FILE_MODE = 0666
+
+def backoffDelay(attempt, baseDelay=RETRY_BASE_DELAY, maxDelay=RETRY_MAX_DELAY):
+    ''' Calculate the delay before trying a request again.
+        The delay is a random time up to an exponentially growing limit so jobs that failed
+        at the same time do not all try again at the same time.
+        @param attempt: Number of tries that already failed (starting at 0)
+        @param baseDelay: Limit on delay after the first failed try
+        @param maxDelay: Largest limit on delay
+        @return Delay in seconds
+    '''
+
+    return random.uniform(0, min(maxDelay, baseDelay * (2 ** attempt)))
+
+''' Semaphore shared by all of the processes on a machine that limits the requests to a host. '''
+
+class HostSemaphore:
+
+    def __init__(self, url, limit=HOST_REQUEST_LIMIT, lockFolder=None):
+        ''' Initialize the object.
+            Each slot is a lock file for the host and a request holds an exclusive lock on one
+            of the slots.  A lock is released by the system when the process holding it ends
+            so a job that is killed never leaves a slot in use.  The lock files in the system
+            temporary folder are shared by the jobs of every user on the machine.
+            @param url: URL of service (only the host and port are used)
+            @param limit: Maximum number of requests at the same time to the host
+            @param lockFolder: Path to folder for the lock files or None to use the system
+                temporary folder
+            @raise ValueError when limit is less than 1
+        '''
+
+        if limit < 1:
+            raise ValueError('Limit on requests to a host must be at least 1')
+        self.host = urlparse.urlparse(url).netloc
+        self.limit = limit
+        self._hostName = re.sub(r'[^A-Za-z0-9.-]', '_', self.host)
+        self._local = threading.local()
+        if lockFolder is None:
+            lockFolder = os.path.join(tempfile.gettempdir(), 'probanno-host-locks')
+            self.shared = True
+            self.folder = os.path.join(lockFolder, self._hostName)
+            try:
+                self._makeSharedFolder(lockFolder)
+                self._makeSharedFolder(self.folder)
+            except OSError as e:
+                if e.errno not in (errno.EACCES, errno.EPERM):
+                    raise
+                self._usePrivateFolder()
+        else:
+            self.shared = False
+            self.folder = os.path.join(lockFolder, self._hostName)
+            self._makeFolder(self.folder)
+        return
+
+    def _makeFolder(self, path):
+        ''' Create a folder and its parent folders if they do not exist.
+            @param path: Path to folder
+            @return Nothing
+        '''
+
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        return
+
+    def _makeSharedFolder(self, path):
+        ''' Create a folder that every user can add files to if it does not exist.
+            @param path: Path to folder
+            @return Nothing
+        '''
+
+        try:
+            os.mkdir(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            return
+        os.chmod(path, SHARED_FOLDER_MODE)
+        return
+
+    def _usePrivateFolder(self):
+        ''' Switch to lock files that are only shared by the jobs of the current user.
+            This is used when the shared lock files cannot be created or opened.
+            @return Nothing
+        '''
+
+        self.shared = False
+        self.folder = os.path.join(tempfile.gettempdir(), 'probanno-host-locks-%d' %(os.getuid()), self._hostName)
+        self._makeFolder(self.folder)
+        return
+
+    def _openSlot(self, slot):
+        ''' Open the lock file for a slot, creating it if it does not exist.
+            The file is opened for reading so a lock file created by another user can be locked.
+            @param slot: Slot number
+            @return File handle of slot
+            @raise OSError when the lock file cannot be opened or created
+        '''
+
+        path = os.path.join(self.folder, 'slot%d' %(slot))
+        while True:
+            try:
+                return os.fdopen(os.open(path, os.O_RDONLY), 'r')
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            try:
+                fd = os.open(path, os.O_RDONLY | os.O_CREAT | os.O_EXCL, SHARED_FILE_MODE)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                continue
+            if self.shared:
+                os.fchmod(fd, SHARED_FILE_MODE)
+            return os.fdopen(fd, 'r')
+
+    def acquire(self):
+        ''' Wait for a free slot and lock it.
+            When a shared lock file cannot be opened, lock files that are only shared by the
+            jobs of the current user are used instead.
+            @return File handle of locked slot
+            @raise OSError when a lock file that is not shared cannot be opened
+        '''
+
+        attempt = 0
+        while True:
+            slots = range(self.limit)
+            random.shuffle(slots)
+            for slot in slots:
+                try:
+                    handle = self._openSlot(slot)
+                except OSError:
+                    if not self.shared:
+                        raise
+                    self._usePrivateFolder()
+                    break
+                try:
+                    fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return handle
+                except IOError as e:
+                    handle.close()
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+            else:
+                time.sleep(backoffDelay(attempt, SLOT_BASE_DELAY, SLOT_MAX_DELAY))
+                attempt += 1
+
+    def release(self, handle):
+        ''' Unlock a slot.
+            @param handle: File handle returned by acquire()
+            @return Nothing
+        '''
+
+        fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+        handle.close()
+        return
+
+    def __enter__(self):
+        if not hasattr(self._local, 'handles'):
+            self._local.handles = list()
+        self._local.handles.append(self.acquire())
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release(self._local.handles.pop())
+        return False
+
+# Semaphores by host for the requests made by this process.
+_semaphores = dict()
+_semaphoresLock = threading.Lock()
+
+def hostSemaphore(url, limit=HOST_REQUEST_LIMIT):
+    ''' Get the semaphore for the host of a URL.
+        @param url: URL of service
+        @param limit: Maximum number of requests at the same time to the host (only used the
+            first time the semaphore for the host is needed)
+        @return HostSemaphore object
+    '''
+
+    host = urlparse.urlparse(url).netloc
+    with _semaphoresLock:
+        if host not in _semaphores:
+            _semaphores[host] = HostSemaphore(url, limit)
+        return _semaphores[host]
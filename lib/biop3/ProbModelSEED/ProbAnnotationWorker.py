@@ -7,8 +7,16 @@ import traceback
 import time
 import math
 import re
+import bisect
+import json
+import errno
+import resource
 import tempfile
 from biop3.ProbModelSEED.ProbAnnotationParser import ProbAnnotationParser
+from biop3.ProbModelSEED import ProbAnnotationEngine
+from biop3.ProbModelSEED.ProbAnnotationHitCache import ProbAnnotationHitCache, sequenceHash
+from biop3.ProbModelSEED.ProbAnnotationHitStore import DEFAULT_MAX_LIKELIHOOD_CHANGE
+from StringIO import StringIO
 from biokbase import log
 from urllib2 import HTTPError
 from ConfigParser import ConfigParser
@@ -37,15 +45,140 @@ class NoGeneIdsError(Exception):
 class RoleNotFoundEror(Exception):
     pass
 
+# Separator between genome ID and feature ID in query IDs when a batch of genomes is searched together.
+BATCH_SEPARATOR = '::'
+
+# Number of bytes of search results lines for searched sequences that are collected before
+# they are added to the hit cache.  Each add to the cache checks the size of the cache so the
+# lines are added in batches instead of one query at a time.
+HIT_CACHE_BATCH_BYTES = 1024 * 1024
+
+''' File handle wrapper that passes the lines read from search program output for each query to a function. '''
+
+class SearchOutputRecorder:
+
+    def __init__(self, handle, storeFunction):
+        ''' Initialize the object.
+            Only the lines for the query being read are kept.  The lines for a query are
+            passed to the store function when a line for a different query is read.
+            @param handle: File handle with search program output
+            @param storeFunction: Function called with query ID and list of lines without
+                the query ID field when all of the lines for the query have been read
+        '''
+
+        self.handle = handle
+        self.storeFunction = storeFunction
+        self.query = None
+        self.lines = list()
+        return
+
+    def readline(self):
+        ''' Read a line and save it without the query ID field.
+            @return Line or empty string at end of file
+        '''
+
+        line = self.handle.readline()
+        if line:
+            query, sep, rest = line.partition('\t')
+            if query != self.query:
+                self.finish()
+                self.query = query
+            self.lines.append(rest)
+        return line
+
+    def finish(self):
+        ''' Pass the lines for the last query to the store function.
+            Call after the search program finished successfully so the lines of a query
+            cut off by a failed search are not stored.
+            @return Nothing
+        '''
+
+        if self.query is not None:
+            self.storeFunction(self.query, self.lines)
+        self.query = None
+        self.lines = list()
+        return
+
+''' Streaming aggregator of per-gene role likelihoods into whole-cell role likelihoods. '''
+
+class RoleProbabilityAggregator:
+
+    def __init__(self, dilutionPercent):
+        ''' Initialize the object.
+            @param dilutionPercent: A gene is assigned to a role when its likelihood is within
+                this percent of the maximum likelihood of the role
+        '''
+
+        self.dilution = float(dilutionPercent)/100.0
+
+        # Maximum likelihood of each role and list of tuples with likelihood and gene for the
+        # genes that can still be within the dilution percent of the maximum likelihood.
+        self.maxProbs = dict()
+        self.candidates = dict()
+        return
+
+    def add(self, gene, role, likelihood):
+        ''' Add the likelihood that a gene has a role.
+            The candidate genes for a role are pruned when the maximum likelihood rises
+            since the threshold for a gene never goes down.
+            @param gene: Query gene ID
+            @param role: Name of role
+            @param likelihood: Likelihood of gene having role
+            @return Nothing
+        '''
+
+        likelihood = float(likelihood)
+        if role not in self.maxProbs:
+            self.maxProbs[role] = likelihood
+            self.candidates[role] = [ (likelihood, gene) ]
+            return
+        if likelihood > self.maxProbs[role]:
+            self.maxProbs[role] = likelihood
+            threshold = self.dilution * likelihood
+            self.candidates[role] = [ candidate for candidate in self.candidates[role] if candidate[0] >= threshold ]
+            self.candidates[role].append( (likelihood, gene) )
+        elif likelihood >= self.dilution * self.maxProbs[role]:
+            self.candidates[role].append( (likelihood, gene) )
+        return
+
+    def addAll(self, roleProbs):
+        ''' Add the likelihoods from a sequence of tuples.
+            @param roleProbs: Iterable of tuples with query gene, role, and likelihood
+            @return Nothing
+        '''
+
+        for gene, role, likelihood in roleProbs:
+            self.add(gene, role, likelihood)
+        return
+
+    def totalRoleProbabilities(self):
+        ''' Get the whole-cell likelihood and the genes that perform each role.
+            @return List of tuples with role, likelihood, and estimated set of genes that perform the role
+        '''
+
+        totalRoleProbs = list()
+        for role in self.maxProbs:
+            genes = sorted(set([ gene for likelihood, gene in self.candidates[role] ]))
+            gpr = ' or '.join(genes)
+            # We only need to group these if there is more than one of them (avoids extra parenthesis when computing complexes)
+            if len(genes) > 1:
+                gpr = '(' + gpr + ')'
+            totalRoleProbs.append( (role, self.maxProbs[role], gpr) )
+        return totalRoleProbs
+
 ''' Worker that implements probabilistic annotation algorithm. '''
 
 class ProbAnnotationWorker:
 
-    def __init__(self, genomeId, context=None, communityIndex='0'):
+    def __init__(self, genomeId, context=None, communityIndex='0', fidRoleIndex=None, config=None):
         ''' Initialize object.
             @param genomeId: Genome ID string for genome being annotated
             @param context: User context when used in a server
             @param communityIndex: Index number of model in a community model
+            @param fidRoleIndex: ProbAnnotationIndex object shared by a server or None to open
+                the compiled index the first time it is needed
+            @param config: Dictionary of configuration variables or None to read them from the
+                deployment config file
             @return Nothing
         '''
 
@@ -55,11 +188,14 @@ class ProbAnnotationWorker:
 
         # Get the configuration variables.
         serviceName = os.environ.get('KB_SERVICE_NAME', 'ProbModelSEED')
-        cfg = ConfigParser()
-        cfg.read(os.path.join(os.environ.get('KB_TOP'), 'deployment.cfg'))
-        self.config = dict()
-        for nameval in cfg.items(serviceName):
-            self.config[nameval[0]] = nameval[1]
+        if config is not None:
+            self.config = dict(config)
+        else:
+            cfg = ConfigParser()
+            cfg.read(os.path.join(os.environ.get('KB_TOP'), 'deployment.cfg'))
+            self.config = dict()
+            for nameval in cfg.items(serviceName):
+                self.config[nameval[0]] = nameval[1]
         
         # Use the context from the server or build a context when used outside of a server.
         if context is not None:
@@ -80,47 +216,127 @@ class ProbAnnotationWorker:
         # Create a ProbAnnotationParser object for working with the static database files.
         self.dataParser = ProbAnnotationParser(self.config)
 
-        # Get the static database files.  If the files do not exist and they are downloaded
-        # from Shock, it can take a few minutes before they are ready.
-        self.dataParser.getDatabaseFiles(self.logger, '')
-        
+        # The static database files are checked the first time they are needed.
+        self.dataReady = False
+
         # Create a work directory for storing temporary files.
         if not os.path.exists(self.config['work_dir']):
             os.makedirs(self.config['work_dir'], 0775)
         self.workFolder = tempfile.mkdtemp(dir=self.config['work_dir'], prefix='')
 
+        # The compiled feature ID to role index is memory-mapped the first time it is needed.
+        self.fidRoleIndex = fidRoleIndex
+
+        # Rolestrings built from the rolestring IDs in the compiled index and the roles in
+        # each rolestring so the rolestrings never need to be split.
+        self.rolestrings = dict()
+        self.rolestringRoles = dict()
+
+        # The hit cache is opened the first time it is needed.  The queries that were found in
+        # the hit cache when the fasta file was built are merged with the search results.
+        self.hitCache = None
+        self.hitCacheQueries = None
+
+        # Measurements of each stage of the algorithm and each search process for the job.
+        self.metrics = { 'job_name': genomeId, 'job_id': os.path.basename(self.workFolder), 'start_time': time.time(), 'stages': list(), 'search_processes': list() }
+
+        return
+
+    def selectGenome(self, genomeId, communityIndex='0'):
+        ''' Select the genome being annotated when the worker is used for a batch of genomes.
+            @param genomeId: Genome ID string for genome being annotated
+            @param communityIndex: Index number of model in a community model
+            @return Nothing
+        '''
+
+        self.genomeId = genomeId
+        self.communityIndex = communityIndex
         return
 
     def genomeToFasta(self, features):
 
         ''' Convert the features from a genome into an amino-acid FASTA file (for BLAST purposes).
-            @param features: List of features with protein sequences
+            @param features: List of features with protein sequences (a generator of features,
+                like GenomeStreamReader.features(), is written as the features are read)
             @return Path to fasta file with query proteins
             @raise NoFeaturesError when list of features is empty
         '''
 
-        # Make sure the genome has features.
-        if len(features) == 0:
-            raise NoFeaturesError('Genome %s has no features. Did you forget to run annotate_genome?\n' %(self.genomeId))
-    
         # Run the list of features to build the fasta file.
         self._log(log.DEBUG, 'Creating protein fasta file for genome '+self.genomeId)
+        start = self._startStage()
+        self._startHitCacheQueries()
         fastaFile = os.path.join(self.workFolder, '%s.faa' %(self.genomeId))
         with open(fastaFile, 'w') as handle:
-            numProteins = 0
-            for feature in features:
-                # Not a protein-encoding gene
-                if 'protein_translation' not in feature:
-                    continue
-                handle.write('>%s\n%s\n' %(feature['id'], feature['protein_translation']))
-                numProteins += 1
+            numProteins = self._writeFeatures(handle, self._requireFeatures(features, self.genomeId), '')
         
+        self._finishStage('fasta', start, numProteins)
         self._log(log.DEBUG, 'Wrote %d protein sequences to "%s"' %(numProteins, fastaFile))
         return fastaFile
-        
+
+    def genomesToFasta(self, genomes):
+
+        ''' Convert the features from a batch of genomes into one amino-acid FASTA file.
+            Each query ID is the genome ID and the feature ID joined by BATCH_SEPARATOR
+            so the search results can be split by genome with splitBlastOutput().
+            @param genomes: List of tuples with genome ID and list or generator of features (a
+                generator only needs the features for one genome at a time)
+            @return Path to fasta file with query proteins from all of the genomes
+            @raise NoFeaturesError when list of features for a genome is empty
+        '''
+
+        self._log(log.DEBUG, 'Creating protein fasta file for batch of genomes')
+        start = self._startStage()
+        self._startHitCacheQueries()
+        fastaFile = os.path.join(self.workFolder, 'batch.faa')
+        with open(fastaFile, 'w') as handle:
+            numProteins = 0
+            numGenomes = 0
+            for genomeId, features in genomes:
+                numProteins += self._writeFeatures(handle, self._requireFeatures(features, genomeId), genomeId+BATCH_SEPARATOR)
+                numGenomes += 1
+
+        self._finishStage('fasta', start, numProteins)
+        self._log(log.DEBUG, 'Wrote %d protein sequences from %d genomes to "%s"' %(numProteins, numGenomes, fastaFile))
+        return fastaFile
+
+    def splitBlastOutput(self, blastResultFile, genomeIds):
+
+        ''' Split the search results for a batch of genomes into one file per genome.
+            The genome prefix added by genomesToFasta() is removed from the query IDs
+            so each file looks like the output of a search for a single genome.
+            @param blastResultFile: Path to output file from search program for the batch
+            @param genomeIds: List of genome ID strings in the batch
+            @return Dictionary keyed by genome ID of path to output file for that genome
+            @raise BlastError when a query ID in the search results is not from a genome in the batch
+        '''
+
+        # Every genome gets an output file, even when there are no hits for any of its proteins.
+        genomeResultFiles = dict()
+        handles = dict()
+        for genomeId in genomeIds:
+            genomeResultFiles[genomeId] = os.path.join(self.workFolder, '%s.blastout' %(genomeId))
+            handles[genomeId] = open(genomeResultFiles[genomeId], 'w')
+
+        try:
+            with open(blastResultFile, 'r') as handle:
+                for line in handle:
+                    genomeId, sep, rest = line.partition(BATCH_SEPARATOR)
+                    if genomeId not in handles:
+                        raise BlastError('Query in search results line "%s" is not from a genome in the batch' %(line.strip('\r\n')))
+                    handles[genomeId].write(rest)
+        finally:
+            for genomeId in handles:
+                handles[genomeId].close()
+
+        self._log(log.DEBUG, 'Split search results for batch into %d files' %(len(genomeResultFiles)))
+        return genomeResultFiles
+
     def runBlast(self, queryFile):
 
         ''' A simplistic wrapper to search for the query proteins against the subsystem proteins.
+            When the search_program_shards configuration variable is more than one, the
+            query proteins are split into shards that are searched concurrently.
             @param queryFile: Path to fasta file with query proteins
             @return Path to output file from search program
             @raise BlastError when there is a problem running the search program
@@ -128,43 +344,130 @@ class ProbAnnotationWorker:
 
         # Generate path to output file.  Output format 6 is tab-delimited format.
         blastResultFile = os.path.join(self.workFolder, '%s.blastout' %(self.genomeId))
+        start = self._startStage()
+        numShards = int(self.config.get('search_program_shards', '1'))
 
-        # Build the command based on the configured search program.
-        if self.config['search_program'] == 'usearch':
-            args = [ self.config['search_program_path'], '-ublast', queryFile,
-                     '-db', self.dataParser.SearchFiles['protein_udb_file'],
-                     '-evalue', self.config['search_program_evalue'],
-                     '-accel', self.config['usearch_accel'],
-                     '-threads', self.config['search_program_threads'],
-                     '-blast6out', blastResultFile ]
-        else:
-            args = [ self.config['search_program_path'], '-query', queryFile,
-                     '-db', self.dataParser.DataFiles['protein_fasta_file'],
-                     '-outfmt', '6', '-evalue', self.config['search_program_evalue'],
-                     '-num_threads', self.config['search_program_threads'],
-                     '-out', blastResultFile ]
+        # When the hits for all of the proteins are in the hit cache there is nothing to search.
+        if self.hitCacheQueries is not None and self.hitCacheQueries['numSearched'] == 0:
+            open(blastResultFile, 'w').close()
 
-        # Run the command to search for proteins against subsystem proteins.
-        cmd = ' '.join(args)
-        self._log(log.DEBUG, 'Started protein search with command: '+cmd)
-        try:
-            proc = subprocess.Popen(args, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
-            (stdout, stderr) = proc.communicate()
-            if proc.returncode < 0:
-                message = '"%s" was terminated by signal %d' %(args[0], -proc.returncode)
-                raise BlastError(message)
-            else:
-                if proc.returncode > 0:
-                    details = '"%s" failed with return code %d\nCommand: "%s"\nStdout: "%s"\nStderr: "%s"' \
-                        %(args[0], proc.returncode, cmd, stdout, stderr)
-                    raise BlastError(details)
-        except OSError as e:
-            message = 'Failed to run "%s": %s' %(args[0], e.strerror)
-            raise BlastError(message)
-        self._log(log.DEBUG, 'Finished protein search')
+        elif numShards > 1:
+            self._runShardedSearch(queryFile, blastResultFile, numShards)
 
+        else:
+            # Run the command to search for proteins against subsystem proteins.  The output
+            # from the search program is saved in files so the process can be reaped with
+            # wait4() to get its resource usage.
+            args = self._searchCommand(queryFile, blastResultFile)
+            cmd = ' '.join(args)
+            self._log(log.DEBUG, 'Started protein search with command: '+cmd)
+            stdoutFile = os.path.join(self.workFolder, '%s.searchout' %(self.genomeId))
+            stderrFile = os.path.join(self.workFolder, '%s.searcherr' %(self.genomeId))
+            with open(stdoutFile, 'w') as stdoutHandle:
+                with open(stderrFile, 'w') as stderrHandle:
+                    try:
+                        proc = subprocess.Popen(args, stdout = stdoutHandle, stderr = stderrHandle)
+                    except OSError as e:
+                        message = 'Failed to run "%s": %s' %(args[0], e.strerror)
+                        raise BlastError(message)
+            self._waitSearch(proc, args)
+            with open(stdoutFile, 'r') as handle:
+                stdout = handle.read()
+            with open(stderrFile, 'r') as handle:
+                stderr = handle.read()
+            self._checkSearchStatus(args, proc.returncode, stdout, stderr)
+            self._log(log.DEBUG, 'Finished protein search')
+
+        self._mergeCachedHits(blastResultFile)
+        numHits = 0
+        with open(blastResultFile, 'r') as handle:
+            for line in handle:
+                numHits += 1
+        self._finishStage('search', start, numHits)
         return blastResultFile
-    
+
+    def runBlastPipeline(self, queryFile):
+
+        ''' Search for the query proteins and calculate roleset probabilities as the results arrive.
+            The search program writes its results to a pipe instead of a file and the
+            hits for each query are scored as soon as all of them have been read, so
+            scoring overlaps with the search and the full set of hits is never stored.
+            @param queryFile: Path to fasta file with query proteins
+            @return Dictionary keyed by query gene of list of tuples with roleset and likelihood
+                (same as rolesetProbabilitiesMarble())
+            @raise BlastError when there is a problem running the search program
+            @raise BadLikelihoodError when there is math error calculating a likelihood
+            @raise NoTargetIdError when target ID in search results is not found in rolestrings
+        '''
+
+        # The search program writes to standard output.  Standard error goes to a file so
+        # progress messages from the search program do not fill a pipe nobody is reading.
+        args = self._searchCommand(queryFile, None)
+        stderrFile = os.path.join(self.workFolder, '%s.searcherr' %(self.genomeId))
+
+        # Run the command and score each query as its hits are completed.  When the hit cache
+        # is used, the search results for each query are added to the cache as they are read.
+        fidRoleIndex = self._getFidRoleIndex()
+        start = self._startStage()
+        targetIdToRolestringId = dict()
+        rolestringTuples = dict()
+        if self.hitCacheQueries is None or self.hitCacheQueries['numSearched'] > 0:
+            cmd = ' '.join(args)
+            self._log(log.DEBUG, 'Started protein search pipeline with command: '+cmd)
+            with open(stderrFile, 'w') as stderrHandle:
+                try:
+                    proc = subprocess.Popen(args, stdout = subprocess.PIPE, stderr = stderrHandle)
+                except OSError as e:
+                    message = 'Failed to run "%s": %s' %(args[0], e.strerror)
+                    raise BlastError(message)
+                searchOutput = proc.stdout
+                if self.hitCacheQueries is not None:
+                    searchOutput = SearchOutputRecorder(proc.stdout, self._addSearchedHits)
+                try:
+                    for query, targetList in self.dataParser.iterBlastOutput(searchOutput, *self._hitPruning()):
+                        if query in rolestringTuples:
+                            raise BlastError('Hits for query %s from "%s" are not grouped together' %(query, args[0]))
+                        rolestringTuples[query] = self._rolesetLikelihoods(query, targetList, fidRoleIndex, targetIdToRolestringId)
+                except:
+                    proc.kill()
+                    proc.wait()
+                    raise
+                proc.stdout.close()
+                self._waitSearch(proc, args)
+            with open(stderrFile, 'r') as stderrHandle:
+                stderr = stderrHandle.read()
+            self._checkSearchStatus(args, proc.returncode, '', stderr)
+            self._log(log.DEBUG, 'Finished protein search pipeline')
+            if self.hitCacheQueries is not None:
+                # A sequence with no hits is added to the cache with no lines.
+                searchOutput.finish()
+                for seqHash in self.hitCacheQueries['searched']:
+                    if seqHash not in self.hitCacheQueries['pending']:
+                        self.hitCacheQueries['pending'][seqHash] = ''
+                self._putPendingHits()
+
+        # Score the queries with hits from the hit cache.  A query with the same sequence as a
+        # query that was searched has the same likelihoods.
+        if self.hitCacheQueries is not None:
+            for query in self.hitCacheQueries['order']:
+                if query in rolestringTuples:
+                    continue
+                seqHash = self.hitCacheQueries['hashes'][query]
+                if seqHash in self.hitCacheQueries['stored']:
+                    searchedQuery = self.hitCacheQueries['stored'][seqHash]
+                    if searchedQuery in rolestringTuples:
+                        rolestringTuples[query] = list(rolestringTuples[searchedQuery])
+                    continue
+                hits = self.hitCacheQueries['cached'][seqHash]
+                lines = ''.join([ query+'\t'+rest for rest in hits.splitlines(True) ])
+                for query, targetList in self.dataParser.iterBlastOutput(StringIO(lines), *self._hitPruning()):
+                    rolestringTuples[query] = self._rolesetLikelihoods(query, targetList, fidRoleIndex, targetIdToRolestringId)
+
+        self._finishStage('search_marble', start, len(rolestringTuples))
+        self._saveRolesetProbabilities(rolestringTuples)
+        self._log(log.DEBUG, 'Finished marble-picking on %d rolesets for genome %s' %(len(rolestringTuples), self.genomeId))
+        return rolestringTuples
+
     def rolesetProbabilitiesMarble(self, blastResultFile):
 
         ''' Calculate the probabilities of rolesets from the BLAST results.
@@ -182,90 +485,120 @@ class ProbAnnotationWorker:
         '''
 
         self._log(log.DEBUG, 'Started marble-picking on rolesets for genome '+self.genomeId)
+        start = self._startStage()
     
-        # Read in the target roles (this function returns the roles as lists!)
-        targetIdToRole, targetRoleToId = self.dataParser.readFidRoleFile(self.dataParser.DataFiles['otu_fid_role_file'])
-    
-        # Convert the lists of roles into "rolestrings" (sort the list so that order doesn't matter)
-        # in order to deal with the case where some of the hits are multi-functional and others only have
-        # a single function.
-        targetIdToRoleString = dict()
-        for target in targetIdToRole:
-            stri = self.config['separator'].join(sorted(targetIdToRole[target]))
-            targetIdToRoleString[target] = stri
-
-        # Parse the output from BLAST which returns a dictionary keyed by query gene of a list
-        # of tuples with target gene and score.
+        # Get the compiled index of target roles.  The rolestrings in the index are the sorted
+        # lists of roles joined together so that order doesn't matter in order to deal with the
+        # case where some of the hits are multi-functional and others only have a single function.
+        fidRoleIndex = self._getFidRoleIndex()
+
+        # Parse the output from BLAST which returns a hit store keyed by query gene of a list
+        # of tuples with target gene and score.  The target genes are interned as their index
+        # in the compiled index.
         # query --> [ (target1, score 1), (target 2, score 2), ... ]
-        idToTargetList = self.dataParser.parseBlastOutput(blastResultFile)
-    
-        # This is a holder for all of our results which is a dictionary keyed by query gene
-        # of a list of tuples with roleset and likelihood.
-        # query -> [ (roleset1, likelihood_1), (roleset2, likelihood_2), ...]
-        rolestringTuples = dict()
+        idToTargetList = self.dataParser.parseBlastOutput(blastResultFile, fidRoleIndex, *self._hitPruning())
+        if idToTargetList.numDiscarded > 0:
+            self._log(log.DEBUG, 'Threw out %d hits with a negative bit score for genome %s' %(idToTargetList.numDiscarded, self.genomeId))
+        if idToTargetList.numPruned > 0:
+            self._log(log.DEBUG, 'Pruned %d low-scoring hits for genome %s' %(idToTargetList.numPruned, self.genomeId))
 
-        # For each query gene we calculate the likelihood of each possible rolestring
-        # See equation 2 in the paper ("Calculating annotation likelihoods" section).
-        for query in idToTargetList:
-            # First we need to know the maximum score for this gene.
-            # I have no idea why but I'm pretty sure Python is silently turning the second
-            # element of these tuples into strings.  That's why I turn them back to floats.
-            maxscore = 0
-            for tup in idToTargetList[query]:
-                if float(tup[1]) > maxscore:
-                    maxscore = float(tup[1])
-    
-            # Now we calculate the cumulative squared scores for each possible rolestring.
-            # This along with pseudocount*maxscore is equivalent to multiplying all scores
-            # by themselves and then dividing by the max score.
-            # This is done to avoid some pathological cases and give more weight to higher-scoring hits
-            # and not let much lower-scoring hits \ noise drown them out.
-            # Build a dictionary keyed by rolestring of the sum of squares of the log-scores.
-            rolestringToScore = dict()
-            for tup in idToTargetList[query]:
-                try:
-                    rolestring = targetIdToRoleString[tup[0]]
-                except KeyError:
-                    message = 'Target id %s from search results file had no roles in rolestring dictionary' %(tup[0])
-                    raise NoTargetIdError(message)
-                if rolestring in rolestringToScore:
-                    rolestringToScore[rolestring] += (float(tup[1]) ** 2)
-                else:
-                    rolestringToScore[rolestring] = (float(tup[1]) ** 2)
-    
-            # Calculate the likelihood that this gene has the given functional annotation.
-            # Start with the denominator which is the sum of squares of the log-scores for
-            # all possible rolestrings.
-            denom = float(self.config['pseudo_count']) * maxscore
-            for stri in rolestringToScore:
-                denom += rolestringToScore[stri]
-            if math.isnan(denom):
-                message = 'Denominator in likelihood calculation for gene %s is NaN %f' %(query, denom)
-                raise BadLikelihoodError(message)
+        rolestringTuples = self.rolesetProbabilitiesFromHits(idToTargetList)
+        self._finishStage('marble', start, len(rolestringTuples))
 
-            # The numerators are the sum of squares for each rolestring.
-            # Calculate the likelihood for each rolestring and store in the output dictionary.
-            for stri in rolestringToScore:
-                p = rolestringToScore[stri] / denom
-                if math.isnan(p):
-                    message = 'Likelihood for rolestring %s in gene %s is NaN based on score %f' %(stri, query, rolestringToScore[stri])
-                    raise BadLikelihoodError(message)
-                if query in rolestringTuples:
-                    rolestringTuples[query].append( (stri, p) )
-                else:
-                    rolestringTuples[query] = [ (stri, p) ]
-    
         # Save the generated data when debug is turned on.
-        if self.logger.get_log_level() >= log.DEBUG2:
-            rolesetProbabilityFile = os.path.join(self.workFolder, '%s.rolesetprobs' %(self.genomeId))
-            with open(rolesetProbabilityFile, 'w') as handle:
-                for query in sorted(rolestringTuples):
-                    for tup in rolestringTuples[query]:
-                        handle.write('%s\t%1.6f\t%s\n' %(query, tup[1], tup[0]))
+        self._saveRolesetProbabilities(rolestringTuples)
             
         self._log(log.DEBUG, 'Finished marble-picking on %d rolesets for genome %s' %(len(rolestringTuples), self.genomeId))
         return rolestringTuples
             
+    def rolesetProbabilitiesFromHits(self, hits, useArrays=True):
+        ''' Calculate the probabilities of rolesets from parsed search results.
+            @param hits: ProbAnnotationHitStore object with hits for each query (as returned by
+                ProbAnnotationParser.parseBlastOutput())
+            @param useArrays: When True, use the array-backed calculations when numpy is available
+                (False to use the pure Python calculations for checking and timing)
+            @return Dictionary (or RolesetLikelihoodStore object) keyed by query gene of list of
+                tuples with roleset and likelihood in order of rolestring ID
+            @raise BadLikelihoodError when there is math error calculating a likelihood
+            @raise NoTargetIdError when target ID in search results is not found in rolestrings
+        '''
+
+        fidRoleIndex = self._getFidRoleIndex()
+
+        # Use the array-backed calculations when numpy is available.
+        if useArrays and ProbAnnotationEngine.NUMPY_AVAILABLE:
+            return self._rolesetLikelihoodsFromArrays(hits, fidRoleIndex)
+
+        # This is a holder for all of our results which is a dictionary keyed by query gene
+        # of a list of tuples with roleset and likelihood.
+        # query -> [ (roleset1, likelihood_1), (roleset2, likelihood_2), ...]
+        rolestringTuples = dict()
+        targetIdToRolestringId = dict()
+        for query in hits:
+            rolestringTuples[query] = self._rolesetLikelihoods(query, hits[query], fidRoleIndex, targetIdToRolestringId)
+        return rolestringTuples
+
+    def incrementalRoleProbabilities(self, features, stream=False):
+
+        ''' Calculate the role probabilities for a genome, only searching for the proteins
+            that are new or changed since the genome was last annotated.
+            The roleset and role likelihoods for each protein are saved by feature ID and
+            sequence hash.  All of the saved results for a genome are discarded when the
+            static database files or the algorithm parameters change.
+            @param features: List or generator of features with protein sequences
+            @param stream: True to score the search results as they are produced
+            @return List of tuples with query gene, role, and likelihood (same as
+                rolesetProbabilitiesToRoleProbabilities())
+            @raise NoFeaturesError when list of features is empty
+        '''
+
+        # Find the proteins with saved results that can be used again.
+        self._openDatabaseFiles()
+        resultsKey = ':'.join([ self._searchDatabaseKey(), self.dataParser.fidRoleChecksum(),
+                                self.config['pseudo_count'], self.config['separator'] ] + [ str(value) for value in self._hitPruning() ])
+        savedGenes = dict()
+        savedResults = self.dataParser.readGeneResults(self.genomeId)
+        if savedResults is not None and savedResults['key'] == resultsKey:
+            savedGenes = savedResults['genes']
+        geneResults = dict()
+        changedFeatures = list()
+        for feature in self._requireFeatures(features, self.genomeId):
+            # Not a protein-encoding gene
+            if 'protein_translation' not in feature:
+                continue
+            seqHash = sequenceHash(feature['protein_translation'])
+            if feature['id'] in savedGenes and savedGenes[feature['id']][0] == seqHash:
+                geneResults[feature['id']] = savedGenes[feature['id']]
+            else:
+                changedFeatures.append( (feature, seqHash) )
+        self._log(log.INFO, 'Found saved results for %d of %d proteins in genome %s' \
+                  %(len(geneResults), len(geneResults) + len(changedFeatures), self.genomeId))
+
+        # Search for the new and changed proteins and save the results for every protein.
+        if len(changedFeatures) > 0:
+            fastaFile = self.genomeToFasta([ feature for feature, seqHash in changedFeatures ])
+            if stream:
+                rolestringTuples = self.runBlastPipeline(fastaFile)
+            else:
+                rolestringTuples = self.rolesetProbabilitiesMarble(self.runBlast(fastaFile))
+            roleTuples = dict()
+            for query, role, likelihood in self.rolesetProbabilitiesToRoleProbabilities(rolestringTuples):
+                if query in roleTuples:
+                    roleTuples[query].append( (role, likelihood) )
+                else:
+                    roleTuples[query] = [ (role, likelihood) ]
+            for feature, seqHash in changedFeatures:
+                geneResults[feature['id']] = (seqHash, rolestringTuples.get(feature['id'], []), roleTuples.get(feature['id'], []))
+        if len(changedFeatures) > 0 or len(geneResults) != len(savedGenes):
+            self.dataParser.writeGeneResults(self.genomeId, resultsKey, geneResults)
+
+        # Merge the role likelihoods for all of the proteins.
+        roleProbs = list()
+        for fid in geneResults:
+            for role, likelihood in geneResults[fid][2]:
+                roleProbs.append( (fid, role, likelihood) )
+        return roleProbs
+
     def rolesetProbabilitiesToRoleProbabilities(self, queryToTuplist):
         ''' Compute probability of each role from the rolesets for each query protein.
             At the moment the strategy is to take any set of rolestrings containing
@@ -281,10 +614,15 @@ class ProbAnnotationWorker:
         '''
 
         self._log(log.DEBUG, 'Started computing role probabilities for genome '+self.genomeId)
+        start = self._startStage()
 
         # Start with an empty list.
         roleProbs = list()
 
+        # The roles in the rolestrings from the compiled index are already known.  Other
+        # rolestrings (e.g. from saved results) are only split the first time they are seen.
+        rolestringRoles = self.rolestringRoles
+
         # Iterate over all of the query genes in the dictionary.
         # querygene -> [ (roleset1, likelihood_1), (roleset2, likelihood_2), ...]
         for query in queryToTuplist:
@@ -292,7 +630,11 @@ class ProbAnnotationWorker:
             # See equation 3 in the paper ("Calculating reaction likelihoods" section).
             queryRolesToProbs = dict()
             for tup in queryToTuplist[query]:
-                rolelist = tup[0].split(self.config['separator'])
+                try:
+                    rolelist = rolestringRoles[tup[0]]
+                except KeyError:
+                    rolelist = tup[0].split(self.config['separator'])
+                    rolestringRoles[tup[0]] = rolelist
                 # Add up all the instances of each particular role on the list.
                 for role in rolelist:
                     if role in queryRolesToProbs:
@@ -303,6 +645,7 @@ class ProbAnnotationWorker:
             # Add them to the array.
             for role in queryRolesToProbs:
                 roleProbs.append( (query, role, queryRolesToProbs[role]) )
+        self._finishStage('role', start, len(roleProbs))
 
         # Save the generated data when debug is turned on.
         if self.logger.get_log_level() >= log.DEBUG2:
@@ -326,48 +669,23 @@ class ProbAnnotationWorker:
             role the maximum likelihood and the estimated set of genes that perform that
             role are linked with an OR relationship to form a Boolean Gene-Function
             relationship.
-            @param roleProbs List of tuples with query gene, role, and likelihood
+            The tuples are aggregated in one pass so they can come from a generator.
+            @param roleProbs Iterable of tuples with query gene, role, and likelihood
             @return List of tuples with role, likelihood, and estimated set of genes that perform the role
-            @raise RoleNotFoundError when role is not placed properly in roleToTotalProb dictionary
         '''
 
         self._log(log.DEBUG, 'Started generating whole-cell role probabilities for genome '+self.genomeId)
 
-        # Find maximum likelihood among all query genes for each role.
-        # This is assumed to be the likelihood of that role occurring in the organism as a whole.
-        roleToTotalProb = dict()
-        for tuple in roleProbs:
-            if tuple[1] in roleToTotalProb:
-                if float(tuple[2]) > roleToTotalProb[tuple[1]]:
-                    roleToTotalProb[tuple[1]] = float(tuple[2])
-            else:
-                roleToTotalProb[tuple[1]] = float(tuple[2])
-
-        # Get the genes within DILUTION_PERCENT percent of the maximum
-        # likelihood and assert that these are the most likely genes responsible for that role.
-        # (note - DILUTION_PERCENT is defined in the config file)
-        # This produces a dictionary from role to a list of genes
+        # Find maximum likelihood among all query genes for each role.  This is assumed to be
+        # the likelihood of that role occurring in the organism as a whole.  The genes within
+        # DILUTION_PERCENT percent of the maximum likelihood are the most likely genes
+        # responsible for that role.
         # See equation 4 in the paper ("Calculating reaction likelihoods" section).
-        roleToGeneList = dict()
-        for tuple in roleProbs:
-            if tuple[1] not in roleToTotalProb:
-                message = 'Role %s not placed properly in roleToTotalProb dictionary?' %(tuple[1])
-                self._log(log.ERR, message)
-                raise RoleNotFoundError(message)
-            if float(tuple[2]) >= float(self.config['dilution_percent'])/100.0 * roleToTotalProb[tuple[1]]:
-                if tuple[1] in roleToGeneList:
-                    roleToGeneList[tuple[1]].append(tuple[0])
-                else:
-                    roleToGeneList[tuple[1]] = [ tuple[0] ]
-
-        # Build the array of total role probabilities.
-        totalRoleProbs = list()
-        for role in roleToTotalProb:
-            gpr = ' or '.join(sorted(list(set(roleToGeneList[role]))))
-            # We only need to group these if there is more than one of them (avoids extra parenthesis when computing complexes)
-            if len(list(set(roleToGeneList[role]))) > 1:
-                gpr = '(' + gpr + ')'
-            totalRoleProbs.append( (role, roleToTotalProb[role], gpr ) )
+        start = self._startStage()
+        aggregator = RoleProbabilityAggregator(self.config['dilution_percent'])
+        aggregator.addAll(roleProbs)
+        totalRoleProbs = aggregator.totalRoleProbabilities()
+        self._finishStage('total_role', start, len(totalRoleProbs))
 
         # Save the generated data when debug is turned on.
         if self.logger.get_log_level() >= log.DEBUG2:
@@ -410,6 +728,7 @@ class ProbAnnotationWorker:
         '''
 
         self._log(log.DEBUG, 'Started computing complex probabilities for '+self.genomeId)
+        start = self._startStage()
 
         # Get the mapping from complexes to roles if it isn't already provided.
         if complexesToRequiredRoles is None:
@@ -417,11 +736,7 @@ class ProbAnnotationWorker:
             self._log(log.DEBUG, 'Found %d complex to role mappings in %s' %(len(complexesToRequiredRoles), self.dataParser.DataFiles['complex_role_file']))
 
         # Get the subsystem roles (used to distinguish between NOTTHERE and NOREPS).
-        otu_fidsToRoles, otu_rolesToFids = self.dataParser.readFidRoleFile(self.dataParser.DataFiles['otu_fid_role_file'])
-        allroles = set()
-        for fid in otu_fidsToRoles:
-            for role in otu_fidsToRoles[fid]:
-                allroles.add(role)
+        allroles = self._getFidRoleIndex().allRoles()
 
         # Build two dictionaries, both keyed by role, one mapping the role to its
         # likelihood and one mapping to the gene list.
@@ -494,6 +809,7 @@ class ProbAnnotationWorker:
                 for tuple in sorted(complexProbs):
                     handle.write("%s\t%1.6f\t%s\t%s\t%s\t%s\n" %(tuple[0], tuple[1], tuple[2], tuple[5], tuple[3], tuple[4]))
 
+        self._finishStage('complex', start, len(complexProbs))
         self._log(log.DEBUG, 'Finished computing complex probabilities for '+self.genomeId)
         return complexProbs
 
@@ -516,6 +832,7 @@ class ProbAnnotationWorker:
         '''
 
         self._log(log.DEBUG, 'Started computing reaction probabilities for '+self.genomeId)
+        start = self._startStage()
 
         # Build a dictionary keyed by complex ID of tuples with likelihood, type, and GPR.
         # Note we don't need to use the list of roles not in organism and list of roles
@@ -567,6 +884,7 @@ class ProbAnnotationWorker:
 
             # Add everything to the final list.
             reactionProbs.append( [rxn+self.communityIndex, maxProb, TYPE, complexString, GPR] )
+        self._finishStage('reaction', start, len(reactionProbs))
 
         # Save the generated data when debug is turned on.
         if self.logger.get_log_level() >= log.DEBUG2:
@@ -578,11 +896,783 @@ class ProbAnnotationWorker:
         self._log(log.DEBUG, 'Finished computing reaction probabilities for '+self.genomeId)
         return reactionProbs
 
+    def _searchCommand(self, queryFile, blastResultFile, threads=None):
+        ''' Build the command to run the configured search program.
+            @param queryFile: Path to fasta file with query proteins
+            @param blastResultFile: Path to output file from search program or None to write
+                the output to standard output
+            @param threads: Number of threads for search program or None to use the
+                search_program_threads configuration variable
+            @return List of arguments for command
+        '''
+
+        self._openDatabaseFiles()
+        if threads is None:
+            threads = self.config['search_program_threads']
+        if self.config['search_program'] == 'usearch':
+            if blastResultFile is None:
+                blastResultFile = '/dev/stdout'
+            args = [ self.config['search_program_path'], '-ublast', queryFile,
+                     '-db', self.dataParser.SearchFiles['protein_udb_file'],
+                     '-evalue', self.config['search_program_evalue'],
+                     '-accel', self.config['usearch_accel'],
+                     '-threads', threads,
+                     '-blast6out', blastResultFile ]
+        else:
+            args = [ self.config['search_program_path'], '-query', queryFile,
+                     '-db', self.dataParser.DataFiles['protein_fasta_file'],
+                     '-outfmt', '6', '-evalue', self.config['search_program_evalue'],
+                     '-num_threads', threads ]
+            if blastResultFile is not None:
+                args += [ '-out', blastResultFile ]
+        return args
+
+    def _splitQueryFile(self, queryFile, numShards):
+        ''' Split a fasta file with query proteins into shards with about the same number of residues.
+            Each protein is assigned to the shard with the fewest residues, starting with the
+            longest protein.  The proteins in a shard are in the same order as the input file.
+            @param queryFile: Path to fasta file with query proteins
+            @param numShards: Maximum number of shards
+            @return List of paths to fasta files for the shards (there are fewer shards than
+                requested when there are fewer proteins)
+        '''
+
+        # Read the proteins from the fasta file.
+        proteins = list()
+        with open(queryFile, 'r') as handle:
+            for line in handle:
+                if line.startswith('>'):
+                    proteins.append( [ line, 0 ] )
+                elif len(proteins) > 0:
+                    proteins[-1][0] += line
+                    proteins[-1][1] += len(line.strip())
+        numShards = min(numShards, len(proteins))
+
+        # Assign each protein to a shard.
+        shardResidues = [ 0 ] * numShards
+        shardProteins = [ list() for index in range(numShards) ]
+        for index in sorted(range(len(proteins)), key=lambda index: proteins[index][1], reverse=True):
+            shard = shardResidues.index(min(shardResidues))
+            shardResidues[shard] += proteins[index][1]
+            shardProteins[shard].append(index)
+
+        # Write the fasta file for each shard.
+        shardFiles = list()
+        for shard in range(numShards):
+            shardFiles.append(os.path.join(self.workFolder, '%s.shard%d.faa' %(self.genomeId, shard)))
+            with open(shardFiles[-1], 'w') as handle:
+                for index in sorted(shardProteins[shard]):
+                    handle.write(proteins[index][0])
+        self._log(log.DEBUG, 'Split %d protein sequences into %d shards with %s residues' \
+                  %(len(proteins), numShards, ','.join([ str(r) for r in shardResidues ])))
+        return shardFiles
+
+    def _runShardedSearch(self, queryFile, blastResultFile, numShards):
+        ''' Search for the query proteins with concurrent search processes on shards of the proteins.
+            The output files from the shards are merged in shard order so the merged results
+            are always in the same order for the same query file.
+            @param queryFile: Path to fasta file with query proteins
+            @param blastResultFile: Path to merged output file
+            @param numShards: Number of shards
+            @return Nothing
+            @raise BlastError when there is a problem running the search program
+        '''
+
+        shardFiles = self._splitQueryFile(queryFile, numShards)
+        threads = self.config.get('search_program_shard_threads', self.config['search_program_threads'])
+
+        # Start a search process for each shard.  The messages from the search program are
+        # saved in a file so a process does not block on a full pipe.
+        shards = list()
+        self._log(log.DEBUG, 'Started protein search on %d shards with %s threads per shard' %(len(shardFiles), threads))
+        try:
+            for index in range(len(shardFiles)):
+                outputFile = os.path.join(self.workFolder, '%s.shard%d.blastout' %(self.genomeId, index))
+                messageFile = os.path.join(self.workFolder, '%s.shard%d.searchout' %(self.genomeId, index))
+                args = self._searchCommand(shardFiles[index], outputFile, threads)
+                self._log(log.DEBUG2, 'Started search on shard %d with command: %s' %(index, ' '.join(args)))
+                with open(messageFile, 'w') as handle:
+                    try:
+                        proc = subprocess.Popen(args, stdout = handle, stderr = subprocess.STDOUT)
+                    except OSError as e:
+                        message = 'Failed to run "%s": %s' %(args[0], e.strerror)
+                        raise BlastError(message)
+                shards.append( (args, proc, outputFile, messageFile) )
+
+            # Wait for all of the search processes and check the status of each one.
+            for args, proc, outputFile, messageFile in shards:
+                self._waitSearch(proc, args)
+            for args, proc, outputFile, messageFile in shards:
+                with open(messageFile, 'r') as handle:
+                    messages = handle.read()
+                self._checkSearchStatus(args, proc.returncode, messages, '')
+        except:
+            for args, proc, outputFile, messageFile in shards:
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+            raise
+
+        # Merge the output files in shard order.
+        with open(blastResultFile, 'w') as handle:
+            for args, proc, outputFile, messageFile in shards:
+                if os.path.exists(outputFile):
+                    with open(outputFile, 'r') as shardHandle:
+                        shutil.copyfileobj(shardHandle, handle)
+        self._log(log.DEBUG, 'Finished protein search on %d shards' %(len(shards)))
+        return
+
+    def _startHitCacheQueries(self):
+        ''' Start tracking the queries written to a fasta file when the hit cache is enabled.
+            @return Nothing
+        '''
+
+        if float(self.config.get('hit_cache_size', '0')) > 0:
+            # Queries in order, sequence hash of each query, hits for each sequence from the
+            # cache, query that is searched for each sequence not in the cache, and number of
+            # queries that are searched.  When the search results are read from a pipe, the
+            # hits for searched sequences waiting to be added to the cache, their size, and
+            # the query for each searched sequence already added to the cache.
+            self.hitCacheQueries = { 'order': list(), 'hashes': dict(), 'cached': dict(), 'searched': dict(), 'numSearched': 0,
+                                     'pending': dict(), 'pendingBytes': 0, 'stored': dict() }
+        else:
+            self.hitCacheQueries = None
+        return
+
+    def _getHitCache(self):
+        ''' Get the hit cache, opening it the first time it is needed.
+            The cache is keyed by the checksum of the search database and the search parameters
+            so the cached hits are removed when the search database changes.
+            @return ProbAnnotationHitCache object
+        '''
+
+        if self.hitCache is None:
+            self._openDatabaseFiles()
+            filename = self.config.get('hit_cache_file', os.path.join(self.config['data_dir'], 'hitcache.db'))
+            maxBytes = float(self.config['hit_cache_size']) * 1024 * 1024
+            self.hitCache = ProbAnnotationHitCache(filename, self._searchDatabaseKey(), maxBytes)
+        return self.hitCache
+
+    def _hitPruning(self):
+        ''' Get the settings for pruning low-scoring hits for each query.
+            Pruned hits add very little to the likelihoods because the scores are squared.
+            @return Tuple with maximum number of hits to keep for a query (0 for no limit),
+                minimum fraction of the maximum score for a query (0 for no limit), and
+                largest change in a likelihood allowed from pruning
+        '''
+
+        return int(self.config.get('hit_top_k', '0')), float(self.config.get('hit_min_relative_score', '0')), \
+            float(self.config.get('hit_max_likelihood_change', repr(DEFAULT_MAX_LIKELIHOOD_CHANGE)))
+
+    def _searchDatabaseKey(self):
+        ''' Build the key that identifies the search database and the search parameters.
+            @return Key string
+        '''
+
+        return ':'.join([ self.dataParser.searchDatabaseChecksum(), self.config['search_program'],
+                          self.config['search_program_evalue'], self.config.get('usearch_accel', '') ])
+
+    def _storeSearchedHits(self, linesByQuery):
+        ''' Add the search results for the sequences that were searched to the hit cache.
+            @param linesByQuery: Dictionary keyed by query ID of list of search results lines
+                without the query ID field
+            @return Nothing
+        '''
+
+        hitsBySequence = dict()
+        for seqHash, query in self.hitCacheQueries['searched'].iteritems():
+            hitsBySequence[seqHash] = ''.join(linesByQuery.get(query, []))
+        if len(hitsBySequence) == 0:
+            return
+        self._getHitCache().put(hitsBySequence)
+        self.hitCacheQueries['cached'].update(hitsBySequence)
+        self.hitCacheQueries['searched'] = dict()
+        self._log(log.DEBUG, 'Added hits for %d protein sequences to hit cache' %(len(hitsBySequence)))
+        return
+
+    def _addSearchedHits(self, query, lines):
+        ''' Add the search results for a query read from a pipe to the hit cache.
+            The lines are collected with the lines for other queries and added to the cache
+            when HIT_CACHE_BATCH_BYTES is reached so the search results are not kept in memory
+            until the search is finished.
+            @param query: Query ID
+            @param lines: List of search results lines without the query ID field
+            @return Nothing
+        '''
+
+        seqHash = self.hitCacheQueries['hashes'].get(query)
+        if seqHash is None or self.hitCacheQueries['searched'].get(seqHash) != query:
+            return
+        hits = ''.join(lines)
+        self.hitCacheQueries['pending'][seqHash] = hits
+        self.hitCacheQueries['pendingBytes'] += len(hits)
+        if self.hitCacheQueries['pendingBytes'] >= HIT_CACHE_BATCH_BYTES:
+            self._putPendingHits()
+        return
+
+    def _putPendingHits(self):
+        ''' Add the search results waiting in the pending batch to the hit cache.
+            @return Nothing
+        '''
+
+        pending = self.hitCacheQueries['pending']
+        if len(pending) == 0:
+            return
+        self._getHitCache().put(pending)
+        for seqHash in pending:
+            self.hitCacheQueries['stored'][seqHash] = self.hitCacheQueries['searched'].pop(seqHash)
+        self.hitCacheQueries['pending'] = dict()
+        self.hitCacheQueries['pendingBytes'] = 0
+        self._log(log.DEBUG, 'Added hits for %d protein sequences to hit cache' %(len(pending)))
+        return
+
+    def _mergeCachedHits(self, blastResultFile):
+        ''' Merge the hits from the hit cache with the search results.
+            The hits for the sequences that were searched are added to the hit cache and
+            the output file is rewritten with the hits for every query in fasta file order.
+            @param blastResultFile: Path to output file from search program
+            @return Nothing
+        '''
+
+        if self.hitCacheQueries is None:
+            return
+        linesByQuery = dict()
+        with open(blastResultFile, 'r') as handle:
+            for line in handle:
+                query, sep, rest = line.partition('\t')
+                if query in linesByQuery:
+                    linesByQuery[query].append(rest)
+                else:
+                    linesByQuery[query] = [ rest ]
+        self._storeSearchedHits(linesByQuery)
+        with open(blastResultFile, 'w') as handle:
+            for query in self.hitCacheQueries['order']:
+                hits = self.hitCacheQueries['cached'][self.hitCacheQueries['hashes'][query]]
+                for rest in hits.splitlines(True):
+                    handle.write(query+'\t'+rest)
+        return
+
+    def _waitSearch(self, proc, args):
+        ''' Wait for a search process to finish and record its resource usage.
+            The process is reaped with wait4() and the return code is saved in the Popen
+            object the same way as Popen.wait().
+            @param proc: Popen object for search process
+            @param args: List of arguments for command
+            @return Return code from search program
+        '''
+
+        while True:
+            try:
+                pid, status, usage = os.wait4(proc.pid, 0)
+                break
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+        self.metrics['search_processes'].append({ 'genome_id': self.genomeId, 'program': os.path.basename(args[0]),
+            'user_time': usage.ru_utime, 'system_time': usage.ru_stime, 'max_rss_kb': usage.ru_maxrss,
+            'returncode': proc.returncode })
+        return proc.returncode
+
+    def _checkSearchStatus(self, args, returncode, stdout, stderr):
+        ''' Check the return code from running the search program.
+            @param args: List of arguments for command
+            @param returncode: Return code from search program
+            @param stdout: Output from search program
+            @param stderr: Error output from search program
+            @return Nothing
+            @raise BlastError when the search program failed
+        '''
+
+        if returncode < 0:
+            message = '"%s" was terminated by signal %d' %(args[0], -returncode)
+            raise BlastError(message)
+        else:
+            if returncode > 0:
+                details = '"%s" failed with return code %d\nCommand: "%s"\nStdout: "%s"\nStderr: "%s"' \
+                    %(args[0], returncode, ' '.join(args), stdout, stderr)
+                raise BlastError(details)
+        return
+
+    def _rolesetLikelihoods(self, query, targetList, fidRoleIndex, targetIdToRolestringId):
+        ''' Calculate the likelihood of each possible rolestring for one query gene.
+            See equation 2 in the paper ("Calculating annotation likelihoods" section).
+            @param query: Query gene ID
+            @param targetList: List of tuples with target gene and score
+            @param fidRoleIndex: ProbAnnotationIndex object for looking up rolestrings
+            @param targetIdToRolestringId: Dictionary of rolestring IDs for targets already looked up
+            @return List of tuples with roleset and likelihood in order of rolestring ID
+            @raise BadLikelihoodError when there is math error calculating a likelihood
+            @raise NoTargetIdError when target ID in search results is not found in rolestrings
+        '''
+
+        # First we need to know the maximum score for this gene.
+        # I have no idea why but I'm pretty sure Python is silently turning the second
+        # element of these tuples into strings.  That's why I turn them back to floats.
+        maxscore = 0
+        for tup in targetList:
+            if float(tup[1]) > maxscore:
+                maxscore = float(tup[1])
+
+        # Now we calculate the cumulative squared scores for each possible rolestring.
+        # This along with pseudocount*maxscore is equivalent to multiplying all scores
+        # by themselves and then dividing by the max score.
+        # This is done to avoid some pathological cases and give more weight to higher-scoring hits
+        # and not let much lower-scoring hits \ noise drown them out.
+        # Build a dictionary keyed by rolestring ID of the sum of squares of the log-scores.
+        rolestringToScore = dict()
+        for tup in targetList:
+            try:
+                rolestringId = targetIdToRolestringId[tup[0]]
+            except KeyError:
+                rolestringId = fidRoleIndex.rolestringId(tup[0])
+                if rolestringId is None:
+                    message = 'Target id %s from search results file had no roles in rolestring dictionary' %(tup[0])
+                    raise NoTargetIdError(message)
+                targetIdToRolestringId[tup[0]] = rolestringId
+            if rolestringId in rolestringToScore:
+                rolestringToScore[rolestringId] += (float(tup[1]) ** 2)
+            else:
+                rolestringToScore[rolestringId] = (float(tup[1]) ** 2)
+
+        # Calculate the likelihood that this gene has the given functional annotation.
+        # Start with the denominator which is the sum of squares of the log-scores for
+        # all possible rolestrings.  The rolestrings are always used in order of rolestring
+        # ID so the sum is the same value as from _rolesetLikelihoodsFromArrays().
+        rolestringIds = sorted(rolestringToScore)
+        denom = float(self.config['pseudo_count']) * maxscore
+        for rolestringId in rolestringIds:
+            denom += rolestringToScore[rolestringId]
+        if math.isnan(denom):
+            message = 'Denominator in likelihood calculation for gene %s is NaN %f' %(query, denom)
+            raise BadLikelihoodError(message)
+
+        # The numerators are the sum of squares for each rolestring.
+        # Calculate the likelihood for each rolestring and store in the output list.
+        tuples = list()
+        for rolestringId in rolestringIds:
+            stri = self._rolestring(fidRoleIndex, rolestringId)
+            p = rolestringToScore[rolestringId] / denom
+            if math.isnan(p):
+                message = 'Likelihood for rolestring %s in gene %s is NaN based on score %f' %(stri, query, rolestringToScore[rolestringId])
+                raise BadLikelihoodError(message)
+            tuples.append( (stri, p) )
+        return tuples
+
+    def _rolesetLikelihoodsFromArrays(self, hits, fidRoleIndex):
+        ''' Calculate the likelihood of each possible rolestring for all query genes with arrays.
+            The maximum scores, the sums of squared scores, the denominators, and the
+            likelihoods are calculated with grouped reductions over all of the hits.  The
+            tuples for a query are in order of rolestring ID and the values are exactly the
+            same as from _rolesetLikelihoods().
+            @param hits: ProbAnnotationHitStore object with hits for each query (as returned by
+                ProbAnnotationParser.parseBlastOutput())
+            @param fidRoleIndex: ProbAnnotationIndex object for looking up rolestrings
+            @return RolesetLikelihoodStore object mapping query gene to list of tuples with
+                roleset and likelihood
+            @raise BadLikelihoodError when there is math error calculating a likelihood
+            @raise NoTargetIdError when target ID in search results is not found in rolestrings
+        '''
+
+        # Look up the rolestring for each target.
+        queries = hits.queries
+        targetRolestringIds = hits.targetRolestringIds(fidRoleIndex)
+        if min(targetRolestringIds or [ 0 ]) < 0:
+            targetIndex = list(targetRolestringIds).index(-1)
+            message = 'Target id %s from search results file had no roles in rolestring dictionary' %(hits.targetId(targetIndex))
+            raise NoTargetIdError(message)
+
+        # Calculate the maximum score for each query, the sum of squares of the scores for
+        # each (query, rolestring) pair, and the likelihood of each pair.
+        maxScores, pairOffsets, pairRolestrings, pairScores = \
+            ProbAnnotationEngine.rolesetScores(hits.queryOffsets, hits.targetIndices, hits.scores, targetRolestringIds)
+        denominators, likelihoods = \
+            ProbAnnotationEngine.rolesetLikelihoods(maxScores, pairOffsets, pairScores, float(self.config['pseudo_count']))
+
+        # Look up the rolestrings used by the pairs.
+        rolestringIds, pairKeys = ProbAnnotationEngine.uniqueValues(pairRolestrings)
+        keyRolestrings = [ self._rolestring(fidRoleIndex, rolestringId) for rolestringId in rolestringIds.tolist() ]
+
+        badDenominators = ProbAnnotationEngine.nanPositions(denominators)
+        if len(badDenominators) > 0:
+            queryIndex = badDenominators[0]
+            message = 'Denominator in likelihood calculation for gene %s is NaN %f' %(queries[queryIndex], denominators[queryIndex])
+            raise BadLikelihoodError(message)
+        badLikelihoods = ProbAnnotationEngine.nanPositions(likelihoods)
+        if len(badLikelihoods) > 0:
+            pair = badLikelihoods[0]
+            queryIndex = bisect.bisect_right(pairOffsets.tolist(), pair) - 1
+            message = 'Likelihood for rolestring %s in gene %s is NaN based on score %f' \
+                %(keyRolestrings[pairKeys[pair]], queries[queryIndex], pairScores[pair])
+            raise BadLikelihoodError(message)
+
+        return ProbAnnotationEngine.RolesetLikelihoodStore(queries, pairOffsets, keyRolestrings, pairKeys, likelihoods)
+
+    def _saveRolesetProbabilities(self, rolestringTuples):
+        ''' Save the roleset probabilities to a file in the work folder when debug is turned on.
+            @param rolestringTuples: Dictionary keyed by query gene of list of tuples with roleset and likelihood
+            @return Nothing
+        '''
+
+        if self.logger.get_log_level() >= log.DEBUG2:
+            rolesetProbabilityFile = os.path.join(self.workFolder, '%s.rolesetprobs' %(self.genomeId))
+            with open(rolesetProbabilityFile, 'w') as handle:
+                for query in sorted(rolestringTuples):
+                    for tup in rolestringTuples[query]:
+                        handle.write('%s\t%1.6f\t%s\n' %(query, tup[1], tup[0]))
+        return
+
+    def _complexGpr(self, template, cplx, numAvailable, rolesToGeneList, allroles):
+        ''' Build the Boolean Gene-Protein relationship for a complex in a compiled template.
+            The individual functions in the complex are linked with an AND relationship.
+            @param template: CompiledTemplate object
+            @param cplx: Index of complex in template
+            @param numAvailable: Number of roles in complex found in organism
+            @param rolesToGeneList: Dictionary keyed by role of gene list for role
+            @param allroles: Set of roles in the subsystems
+            @return Gene-Protein relationship string
+        '''
+
+        if numAvailable == 0:
+            return ''
+        roles = [ template.roles[roleId] for roleId in template.complexRoles(cplx) ]
+        partialGprList = [ rolesToGeneList[f] for f in roles if f in allroles and f in rolesToGeneList ]
+        GPR = " and ".join( list(set(partialGprList)) )
+        if GPR != "" and len(list(set(partialGprList))) > 1:
+            GPR = "(" + GPR + ")"
+        return GPR
+
+    def _openDatabaseFiles(self):
+        ''' Make sure the static database files are ready the first time they are needed.
+            This is fast when "ms-probanno-data warmup" has published the ready file.  If the
+            files do not exist and they are downloaded from Shock, it can take a few minutes
+            before they are ready.
+            @return Nothing
+        '''
+
+        if not self.dataReady:
+            self.dataParser.openDatabaseFiles(self.logger, '')
+            self.dataReady = True
+        return
+
+    def _rolestring(self, fidRoleIndex, rolestringId):
+        ''' Get the rolestring for a rolestring ID from the compiled index.
+            The roles in the rolestring are saved so the rolestring does not need to be
+            split when calculating role probabilities.
+            @param fidRoleIndex: ProbAnnotationIndex object for looking up rolestrings
+            @param rolestringId: Rolestring ID
+            @return Sorted role names joined with the separator
+        '''
+
+        try:
+            return self.rolestrings[rolestringId]
+        except KeyError:
+            roles = [ fidRoleIndex.role(roleId) for roleId in fidRoleIndex.rolestringRoles(rolestringId) ]
+            rolestring = self.config['separator'].join(roles)
+            self.rolestrings[rolestringId] = rolestring
+            self.rolestringRoles[rolestring] = roles
+            return rolestring
+
+    def _getFidRoleIndex(self):
+        ''' Get the compiled feature ID to role index.
+            The index built by "ms-probanno-data builddb" is used when it is current.
+            Otherwise an index is compiled from the feature ID to role file in the
+            work folder.
+            @return ProbAnnotationIndex object
+        '''
+
+        if self.fidRoleIndex is None:
+            self._openDatabaseFiles()
+            if self.dataParser.isFidRoleIndexCurrent():
+                indexFile = self.dataParser.IndexFiles['otu_fid_role_index_file']
+            else:
+                self._log(log.NOTICE, 'Compiled index for %s is missing or out of date, run "ms-probanno-data builddb"' \
+                          %(self.dataParser.DataFiles['otu_fid_role_file']))
+                indexFile = self.dataParser.buildFidRoleIndex(os.path.join(self.workFolder, 'OTU_FID_ROLE.index'))
+            self.fidRoleIndex = self.dataParser.readFidRoleIndexFile(indexFile)
+        return self.fidRoleIndex
+
+    def _requireFeatures(self, features, genomeId):
+        ''' Pass through the features from a genome and make sure the genome has features.
+            @param features: List or generator of features
+            @param genomeId: Genome ID string for genome with the features
+            @return Generator of features
+            @raise NoFeaturesError after the last feature when there are no features
+        '''
+
+        numFeatures = 0
+        for feature in features:
+            numFeatures += 1
+            yield feature
+        if numFeatures == 0:
+            raise NoFeaturesError('Genome %s has no features. Did you forget to run annotate_genome?\n' %(genomeId))
+        return
+
+    def _writeFeatures(self, handle, features, prefix):
+        ''' Write the protein sequences from a list of features to a FASTA file.
+            When the hit cache is enabled, a sequence is only written when its hits are not
+            in the cache and it has not already been written for another feature.
+            @param handle: File handle of FASTA file
+            @param features: List of features with protein sequences
+            @param prefix: String added to beginning of every query ID
+            @return Number of protein sequences written to file
+        '''
+
+        numProteins = 0
+        if self.hitCacheQueries is None:
+            for feature in features:
+                # Not a protein-encoding gene
+                if 'protein_translation' not in feature:
+                    continue
+                handle.write('>%s%s\n%s\n' %(prefix, feature['id'], feature['protein_translation']))
+                numProteins += 1
+            return numProteins
+
+        # Look up all of the sequences in the hit cache at once.
+        queries = self.hitCacheQueries
+        proteins = [ (prefix+feature['id'], feature['protein_translation']) for feature in features if 'protein_translation' in feature ]
+        hashes = [ sequenceHash(sequence) for query, sequence in proteins ]
+        queries['cached'].update(self._getHitCache().get([ h for h in hashes if h not in queries['cached'] and h not in queries['searched'] ]))
+        for index in range(len(proteins)):
+            query, sequence = proteins[index]
+            queries['order'].append(query)
+            queries['hashes'][query] = hashes[index]
+            if hashes[index] in queries['cached'] or hashes[index] in queries['searched']:
+                continue
+            handle.write('>%s\n%s\n' %(query, sequence))
+            queries['searched'][hashes[index]] = query
+            numProteins += 1
+        queries['numSearched'] += numProteins
+        self._log(log.DEBUG, 'Found hits for %d of %d protein sequences in hit cache' %(len(proteins) - numProteins, len(proteins)))
+        return numProteins
+
+    def templateProbabilities(self, totalRoleProbs, template):
+        ''' Compute the likelihood of each reaction in a compiled template from the likelihood of each role.
+            This is the same calculation as complexProbabilities() followed by
+            reactionProbabilities() but the minimum over the roles in a complex and the
+            maximum over the complexes for a reaction are calculated with reductions over
+            the rows of the compiled template so one compiled template can be used to score
+            many genomes.  A gene-protein-reaction relationship is only built for a reaction
+            with a likelihood of at least the gpr_probability_cutoff configuration variable.
+            @param totalRoleProbs: List of tuples with role, likelihood, and estimated set
+                of genes that perform the role
+            @param template: CompiledTemplate object with complexes and reactions from template
+            @return List of tuples with reaction ID, likelihood, reaction type, complex info,
+                and gene-protein-reaction relationship (same as reactionProbabilities())
+        '''
+
+        # Without numpy, use the mappings with the original calculations.
+        if not ProbAnnotationEngine.NUMPY_AVAILABLE:
+            complexProbs = self.complexProbabilities(totalRoleProbs, complexesToRequiredRoles = template.complexesToRoles())
+            return self.reactionProbabilities(complexProbs, rxnsToComplexes = template.reactionsToComplexes())
+
+        self._log(log.DEBUG, 'Started computing template reaction probabilities for '+self.genomeId)
+        start = self._startStage()
+
+        # Build the vectors of role likelihoods and role status in the order of the template roles.
+        allroles = self._getFidRoleIndex().allRoles()
+        rolesToProbabilities = dict()
+        rolesToGeneList = dict()
+        for tuple in totalRoleProbs:
+            rolesToProbabilities[tuple[0]] = float(tuple[1])
+            rolesToGeneList[tuple[0]] = tuple[2]
+        roleProbabilities = [ rolesToProbabilities.get(role, 0.0) for role in template.roles ]
+        roleAvailable = [ role in rolesToProbabilities for role in template.roles ]
+        roleRepresented = [ role in allroles for role in template.roles ]
+
+        # Calculate the likelihood of each complex.
+        complexLikelihoods, complexTypes, numAvailable = \
+            ProbAnnotationEngine.complexScores(template, roleProbabilities, roleAvailable, roleRepresented)
+        complexScores = complexLikelihoods
+        complexLikelihoods = complexLikelihoods.tolist()
+        complexTypes = complexTypes.tolist()
+        numAvailable = numAvailable.tolist()
+
+        # Build the type string for each complex.
+        typeNames = { ProbAnnotationEngine.CPLX_FULL: 'CPLX_FULL', ProbAnnotationEngine.CPLX_NOTTHERE: 'CPLX_NOTTHERE',
+                      ProbAnnotationEngine.CPLX_NOREPS: 'CPLX_NOREPS', ProbAnnotationEngine.CPLX_NOREPS_AND_NOTTHERE: 'CPLX_NOREPS_AND_NOTTHERE' }
+        complexTypeNames = list()
+        for index in range(len(template.complexes)):
+            if complexTypes[index] == ProbAnnotationEngine.CPLX_PARTIAL:
+                numRoles = template.complexRoleOffsets[index + 1] - template.complexRoleOffsets[index]
+                complexTypeNames.append('CPLX_PARTIAL_%d_of_%d' %(numAvailable[index], numRoles))
+            else:
+                complexTypeNames.append(typeNames[complexTypes[index]])
+        self._finishStage('complex', start, len(complexTypeNames))
+
+        # Calculate the likelihood of each reaction.
+        start = self._startStage()
+        reactionLikelihoods = ProbAnnotationEngine.reactionScores(template, complexScores).tolist()
+
+        # Build the list of reaction likelihoods.  The gene-protein-reaction relationships
+        # are only built for reactions above the cutoff (and every reaction when debug is
+        # turned on so the complex probabilities can be saved).
+        SEPARATOR = self.config['separator']
+        dilutionPercent = float(self.config['dilution_percent'])
+        gprCutoff = float(self.config.get('gpr_probability_cutoff', '0'))
+        saveAll = self.logger.get_log_level() >= log.DEBUG2
+        complexGprs = dict()
+        reactionProbs = list()
+        for index in range(len(template.reactions)):
+            rxnComplexes = template.reactionComplexes(index)
+            if len(rxnComplexes) == 0:
+                reactionProbs.append( [ template.reactions[index]+self.communityIndex, 0, 'NOCOMPLEXES', '', '' ] )
+                continue
+            maxProb = reactionLikelihoods[index]
+
+            # Complex1 (P1; TYPE1) ///Complex2 (P2; TYPE2) ...
+            complexList = [ (cplx, complexLikelihoods[cplx]) for cplx in rxnComplexes ]
+            complexList.sort(key=lambda tup: tup[1], reverse=True)
+            complexString = SEPARATOR.join([ '%s (%1.4f; %s)' %(template.complexes[cplx], prob, complexTypeNames[cplx]) for cplx, prob in complexList ])
+
+            # Link the complexes within the cutoff of the maximum likelihood with an OR relationship.
+            GPR = ''
+            if maxProb >= gprCutoff or saveAll:
+                cplxGprs = list()
+                for cplx in rxnComplexes:
+                    if complexLikelihoods[cplx] < maxProb * dilutionPercent/100.0:
+                        continue
+                    if cplx not in complexGprs:
+                        complexGprs[cplx] = self._complexGpr(template, cplx, numAvailable[cplx], rolesToGeneList, allroles)
+                    cplxGprs.append(complexGprs[cplx])
+                if len(cplxGprs) > 0:
+                    GPR = " or ".join( list(set(cplxGprs)) )
+            reactionProbs.append( [ template.reactions[index]+self.communityIndex, maxProb, 'HASCOMPLEXES', complexString, GPR ] )
+        self._finishStage('reaction', start, len(reactionProbs))
+
+        # Save the generated data when debug is turned on.
+        if saveAll:
+            complex_probability_file = os.path.join(self.workFolder, "%s.complexprobs" %(self.genomeId))
+            with open(complex_probability_file, "w") as handle:
+                for cplx in sorted(range(len(template.complexes)), key=lambda index: template.complexes[index]):
+                    if cplx not in complexGprs:
+                        complexGprs[cplx] = self._complexGpr(template, cplx, numAvailable[cplx], rolesToGeneList, allroles)
+                    roles = [ template.roles[roleId] for roleId in template.complexRoles(cplx) ]
+                    unavailRoles = [ role for role in roles if role in allroles and role not in rolesToProbabilities ]
+                    noexistRoles = [ role for role in roles if role not in allroles ]
+                    handle.write("%s\t%1.6f\t%s\t%s\t%s\t%s\n" %(template.complexes[cplx], complexLikelihoods[cplx], complexTypeNames[cplx],
+                        complexGprs[cplx], SEPARATOR.join(unavailRoles), SEPARATOR.join(noexistRoles)))
+            reaction_probability_file = os.path.join(self.workFolder, "%s.rxnprobs" %(self.genomeId))
+            with open(reaction_probability_file, "w") as handle:
+                for tuple in sorted(reactionProbs):
+                    handle.write("%s\t%1.6f\t%s\t%s\t%s\n" %(tuple[0], tuple[1], tuple[2], tuple[3], tuple[4]))
+
+        self._log(log.DEBUG, 'Finished computing template reaction probabilities for '+self.genomeId)
+        return reactionProbs
+
+    def communityReactionProbabilities(self, members, template):
+        ''' Compute the reaction probabilities for the members of a community model.
+            The proteins from all of the members are searched together and the search
+            results are split by member.  The rest of the algorithm runs for one member at
+            a time with the same compiled template and the reaction probabilities for a
+            member are returned before the next member is started, so only the results for
+            one member are in memory at a time.  A genome that is a member more than once
+            is only searched once and the features for the other members with the same
+            genome ID are not read (and are closed when they have a close() method).
+            @param members: List of tuples with genome ID, community index, and list of
+                features (a generator only needs the features for one member at a time)
+            @param template: CompiledTemplate object with complexes and reactions from template
+            @return Generator of tuples with genome ID, community index, and list of reaction
+                probabilities (community index is appended to the reaction IDs) for each member
+            @raise NoFeaturesError when list of features for a member is empty
+        '''
+
+        # Build one fasta file for all of the members while recording the members.
+        memberList = list()
+        genomeIds = list()
+        def memberGenomes():
+            for genomeId, communityIndex, features in members:
+                memberList.append( (genomeId, communityIndex) )
+                if genomeId not in genomeIds:
+                    genomeIds.append(genomeId)
+                    yield genomeId, features
+                elif hasattr(features, 'close'):
+                    features.close()
+            return
+        fastaFile = self.genomesToFasta(memberGenomes())
+
+        # Search for the proteins from all of the members and split the results by member.
+        blastResultFiles = self.splitBlastOutput(self.runBlast(fastaFile), genomeIds)
+        self._log(log.INFO, 'Searched for proteins from %d members of community' %(len(memberList)))
+
+        # Run the rest of the algorithm for each member.
+        for genomeId, communityIndex in memberList:
+            self.selectGenome(genomeId, communityIndex)
+            rolestringTuples = self.rolesetProbabilitiesMarble(blastResultFiles[genomeId])
+            totalRoleProbs = self.totalRoleProbabilities(self.rolesetProbabilitiesToRoleProbabilities(rolestringTuples))
+            del rolestringTuples
+            yield genomeId, communityIndex, self.templateProbabilities(totalRoleProbs, template)
+        return
+
+    def loadReferenceData(self):
+        ''' Load the static reference data before the first genome is annotated.
+            A server uses this to keep the data warm and share the compiled index with the
+            workers for each request.
+            @return ProbAnnotationIndex object for the compiled feature ID to role index
+        '''
+
+        self._openDatabaseFiles()
+        return self._getFidRoleIndex()
+
+    def _startStage(self):
+        ''' Start measuring a stage of the algorithm.
+            @return Tuple with wall clock time and CPU time at the start of the stage
+        '''
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return (time.time(), usage.ru_utime + usage.ru_stime)
+
+    def _finishStage(self, stage, start, numItems):
+        ''' Record the measurements for a stage of the algorithm.
+            The CPU time is for the whole process (which includes other threads in a server)
+            and the maximum resident set size is the peak for the process so far.
+            @param stage: Name of stage
+            @param start: Tuple returned by _startStage()
+            @param numItems: Number of items produced by the stage
+            @return Nothing
+        '''
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        measurement = { 'stage': stage, 'genome_id': self.genomeId, 'wall_time': time.time() - start[0],
+                        'cpu_time': usage.ru_utime + usage.ru_stime - start[1], 'max_rss_kb': usage.ru_maxrss,
+                        'items': numItems }
+        self.metrics['stages'].append(measurement)
+        self._log(log.DEBUG, 'Stage %s for genome %s took %.3f seconds (%.3f CPU seconds) for %d items' \
+                  %(stage, self.genomeId, measurement['wall_time'], measurement['cpu_time'], numItems))
+        return
+
+    def writeMetricsFile(self, filename):
+        ''' Write the measurements for the job to a JSON file.
+            @param filename: Path to metrics file
+            @return Nothing
+        '''
+
+        metrics = dict(self.metrics)
+        metrics['end_time'] = time.time()
+        with open(filename, 'w') as handle:
+            json.dump(metrics, handle, indent=4, sort_keys=True)
+        return
+
     def cleanup(self):
         ''' Cleanup the work folder.
+            When the metrics_dir configuration variable is set, the measurements for the job
+            are saved in a metrics file in that folder.
             @return Nothing
         '''
 
+        if 'metrics_dir' in self.config and len(self.metrics['stages']) > 0:
+            try:
+                if not os.path.exists(self.config['metrics_dir']):
+                    os.makedirs(self.config['metrics_dir'], 0775)
+                self.writeMetricsFile(os.path.join(self.config['metrics_dir'], '%s.%s.json' %(self.metrics['job_name'], self.metrics['job_id'])))
+            except (IOError, OSError) as e:
+                self._log(log.WARNING, 'Failed to save metrics file: %s' %(e))
+        if self.hitCache is not None:
+            self.hitCache.close()
+            self.hitCache = None
         if self.logger.get_log_level() < log.DEBUG2:
             shutil.rmtree(self.workFolder)
         return
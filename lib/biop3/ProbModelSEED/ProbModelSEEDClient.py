@@ -13,15 +13,18 @@ except ImportError:
     import simplejson as _json
 
 import requests as _requests
+import threading as _threading
 import urlparse as _urlparse
 import random as _random
 import base64 as _base64
 from ConfigParser import ConfigParser as _ConfigParser
+from multiprocessing.pool import ThreadPool as _ThreadPool
 import os as _os
 
 _CT = 'content-type'
 _AJ = 'application/json'
 _URL_SCHEME = frozenset(['http', 'https'])
+_CHUNK_SIZE = 1024 * 1024
 
 
 def _get_token(user_id, password,
@@ -79,6 +82,115 @@ def _read_inifile(file=_os.environ.get(  # @ReservedAssignment
     return authdata
 
 
+class _JSONStreamDecoder(object):
+    # decode a JSON document from an iterator of chunks as it is read, a value that
+    # is all in the buffer is decoded at once and an object or list that goes
+    # past the end of the buffer is decoded one member at a time so only the
+    # text of the value being decoded and the last chunk are kept in memory
+
+    _WHITESPACE = ' \t\n\r'
+    _NUMBER = '0123456789.eE+-'
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._decoder = _json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def decode(self):
+        value = self._value()
+        if self._peek() != '':
+            raise ValueError('Extra data after JSON document')
+        return value
+
+    def _fill(self):
+        # add the next chunk to the buffer, returns False at end of stream
+        if self._eof:
+            return False
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _peek(self):
+        # skip whitespace and return the next character ('' at end of stream)
+        while True:
+            while self._pos < len(self._buf) and \
+                    self._buf[self._pos] in self._WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ''
+
+    def _value(self):
+        char = self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+                # a number at the end of the buffer can continue in the
+                # next chunk
+                if self._eof or (end < len(self._buf) and
+                                 self._buf[end] not in self._NUMBER):
+                    self._pos = end
+                    return value
+            except ValueError:
+                if char == '{':
+                    return self._object()
+                if char == '[':
+                    return self._list()
+                if self._eof:
+                    raise
+            self._fill()
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char == '' or char not in chars:
+            raise ValueError('Expecting one of %r in JSON document' % chars)
+        self._pos += 1
+        return char
+
+    def _object(self):
+        self._expect('{')
+        obj = {}
+        if self._peek() == '}':
+            self._pos += 1
+            return obj
+        while True:
+            if self._peek() != '"':
+                raise ValueError('Expecting property name in JSON document')
+            key = self._value()
+            self._expect(':')
+            obj[key] = self._value()
+            if self._expect(',}') == '}':
+                return obj
+
+    def _list(self):
+        self._expect('[')
+        values = []
+        if self._peek() == ']':
+            self._pos += 1
+            return values
+        while True:
+            values.append(self._value())
+            if self._expect(',]') == ']':
+                return values
+
+
+def _read_json(ret):
+    # decode the JSON body of a streamed response as it is read from the
+    # connection, the body is decompressed a chunk at a time so neither the
+    # compressed nor the decompressed body is kept in memory
+    try:
+        return _JSONStreamDecoder(ret.iter_content(_CHUNK_SIZE)).decode()
+    finally:
+        ret.close()
+
+
 class ServerError(Exception):
 
     def __init__(self, name, code, message, data=None, error=None):
@@ -103,11 +215,73 @@ class _JSONObjectEncoder(_json.JSONEncoder):
         return _json.JSONEncoder.default(self, obj)
 
 
+class BatchCall(object):
+    # one call collected by a batch, result() returns the result of the call
+    # or raises the error after the batch is sent
+
+    def __init__(self, method, params):
+        self.method = method
+        self.params = params
+        self._done = False
+        self._result = None
+        self._error = None
+
+    def _set(self, result=None, error=None):
+        self._result = result
+        self._error = error
+        self._done = True
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if not self._done:
+            raise ValueError('Batch with call to ' + self.method +
+                             " hasn't been sent")
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class _Batch(object):
+    # collects calls made with the names of the client methods and sends them
+    # together when the with block ends or send() is called
+
+    def __init__(self, client):
+        self._client = client
+        self._calls = []
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name in ('submit', 'map', 'close', 'batch') \
+                or not callable(getattr(self._client, name, None)):
+            raise AttributeError(name + " isn't a method of the service")
+
+        def add_call(input):
+            call = BatchCall('ProbModelSEED.' + name, [input])
+            self._calls.append(call)
+            return call
+        return add_call
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.send()
+        return False
+
+    def send(self):
+        calls = [call for call in self._calls if not call.done()]
+        if len(calls) > 0:
+            self._client._call_batch(calls)
+
+
 class ProbModelSEED(object):
 
     def __init__(self, url=None, timeout=30 * 60, user_id=None,
                  password=None, token=None, ignore_authrc=False,
-                 trust_all_ssl_certificates=False):
+                 trust_all_ssl_certificates=False, pool_size=10,
+                 keep_alive=True):
         if url is None:
             url = 'http://p3.theseed.org/services/ProbModelSEED'
         scheme, _, _, _, _, _ = _urlparse.urlparse(url)
@@ -117,6 +291,23 @@ class ProbModelSEED(object):
         self.timeout = int(timeout)
         self._headers = dict()
         self.trust_all_ssl_certificates = trust_all_ssl_certificates
+        # one session reuses connections to the server for every call,
+        # pool_size is the number of connections kept open and the number
+        # of threads used by submit()
+        self.pool_size = int(pool_size)
+        if self.pool_size < 1:
+            raise ValueError('Pool size must be at least 1')
+        self._session = _requests.Session()
+        adapter = _requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        if not keep_alive:
+            self._headers['Connection'] = 'close'
+        # large results like exported models compress well
+        self._headers['Accept-Encoding'] = 'gzip, deflate'
+        self._pool = None
+        self._pool_lock = _threading.Lock()
         # token overrides user_id and password
         if token is not None:
             self._headers['AUTHORIZATION'] = token
@@ -146,9 +337,9 @@ class ProbModelSEED(object):
                     }
 
         body = _json.dumps(arg_hash, cls=_JSONObjectEncoder)
-        ret = _requests.post(self.url, data=body, headers=self._headers,
-                             timeout=self.timeout,
-                             verify=not self.trust_all_ssl_certificates)
+        ret = self._session.post(self.url, data=body, headers=self._headers,
+                                 timeout=self.timeout, stream=True,
+                                 verify=not self.trust_all_ssl_certificates)
         if ret.status_code == _requests.codes.server_error:
             if _CT in ret.headers and ret.headers[_CT] == _AJ:
                 err = _json.loads(ret.text)
@@ -159,12 +350,121 @@ class ProbModelSEED(object):
             else:
                 raise ServerError('Unknown', 0, ret.text)
         if ret.status_code != _requests.codes.OK:
+            ret.close()
             ret.raise_for_status()
-        resp = _json.loads(ret.text)
+        resp = _read_json(ret)
         if 'result' not in resp:
             raise ServerError('Unknown', 0, 'An unknown server error occurred')
         return resp['result']
 
+    def batch(self):
+        # collect calls and send them to the server in one request, e.g.
+        #   with client.batch() as batch:
+        #       model = batch.get_model({'model': ref})
+        #   print model.result()
+        return _Batch(self)
+
+    def _call_batch(self, calls):
+        arg_hashes = []
+        calls_by_id = {}
+        for call in calls:
+            call_id = str(_random.random())[2:]
+            while call_id in calls_by_id:
+                call_id = str(_random.random())[2:]
+            calls_by_id[call_id] = call
+            arg_hashes.append({'method': call.method,
+                               'params': call.params,
+                               'version': '1.1',
+                               'id': call_id
+                               })
+
+        body = _json.dumps(arg_hashes, cls=_JSONObjectEncoder)
+        try:
+            ret = self._session.post(self.url, data=body,
+                                     headers=self._headers,
+                                     timeout=self.timeout, stream=True,
+                                     verify=not self.trust_all_ssl_certificates)
+            resps = None
+            if ret.status_code in (_requests.codes.OK,
+                                   _requests.codes.server_error):
+                try:
+                    resps = _read_json(ret)
+                except ValueError:
+                    resps = None
+            else:
+                ret.close()
+        except Exception as e:
+            # the batch couldn't be sent or its response couldn't be read so
+            # every call in the batch fails with the same error
+            for call in calls:
+                call._set(error=e)
+            return
+        if not isinstance(resps, list):
+            # the server doesn't support batches so send the calls
+            # separately and at the same time
+            self._call_separately(calls)
+            return
+
+        for resp in resps:
+            call = calls_by_id.pop(resp.get('id'), None)
+            if call is None:
+                continue
+            if resp.get('error') is not None:
+                call._set(error=ServerError(**resp['error']))
+            elif 'result' not in resp:
+                call._set(error=ServerError(
+                    'Unknown', 0, 'An unknown server error occurred'))
+            else:
+                call._set(result=resp['result'][0]
+                          if resp['result'] else None)
+        for call in calls_by_id.values():
+            call._set(error=ServerError(
+                'Unknown', 0, 'No response for call to ' + call.method))
+
+    def _call_separately(self, calls):
+        pool = self._get_pool()
+        results = [pool.apply_async(self._call, [call.method, call.params])
+                   for call in calls]
+        for call, result in zip(calls, results):
+            # every call is settled, including calls that fail with a
+            # transport error
+            try:
+                resp = result.get()
+            except Exception as e:
+                call._set(error=e)
+            else:
+                call._set(result=resp[0] if resp else None)
+
+    def submit(self, method, input):
+        # run a method in a thread from the pool, the returned AsyncResult's
+        # get() gives the return value of the method or raises its error
+        if method.startswith('_') or method in ('submit', 'map', 'close',
+                                                'batch') \
+                or not callable(getattr(self, method, None)):
+            raise ValueError(method + " isn't a method of the service")
+        return self._get_pool().apply_async(getattr(self, method), [input])
+
+    def map(self, method, inputs):
+        # run a method for every input concurrently and return the results
+        # in the same order as the inputs
+        results = [self.submit(method, input) for input in inputs]
+        return [result.get() for result in results]
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = _ThreadPool(self.pool_size)
+            return self._pool
+
+    def close(self):
+        # stop the threads used by submit() and close the connections
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+        self._session.close()
+
     def list_gapfill_solutions(self, input):
         resp = self._call('ProbModelSEED.list_gapfill_solutions',
                           [input])
@@ -190,6 +490,31 @@ class ProbModelSEED(object):
                           [input])
         return resp[0]
 
+    def export_model_to_file(self, input, filename):
+        # export a model to Shock and download the exported file to filename
+        # in chunks so the export is never held in memory, the file is
+        # written to a temporary name and renamed when it is complete
+        input = dict(input)
+        input['to_shock'] = 1
+        url = self.export_model(input)
+        headers = {'Accept-Encoding': 'gzip, deflate'}
+        if 'AUTHORIZATION' in self._headers:
+            headers['Authorization'] = 'OAuth ' + \
+                self._headers['AUTHORIZATION']
+        ret = self._session.get(url + '?download', headers=headers,
+                                timeout=self.timeout, stream=True,
+                                verify=not self.trust_all_ssl_certificates)
+        try:
+            ret.raise_for_status()
+            partname = filename + '.part'
+            with open(partname, 'wb') as handle:
+                for chunk in ret.iter_content(_CHUNK_SIZE):
+                    handle.write(chunk)
+            _os.rename(partname, filename)
+        finally:
+            ret.close()
+        return filename
+
     def export_media(self, input):
         resp = self._call('ProbModelSEED.export_media',
                           [input])
@@ -3,6 +3,7 @@
 import argparse
 import os
 import sys
+import time
 import traceback
 from ConfigParser import ConfigParser
 from biop3.ProbModelSEED.ProbAnnotationParser import ProbAnnotationParser, MakeblastdbError
@@ -21,8 +22,20 @@ DESCRIPTION
       
       The action argument specifies the action to perform. The following actions
       are supported: (1) "load" to load the data files from Shock, (2) "store"
-      to store the data files to Shock, or (3) "builddb" to build a search
-      database for the configured search program.
+      to store the data files and the compiled index of the feature ID to role
+      file to Shock, (3) "builddb" to build a search database for the
+      configured search program and the compiled index of the feature ID to
+      role file, or (4) "warmup" to load and validate the
+      data files once and publish a ready file so that workers only need a
+      quick check of the data files when they start.
+
+      The compiled index has the interned rolestrings (sorted lists of role
+      IDs) and the rolestring ID of every feature.  It is built by "store"
+      when it is out of date and is downloaded by "load" when it was built
+      from the same feature ID to role file.  Otherwise it is built locally.
+
+      The --interval optional argument runs the "warmup" action as a daemon
+      that validates the data files again every interval seconds.
        
       The --token optional argument specifies the authentication token for the
       user and is required when using the "store" action.
@@ -36,6 +49,9 @@ EXAMPLES
       Load the static data files from Shock:
       > ms-probanno-data load
 
+      Validate the static data files every hour:
+      > ms-probanno-data warmup --interval 3600
+
 AUTHORS
       Mike Mundy 
 '''
@@ -43,8 +59,9 @@ AUTHORS
 if __name__ == '__main__':
     # Parse options.
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, prog='ms-probanno', epilog=desc3)
-    parser.add_argument('action', help='action to perform (load, store, builddb)', action='store', default=None)
+    parser.add_argument('action', help='action to perform (load, store, builddb, warmup)', action='store', default=None)
     parser.add_argument('--token', help='token for user', action='store', dest='token', default=None)
+    parser.add_argument('--interval', help='seconds between validations for warmup action', action='store', type=int, dest='interval', default=None)
     usage = parser.format_usage()
     parser.description = desc1 + '      ' + usage + desc2
     parser.usage = argparse.SUPPRESS
@@ -99,7 +116,31 @@ if __name__ == '__main__':
             print 'Finished building search database'
         except MakeblastdbError as e:
             print 'Failed to build a search database: '+e.message
+        print 'Started building compiled feature ID to role index ...'
+        try:
+            dataParser.buildFidRoleIndex()
+            print 'Finished building compiled feature ID to role index'
+        except:
+            print 'Failed to build compiled feature ID to role index'
+            traceback.print_exc(file=sys.stderr)
+            exit(1)
         
+    # Validate the static data files and publish the ready file.
+    elif args.action == 'warmup':
+        while True:
+            print 'Started validating data files ...'
+            try:
+                dataParser.warmupDatabaseFiles(logger)
+                print 'Finished validating data files'
+            except:
+                print 'Failed to validate static data files'
+                traceback.print_exc(file=sys.stderr)
+                if args.interval is None:
+                    exit(1)
+            if args.interval is None:
+                break
+            time.sleep(args.interval)
+
     else:
         print 'Action '+args.action+' is not supported'
         exit(1)
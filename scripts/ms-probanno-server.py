@@ -0,0 +1,72 @@
+#! /usr/bin/env python
+
+import argparse
+import sys
+import traceback
+from biop3.ProbModelSEED.ProbAnnotationServer import ProbAnnotationService, ProbAnnotationServer
+
+desc1 = '''
+NAME
+      ms-probanno-server -- run a local server for the probabilistic annotation algorithm
+
+SYNOPSIS
+'''
+
+desc2 = '''
+DESCRIPTION
+      Run a long-running server that annotates genomes for ms-probanno.  The
+      server validates the static database files, keeps the compiled feature ID
+      to role index memory-mapped, keeps compiled templates in memory, and
+      reads the search database once at startup so a request only needs to
+      run the search and the likelihood calculations.
+
+      The server accepts JSON-RPC 1.1 requests.  Use "ms-probanno --server URL"
+      to submit a genome to the server.
+
+      The --port optional argument specifies the port number for the server.
+      The default is the annotation_server_port configuration variable, which
+      is 7133 so the server does not collide with the ProbModelSEED service on
+      port 7130.  The --host optional argument specifies the host name or
+      address the server listens on.  The number of genomes annotated at the
+      same time is set by the annotation_server_jobs configuration variable.
+'''
+
+desc3 = '''
+EXAMPLES
+      Run the server on port 7140:
+      > ms-probanno-server --port 7140
+
+SEE ALSO
+      ms-probanno
+
+AUTHORS
+      Mike Mundy 
+'''
+
+if __name__ == '__main__':
+    # Parse options.
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, prog='ms-probanno-server', epilog=desc3)
+    parser.add_argument('--host', help='host name or address to listen on', action='store', dest='host', default='localhost')
+    parser.add_argument('--port', help='port number for server', action='store', type=int, dest='port', default=None)
+    usage = parser.format_usage()
+    parser.description = desc1 + '      ' + usage + desc2
+    parser.usage = argparse.SUPPRESS
+    args = parser.parse_args()
+
+    # Load the reference data and start the server.
+    try:
+        service = ProbAnnotationService()
+    except Exception as e:
+        sys.stderr.write('Failed to load reference data for server: %s\n' %(e))
+        traceback.print_exc(file=sys.stderr)
+        exit(1)
+    if args.port is None:
+        args.port = int(service.config.get('annotation_server_port', '7133'))
+    server = ProbAnnotationServer((args.host, args.port), service)
+    sys.stderr.write('Annotation server is listening on %s:%d\n' %(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    service.worker.cleanup()
+    exit(0)
@@ -7,7 +7,13 @@ import os
 import time
 import traceback
 import requests
+import threading
+from StringIO import StringIO
 from biop3.ProbModelSEED.ProbAnnotationWorker import ProbAnnotationWorker
+from biop3.ProbModelSEED.ProbAnnotationGenomeStream import GenomeStreamReader, GenomeStreamError
+from biop3.ProbModelSEED.ProbAnnotationThrottle import hostSemaphore, backoffDelay, HOST_REQUEST_LIMIT, RETRY_COUNT
+from biop3.ProbModelSEED.ProbAnnotationEngine import CompiledTemplate
+from biop3.ProbModelSEED.ProbAnnotationServer import ProbAnnotationClient
 from biop3.Workspace.WorkspaceClient import Workspace, ServerError as WorkspaceServerError, _read_inifile
 
 desc1 = '''
@@ -23,7 +29,65 @@ DESCRIPTION
       the reference to the template model used to reconstruct a model for the
       organism.  The rxnprobsref argument is the reference to where the output
       rxnprobs object is stored.
+
+      A genome object is read as it is downloaded and only the ID and the
+      protein sequence of each feature are kept.  The protein sequences are
+      written to the search program's input file as the features are read so
+      the genome object is never held in memory.
+
+      The complex and reaction mappings compiled from a template are saved in
+      a local cache (in the folder set by the template_cache_dir configuration
+      variable) so a template object is only downloaded again after it changes
+      in the workspace.
       
+      The --batch optional argument specifies the path to a manifest file for
+      annotating a batch of genomes with a single search.  Each line in the
+      manifest file has a genomeref, templateref, and rxnprobsref separated by
+      whitespace.  Blank lines and lines starting with "#" are ignored.  The
+      proteins from all of the genomes are searched together and a rxnprobs
+      object is stored for every line.  When --batch is specified, the
+      positional arguments are not used.
+
+      The --community optional argument specifies the path to a manifest file
+      for annotating the members of a community model.  Each line in the
+      manifest file has a genomeref, templateref, rxnprobsref, and community
+      index separated by whitespace and every member must use the same
+      template.  The proteins from all of the members are searched together,
+      the template is compiled once, and the rxnprobs object for each member
+      is stored before the next member is started.  The community index is
+      appended to the reaction IDs.  When --community is specified, the
+      positional arguments are not used.
+
+      The --stream optional argument runs the search program with its output
+      sent to a pipe and scores the hits for each protein as soon as they are
+      available instead of waiting for the search to finish.
+
+      The --server optional argument specifies the url of an annotation server
+      started with ms-probanno-server.  The genome is sent to the server which
+      keeps the reference data loaded between genomes.  When the server is not
+      running, the algorithm is run locally.
+
+      The --incremental optional argument saves the intermediate results for
+      each protein in a local folder (set by the gene_results_dir configuration
+      variable).  When the genome is annotated again, only the proteins that
+      are new or have a changed sequence are searched.  The saved results are
+      not used after the static database files change.
+
+      The --compact-file optional argument specifies the path to a local file
+      where the reaction probabilities are also saved in a compact columnar
+      form.  The reaction IDs and probabilities in the file can be loaded
+      without decoding the complex strings and GPRs.  The probabilities are
+      saved as 32-bit floats.  The rxnprobs object is always stored in the
+      workspace.
+
+      The genome and template objects are fetched at the same time.  A request
+      to the workspace or Shock that fails because the service is busy or
+      unavailable is tried again after a random delay that doubles with each
+      failure (up to about a minute).  The --host-limit optional argument
+      specifies the maximum number of requests at the same time to a service
+      host from all of the jobs on the machine (the default is 8).  Jobs wait
+      for a free slot so many simultaneous jobs do not overload a service.
+
       The --ws-url optional argument specifies the url of the workspace service
       endpoint.  The --token optional argument specifies the authentication
       token for the user.
@@ -35,10 +99,70 @@ EXAMPLES
       > ms-probanno /mmundy/home/models/.224308.49_model/224308.49.genome
           /chenry/public/modelsupport/templates/GramPositive.modeltemplate
           /mmundy/home/models/.224308.49_model/224308.49.rxnprobs
+
+      Run probabilistic annotation for the genomes listed in a manifest file:
+      > ms-probanno --batch genomes.manifest
+
+      Run probabilistic annotation for the members of a community model:
+      > ms-probanno --community members.manifest
+
+      Run probabilistic annotation on an annotation server:
+      > ms-probanno --server http://localhost:7133 /mmundy/home/models/.224308.49_model/224308.49.genome
+          /chenry/public/modelsupport/templates/GramPositive.modeltemplate
+          /mmundy/home/models/.224308.49_model/224308.49.rxnprobs
+
 AUTHORS
       Mike Mundy 
 '''
 
+# Maximum number of requests at the same time to one host from all of the jobs on this machine.
+hostLimit = HOST_REQUEST_LIMIT
+
+# Messages from the workspace client for errors when the service is busy or unavailable.
+TRANSIENT_ERRORS = [ 'HTTP status: 502 Bad Gateway', 'HTTP status: 503 Service Unavailable', 'HTTP status: 504 Gateway Timeout' ]
+
+def isTransientError(e):
+    ''' Check if an error from a request is from a network glitch or a busy service.
+
+        @param e: Exception raised by the workspace client or a download
+        @return True when the request should be tried again
+    '''
+
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(e, requests.exceptions.HTTPError):
+        return e.response is not None and e.response.status_code in (502, 503, 504)
+    for message in TRANSIENT_ERRORS:
+        if message in str(e):
+            return True
+    return False
+
+def startFetch(function, *args):
+    ''' Start getting an input in a separate thread.
+
+        @param function: Function that gets the input
+        @param args: Arguments for function
+        @return Function that waits for the thread and returns the input (or raises the
+            exception from the thread, including the SystemExit when the input is not found)
+    '''
+
+    result = dict()
+    def run():
+        try:
+            result['value'] = function(*args)
+        except BaseException:
+            result['error'] = sys.exc_info()
+        return
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    def wait():
+        thread.join()
+        if 'error' in result:
+            raise result['error'][0], result['error'][1], result['error'][2]
+        return result['value']
+    return wait
+
 def getObject(wsClient, reference, token):
     ''' Get an object from the workspace.
     
@@ -48,25 +172,27 @@ def getObject(wsClient, reference, token):
     '''
 
     requests.packages.urllib3.disable_warnings()
-    retryCount = 3
-    while retryCount > 0:
+    attempt = 0
+    while attempt < RETRY_COUNT:
         try:
             # The get() method returns an array of tuples where the first element is
             # the object's metadata (which is valid json) and the second element is
             # the object's data (which is not valid json).
-            object = wsClient.get({ 'objects': [ reference ] })
+            with hostSemaphore(wsClient.url, hostLimit):
+                object = wsClient.get({ 'objects': [ reference ] })
             if len(object[0][0][11]) > 0:
-                response = requests.get(object[0][0][11]+'?download', headers={ 'AUTHORIZATION': 'OAuth '+token })
-                if response.status_code != requests.codes.OK:
-                    response.raise_for_status()
-                object[0][1] = response.text
+                with hostSemaphore(object[0][0][11], hostLimit):
+                    response = requests.get(object[0][0][11]+'?download', headers={ 'AUTHORIZATION': 'OAuth '+token })
+                    if response.status_code != requests.codes.OK:
+                        response.raise_for_status()
+                    object[0][1] = response.text
             return json.loads(object[0][1])
     
-        except WorkspaceServerError as e:
-            # When there is a network glitch, wait a second and try again.
-            if 'HTTP status: 503 Service Unavailable' in e.message or 'HTTP status: 502 Bad Gateway' in e.message:
-                retryCount -= 1
-                time.sleep(1)
+        except (WorkspaceServerError, requests.exceptions.RequestException) as e:
+            # When there is a network glitch or the service is busy, wait and try again.
+            if isTransientError(e):
+                time.sleep(backoffDelay(attempt))
+                attempt += 1
             else:                
                 sys.stderr.write('Failed to get object using reference %s\n' %(reference))
                 tb = traceback.format_exc()
@@ -76,6 +202,116 @@ def getObject(wsClient, reference, token):
     sys.stderr.write('Failed to get object using reference %s because of network problems\n' %(reference))
     exit(1)
 
+def getGenome(wsClient, reference, token):
+    ''' Get a genome object from the workspace as a stream of projected features.
+
+        @param wsClient: Workspace client object
+        @param reference: Reference to genome object
+        @param token: Authentication token for user
+        @return GenomeStreamReader object with genome ID and features
+    '''
+
+    requests.packages.urllib3.disable_warnings()
+    attempt = 0
+    while attempt < RETRY_COUNT:
+        try:
+            # When the object data is in Shock, the download is parsed as it is read.
+            with hostSemaphore(wsClient.url, hostLimit):
+                object = wsClient.get({ 'objects': [ reference ] })
+            if len(object[0][0][11]) > 0:
+                # The slot for the Shock host is held until the reader has read the whole
+                # object, which is after the features are used.
+                semaphore = hostSemaphore(object[0][0][11], hostLimit)
+                slot = semaphore.acquire()
+                try:
+                    response = requests.get(object[0][0][11]+'?download', headers={ 'AUTHORIZATION': 'OAuth '+token }, stream=True)
+                except:
+                    semaphore.release(slot)
+                    raise
+                def closeResponse():
+                    response.close()
+                    semaphore.release(slot)
+                if response.status_code != requests.codes.OK:
+                    closeResponse()
+                    response.raise_for_status()
+                response.raw.decode_content = True
+                return GenomeStreamReader(response.raw, closeFunction=closeResponse)
+            else:
+                data = object[0][1]
+                if isinstance(data, unicode):
+                    data = data.encode('utf-8')
+                return GenomeStreamReader(StringIO(data))
+
+        except (WorkspaceServerError, requests.exceptions.RequestException) as e:
+            # When there is a network glitch or the service is busy, wait and try again.
+            if isTransientError(e):
+                time.sleep(backoffDelay(attempt))
+                attempt += 1
+            else:
+                sys.stderr.write('Failed to get genome using reference %s\n' %(reference))
+                tb = traceback.format_exc()
+                sys.stderr.write(tb)
+                exit(1)
+
+        except GenomeStreamError as e:
+            sys.stderr.write('Failed to read genome using reference %s: %s\n' %(reference, e))
+            exit(1)
+
+    sys.stderr.write('Failed to get genome using reference %s because of network problems\n' %(reference))
+    exit(1)
+
+def prefetchGenomes(wsClient, token, references):
+    ''' Get genome objects from the workspace in order, getting the next genome while the
+        features of a genome are read.
+
+        @param wsClient: Workspace client object
+        @param token: Authentication token for user
+        @param references: List of references to genome objects
+        @return Generator of tuples with reference and GenomeStreamReader object (the first
+            genome is requested before the generator is used)
+    '''
+
+    if len(references) == 0:
+        return iter([])
+    pending = [ startFetch(getGenome, wsClient, references[0], token) ]
+    def genomes():
+        for index in range(len(references)):
+            genome = pending.pop()()
+            if index + 1 < len(references):
+                pending.append(startFetch(getGenome, wsClient, references[index+1], token))
+            yield references[index], genome
+        return
+    return genomes()
+
+def getObjectMetadata(wsClient, reference):
+    ''' Get the metadata for an object from the workspace.
+    
+        @param wsClient: Workspace client object
+        @param reference: Reference to workspace object
+        @return Object metadata tuple
+    '''
+
+    attempt = 0
+    while attempt < RETRY_COUNT:
+        try:
+            with hostSemaphore(wsClient.url, hostLimit):
+                object = wsClient.get({ 'objects': [ reference ], 'metadata_only': 1 })
+            return object[0][0]
+    
+        except (WorkspaceServerError, requests.exceptions.RequestException) as e:
+            # When there is a network glitch or the service is busy, wait and try again.
+            if isTransientError(e):
+                time.sleep(backoffDelay(attempt))
+                attempt += 1
+            else:                
+                sys.stderr.write('Failed to get metadata using reference %s\n' %(reference))
+                tb = traceback.format_exc()
+                sys.stderr.write(tb)
+                exit(1)
+
+    sys.stderr.write('Failed to get metadata using reference %s because of network problems\n' %(reference))
+    exit(1)
+
 def putObject(wsClient, reference, type, data):
     ''' Put an object to the workspace.
     
@@ -86,17 +322,18 @@ def putObject(wsClient, reference, type, data):
         @return Nothing
     '''
 
-    retryCount = 3
-    while retryCount > 0:
+    attempt = 0
+    while attempt < RETRY_COUNT:
         try:
-            wsClient.create({ 'objects': [ [ reference, type, { }, data ] ], 'overwrite': 1 })
+            with hostSemaphore(wsClient.url, hostLimit):
+                wsClient.create({ 'objects': [ [ reference, type, { }, data ] ], 'overwrite': 1 })
             return
     
-        except WorkspaceServerError as e:
-            # When there is a network glitch, wait a second and try again.
-            if 'HTTP status: 503 Service Unavailable' in e.message or 'HTTP status: 502 Bad Gateway' in e.message:
-                retryCount -= 1
-                time.sleep(1)
+        except (WorkspaceServerError, requests.exceptions.RequestException) as e:
+            # When there is a network glitch or the service is busy, wait and try again.
+            if isTransientError(e):
+                time.sleep(backoffDelay(attempt))
+                attempt += 1
             else:                
                 sys.stderr.write('Failed to create object using reference %s\n' %(reference))
                 tb = traceback.format_exc()
@@ -106,41 +343,46 @@ def putObject(wsClient, reference, type, data):
     sys.stderr.write('Failed to create object using reference %s because of network problems\n' %(reference))
     exit(1)
 
-if __name__ == '__main__':
-    # Parse options.
-    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, prog='ms-probanno', epilog=desc3)
-    parser.add_argument('genomeref', help='reference to genome object', action='store', default=None)
-    parser.add_argument('templateref', help='reference to template model object', action='store', default=None)
-    parser.add_argument('rxnprobsref', help='reference to rxnprobs object', action='store', default=None)
-    parser.add_argument('--ws-url', help='url of workspace service endpoint', action='store', dest='wsURL', default='https://p3.theseed.org/services/Workspace')
-    parser.add_argument('--token', help='token for user', action='store', dest='token', default=None)
-    usage = parser.format_usage()
-    parser.description = desc1 + '      ' + usage + desc2
-    parser.usage = argparse.SUPPRESS
-    args = parser.parse_args()
-    
-    # Get the token from the config file if one is not provided.
-    if args.token is None:
-        authdata = _read_inifile()
-        args.token = authdata['token']
-     
-    # Workaround for extraneous delimiter tacked on the end of references.
-    if args.genomeref[-2:] == '||':
-        args.genomeref = args.genomeref[:-2]
-    if args.templateref[-2:] == '||':
-        args.templateref = args.templateref[:-2]
-    
-    # Get the genome object from the workspace (for the features).
-    wsClient = Workspace(url=args.wsURL, token=args.token)
-    genome = getObject(wsClient, args.genomeref, args.token)
+def readManifest(filename, fieldNames=[ 'genomeref', 'templateref', 'rxnprobsref' ]):
+    ''' Read a manifest file with the genomes to annotate in a batch.
+
+        @param filename: Path to manifest file
+        @param fieldNames: List of names of fields in each line
+        @return List of tuples with genome reference, template reference, and rxnprobs reference
+            (and the other fields in fieldNames)
+    '''
+
+    entries = list()
+    with open(filename, 'r') as handle:
+        for line in handle:
+            line = line.strip()
+            if len(line) == 0 or line[0] == '#':
+                continue
+            fields = line.split()
+            if len(fields) != len(fieldNames):
+                sys.stderr.write('Manifest line "%s" does not have a %s, and %s\n' %(line, ', '.join(fieldNames[:-1]), fieldNames[-1]))
+                exit(1)
+            entries.append(tuple(fields))
+    return entries
+
+def fixReference(reference):
+    ''' Remove the extraneous delimiter tacked on the end of a reference.
+
+        @param reference: Reference to workspace object
+        @return Fixed reference
+    '''
+
+    if reference[-2:] == '||':
+        return reference[:-2]
+    return reference
 
-    # Get the template object from the workspace (for the complexes and roles).
-    template = getObject(wsClient, args.templateref, args.token)
+def buildTemplateMappings(template):
+    ''' Build the complex and reaction mappings used by the algorithm from a template.
 
-    # Build a dictionary to look up roles in the template by ID.
-    roles = dict()
-    for index in range(len(template['roles'])):        
-        roles[template['roles'][index]['id']] = index
+        @param template: Template model object data
+        @return Dictionary mapping a complex to a list of roles, dictionary mapping
+            a reaction to a list of complexes
+    '''
 
     # Create a dictionary to map a complex to a list of roles as defined in the template.
     complexesToRoles = dict()
@@ -164,31 +406,327 @@ if __name__ == '__main__':
                 # Complex ID is last element in reference.
                 reactionsToComplexes[reactionId].append(complexRef.split('/')[-1])
 
-    # Create a worker for running the algorithm.
-    worker = ProbAnnotationWorker(genome['id'])
-        
-    # Run the probabilistic annotation algorithm.
+    return complexesToRoles, reactionsToComplexes
+
+def getCompiledTemplate(wsClient, reference, token, dataParser):
+    ''' Get the compiled mappings for a template from the cache or build them from the template object.
+
+        @param wsClient: Workspace client object
+        @param reference: Reference to template object
+        @param token: Authentication token for user
+        @param dataParser: ProbAnnotationParser object for the compiled template cache
+        @return Key of template in the compiled template cache, CompiledTemplate object
+    '''
+
+    # The creation time and ID change when the template object is replaced.
+    metadata = getObjectMetadata(wsClient, reference)
+    key = dataParser.templateCacheKey(reference, metadata[3], metadata[4])
+    template = dataParser.readCompiledTemplate(key)
+    if template is None:
+        complexesToRoles, reactionsToComplexes = buildTemplateMappings(getObject(wsClient, reference, token))
+        template = CompiledTemplate(complexesToRoles, reactionsToComplexes)
+        dataParser.writeCompiledTemplate(key, template)
+    return key, template
+
+def submitToServer(url, genomeId, features, templateKey):
+    ''' Run the probabilistic annotation algorithm for a genome on an annotation server.
+
+        @param url: URL of annotation server
+        @param genomeId: Genome ID string
+        @param features: List of features with protein sequences
+        @param templateKey: Key of template in the compiled template cache
+        @return List of reaction probabilities or None when the server is not running
+    '''
+
+    features = [ { 'id': f['id'], 'protein_translation': f['protein_translation'] } for f in features if 'protein_translation' in f ]
+    client = ProbAnnotationClient(url)
     try:
-        # Convert the features in the genome object to a fasta file.
-        fastaFile = worker.genomeToFasta(genome['features'])
-        
-        # Run blast using the fasta file.
+        output = client.annotate({ 'genome_id': genomeId, 'features': features, 'template_key': templateKey })
+    except requests.exceptions.ConnectionError:
+        sys.stderr.write('Annotation server at %s is not running, running algorithm locally\n' %(url))
+        return None
+    return output['reaction_probabilities']
+
+def runLikelihoodStages(worker, rolestringTuples, template):
+    ''' Run the stages of the algorithm that follow the roleset probabilities.
+
+        @param worker: ProbAnnotationWorker object for the genome
+        @param rolestringTuples: Dictionary keyed by query gene of list of tuples with roleset and likelihood
+        @param template: CompiledTemplate object with the complexes and reactions from the template
+        @return List of reaction probabilities
+    '''
+
+    # Calculate per-gene role probabilities.
+    roleProbs = worker.rolesetProbabilitiesToRoleProbabilities(rolestringTuples)
+
+    # Calculate whole cell role probabilities.
+    totalRoleProbs = worker.totalRoleProbabilities(roleProbs)
+
+    # Calculate complex and reaction probabilities.
+    return worker.templateProbabilities(totalRoleProbs, template)
+
+def runBatch(wsClient, token, entries):
+    ''' Run the probabilistic annotation algorithm for a batch of genomes with one search.
+
+        @param wsClient: Workspace client object
+        @param token: Authentication token for user
+        @param entries: List of tuples with genome reference, template reference, and rxnprobs reference
+        @return Number of entries that failed
+    '''
+
+    # Create a worker for running the algorithm on all of the genomes.
+    worker = ProbAnnotationWorker('batch')
+
+    # Start getting the compiled mappings for every template (once per template) while the
+    # genomes are searched.
+    waitTemplates = dict()
+    for genomeref, templateref, rxnprobsref in entries:
+        if templateref not in waitTemplates:
+            waitTemplates[templateref] = startFetch(getCompiledTemplate, wsClient, templateref, token, worker.dataParser)
+
+    # Get the genome objects from the workspace one at a time as the fasta file is built (a
+    # genome listed more than once is only searched once).
+    genomes = dict()
+    genomeIds = list()
+    def batchGenomes():
+        genomerefs = list()
+        for genomeref, templateref, rxnprobsref in entries:
+            if genomeref not in genomerefs:
+                genomerefs.append(genomeref)
+        for genomeref, genome in prefetchGenomes(wsClient, token, genomerefs):
+            genomes[genomeref] = genome.genomeId
+            if genome.genomeId not in genomeIds:
+                genomeIds.append(genome.genomeId)
+                yield genome.genomeId, genome.features()
+        return
+
+    # Search for the proteins from all of the genomes and split the results by genome.
+    try:
+        fastaFile = worker.genomesToFasta(batchGenomes())
         blastResultFile = worker.runBlast(fastaFile)
+        blastResultFiles = worker.splitBlastOutput(blastResultFile, genomeIds)
+
+    except Exception as e:
+        worker.cleanup()
+        sys.stderr.write('Failed to run protein search for batch: %s\n' %(e.message))
+        tb = traceback.format_exc()
+        sys.stderr.write(tb)
+        exit(1)
+    templates = dict()
+    for templateref in waitTemplates:
+        templateKey, templates[templateref] = waitTemplates[templateref]()
+
+    # Run the rest of the algorithm and store a rxnprobs object for each entry.
+    numFailed = 0
+    for genomeref, templateref, rxnprobsref in entries:
+        genomeId = genomes[genomeref]
+        worker.selectGenome(genomeId)
+        try:
+            rolestringTuples = worker.rolesetProbabilitiesMarble(blastResultFiles[genomeId])
+            reactionProbs = runLikelihoodStages(worker, rolestringTuples, templates[templateref])
+        except Exception as e:
+            numFailed += 1
+            sys.stderr.write('Failed to run probabilistic annotation algorithm for %s: %s\n' %(genomeref, e.message))
+            tb = traceback.format_exc()
+            sys.stderr.write(tb)
+            continue
+        data = dict()
+        data['reaction_probabilities'] = reactionProbs
+        putObject(wsClient, rxnprobsref, 'rxnprobs', data)
+
+    # Cleanup work directory.
+    worker.cleanup()
+    return numFailed
+
+def runCommunity(wsClient, token, entries):
+    ''' Run the probabilistic annotation algorithm for the members of a community model with one search.
+
+        @param wsClient: Workspace client object
+        @param token: Authentication token for user
+        @param entries: List of tuples with genome reference, template reference, rxnprobs reference,
+            and community index
+        @return Nothing
+    '''
+
+    # All of the members use the same compiled template.
+    if len(set([ templateref for genomeref, templateref, rxnprobsref, communityIndex in entries ])) != 1:
+        sys.stderr.write('All members of a community must use the same template\n')
+        exit(1)
+
+    # Create a worker for running the algorithm on all of the members.
+    worker = ProbAnnotationWorker('community')
+    waitTemplate = startFetch(getCompiledTemplate, wsClient, entries[0][1], token, worker.dataParser)
+
+    # Get the genome objects from the workspace one at a time as the fasta file is built (a
+    # genome listed more than once is only retrieved once).  The worker keys the members by
+    # genome ID, so when two references have a genome with the same ID, the proteins from the
+    # first reference are used for both and the second genome is closed without being read.
+    genomerefs = list()
+    for genomeref, templateref, rxnprobsref, communityIndex in entries:
+        if genomeref not in genomerefs:
+            genomerefs.append(genomeref)
+    genomes = prefetchGenomes(wsClient, token, genomerefs)
+    genomeIds = dict()
+    firstRefs = dict()
+    def members():
+        for genomeref, templateref, rxnprobsref, communityIndex in entries:
+            if genomeref in genomeIds:
+                yield genomeIds[genomeref], communityIndex, list()
+                continue
+            fetchedref, genome = genomes.next()
+            genomeIds[genomeref] = genome.genomeId
+            if genome.genomeId in firstRefs:
+                genome.close()
+                sys.stderr.write('Genome %s from %s has the same ID as the genome from %s so the proteins from %s are used\n' \
+                                 %(genome.genomeId, genomeref, firstRefs[genome.genomeId], firstRefs[genome.genomeId]))
+                yield genome.genomeId, communityIndex, list()
+                continue
+            firstRefs[genome.genomeId] = genomeref
+            yield genome.genomeId, communityIndex, genome.features()
+        return
+    templateKey, compiledTemplate = waitTemplate()
+
+    # Store the rxnprobs object for each member as soon as it is available.
+    index = 0
+    try:
+        for genomeId, communityIndex, reactionProbs in worker.communityReactionProbabilities(members(), compiledTemplate):
+            data = dict()
+            data['reaction_probabilities'] = reactionProbs
+            putObject(wsClient, entries[index][2], 'rxnprobs', data)
+            index += 1
+
+    except Exception as e:
+        worker.cleanup()
+        sys.stderr.write('Failed to run probabilistic annotation algorithm for community: %s\n' %(e.message))
+        tb = traceback.format_exc()
+        sys.stderr.write(tb)
+        exit(1)
+
+    # Cleanup work directory.
+    worker.cleanup()
+    return
+
+if __name__ == '__main__':
+    # Parse options.
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, prog='ms-probanno', epilog=desc3)
+    parser.add_argument('genomeref', help='reference to genome object', action='store', nargs='?', default=None)
+    parser.add_argument('templateref', help='reference to template model object', action='store', nargs='?', default=None)
+    parser.add_argument('rxnprobsref', help='reference to rxnprobs object', action='store', nargs='?', default=None)
+    parser.add_argument('--batch', help='path to manifest file with genomes to annotate in a batch', action='store', dest='batch', default=None)
+    parser.add_argument('--community', help='path to manifest file with members of a community model to annotate', action='store', dest='community', default=None)
+    parser.add_argument('--stream', help='score search results as they are produced without an output file', action='store_true', dest='stream', default=False)
+    parser.add_argument('--incremental', help='only search for proteins that changed since the genome was last annotated', action='store_true', dest='incremental', default=False)
+    parser.add_argument('--server', help='url of annotation server to run the algorithm', action='store', dest='server', default=None)
+    parser.add_argument('--compact-file', help='path to local file for compact copy of reaction probabilities', action='store', dest='compactFile', default=None)
+    parser.add_argument('--host-limit', help='maximum number of requests at the same time to a service host from all jobs on this machine', action='store', type=int, dest='hostLimit', default=HOST_REQUEST_LIMIT)
+    parser.add_argument('--ws-url', help='url of workspace service endpoint', action='store', dest='wsURL', default='https://p3.theseed.org/services/Workspace')
+    parser.add_argument('--token', help='token for user', action='store', dest='token', default=None)
+    usage = parser.format_usage()
+    parser.description = desc1 + '      ' + usage + desc2
+    parser.usage = argparse.SUPPRESS
+    args = parser.parse_args()
+    if args.batch is None and args.community is None and args.rxnprobsref is None:
+        parser.error('genomeref, templateref, and rxnprobsref are required when --batch or --community is not specified')
+    if args.community is not None and (args.batch is not None or args.stream or args.server is not None or args.incremental or args.compactFile is not None):
+        parser.error('--community is not supported with --batch, --stream, --server, --incremental, or --compact-file')
+    if args.batch is not None and args.stream:
+        parser.error('--stream is not supported with --batch')
+    if args.server is not None and (args.batch is not None or args.stream):
+        parser.error('--server is not supported with --batch or --stream')
+    if args.incremental and (args.batch is not None or args.server is not None):
+        parser.error('--incremental is not supported with --batch or --server')
+    if args.compactFile is not None and args.batch is not None:
+        parser.error('--compact-file is not supported with --batch')
+    
+    # Get the token from the config file if one is not provided.
+    if args.token is None:
+        authdata = _read_inifile()
+        args.token = authdata['token']
+
+    if args.hostLimit < 1:
+        parser.error('--host-limit must be at least 1')
+    hostLimit = args.hostLimit
+
+    wsClient = Workspace(url=args.wsURL, token=args.token)
+
+    # Run the algorithm for all of the genomes in the manifest file.
+    if args.batch is not None:
+        entries = [ (fixReference(g), fixReference(t), r) for g, t, r in readManifest(args.batch) ]
+        if runBatch(wsClient, args.token, entries) > 0:
+            exit(1)
+        exit(0)
+
+    # Run the algorithm for all of the members of a community model.
+    if args.community is not None:
+        entries = [ (fixReference(g), fixReference(t), r, c) for g, t, r, c in
+                    readManifest(args.community, [ 'genomeref', 'templateref', 'rxnprobsref', 'community index' ]) ]
+        runCommunity(wsClient, args.token, entries)
+        exit(0)
+
+    # Workaround for extraneous delimiter tacked on the end of references.
+    args.genomeref = fixReference(args.genomeref)
+    args.templateref = fixReference(args.templateref)
+    
+    # Create a worker for running the algorithm (the genome is selected when its ID is known).
+    worker = ProbAnnotationWorker(os.path.basename(args.genomeref))
+
+    # Get the compiled mappings for the template (for the complexes and roles) while the
+    # genome object is being read.
+    waitTemplate = startFetch(getCompiledTemplate, wsClient, args.templateref, args.token, worker.dataParser)
+
+    # Get the genome object from the workspace (for the protein sequences of the features).
+    genome = getGenome(wsClient, args.genomeref, args.token)
+    features = genome.features()
+    worker.selectGenome(genome.genomeId)
+
+    # Submit the genome to the annotation server when one is running.
+    reactionProbs = None
+    if args.server is not None:
+        templateKey, compiledTemplate = waitTemplate()
+        try:
+            # Keep the features in case the algorithm is run locally.
+            features = list(features)
+            reactionProbs = submitToServer(args.server, genome.genomeId, features, templateKey)
+        except Exception as e:
+            worker.cleanup()
+            sys.stderr.write('Failed to run probabilistic annotation algorithm on server: %s\n' %(e))
+            exit(1)
+    if reactionProbs is not None:
+        worker.cleanup()
+        if args.compactFile is not None:
+            worker.dataParser.writeCompactRxnprobsFile(args.compactFile, reactionProbs)
+        data = dict()
+        data['reaction_probabilities'] = reactionProbs
+        putObject(wsClient, args.rxnprobsref, 'rxnprobs', data)
+        exit(0)
         
-        # Calculate roleset probabilities.
-        rolestringTuples = worker.rolesetProbabilitiesMarble(blastResultFile)
-        
-        # Calculate per-gene role probabilities.
-        roleProbs = worker.rolesetProbabilitiesToRoleProbabilities(rolestringTuples)
-        
-        # Calculate whole cell role probabilities.
-        totalRoleProbs = worker.totalRoleProbabilities(roleProbs)
+    # Run the probabilistic annotation algorithm.
+    try:
+        if args.incremental:
+            # Search for the new and changed proteins and merge with the saved role probabilities.
+            roleProbs = worker.incrementalRoleProbabilities(features, stream=args.stream)
+            totalRoleProbs = worker.totalRoleProbabilities(roleProbs)
+            templateKey, compiledTemplate = waitTemplate()
+            reactionProbs = worker.templateProbabilities(totalRoleProbs, compiledTemplate)
+
+        else:
+            # Convert the features in the genome object to a fasta file.
+            fastaFile = worker.genomeToFasta(features)
+
+            # Run blast using the fasta file and calculate roleset probabilities.
+            if args.stream:
+                rolestringTuples = worker.runBlastPipeline(fastaFile)
+            else:
+                blastResultFile = worker.runBlast(fastaFile)
+                rolestringTuples = worker.rolesetProbabilitiesMarble(blastResultFile)
+
+            # Calculate reaction probabilities from the roleset probabilities.
+            templateKey, compiledTemplate = waitTemplate()
+            reactionProbs = runLikelihoodStages(worker, rolestringTuples, compiledTemplate)
 
-        # Calculate complex probabilities.
-        complexProbs = worker.complexProbabilities(totalRoleProbs, complexesToRequiredRoles = complexesToRoles)
- 
-        # Calculate reaction probabilities.
-        reactionProbs = worker.reactionProbabilities(complexProbs, rxnsToComplexes = reactionsToComplexes) 
+        # Save a compact copy of the reaction probabilities.
+        if args.compactFile is not None:
+            worker.dataParser.writeCompactRxnprobsFile(args.compactFile, reactionProbs)
 
         # Cleanup work directory.
         worker.cleanup()
@@ -205,4 +743,4 @@ if __name__ == '__main__':
     data['reaction_probabilities'] = reactionProbs
     putObject(wsClient, args.rxnprobsref, 'rxnprobs', data)
 
-    exit(0)
\ No newline at end of file
+    exit(0)